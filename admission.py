@@ -0,0 +1,212 @@
+"""
+Контроль допуска для дорогих эндпоинтов (/api/chat-stream, /api/chat-ws, /remove).
+
+- token bucket на каждое устройство (device_id или IP) и эндпоинт;
+- лимит одновременных задач на каждый этап конвейера (STT/LLM/TTS/RVC/image) с очередью;
+- сброс нагрузки по глубине очереди: 429 + Retry-After вместо бесконечного ожидания;
+- приоритет для устройств, которые уже проходят квест (успешно распознанная реплика
+  за последние active_ttl секунд — не просто допуск, иначе повторы сами себя повышают);
+- фоновые прогревы (/api/warmup) идут последними и первыми отсекаются при очереди.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+
+PRIORITY_ACTIVE = 0   # устройство уже проходит квест
+PRIORITY_NEW = 1
+PRIORITY_BACKGROUND = 2  # прогрев, которого никто не ждёт
+
+# Приоритет текущего запроса, выставляется эндпоинтом и читается лимитерами этапов
+current_priority = contextvars.ContextVar("admission_priority", default=PRIORITY_NEW)
+
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен; retry_after — через сколько секунд имеет смысл повторить"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """0 если токен выдан, иначе сколько секунд ждать до следующего"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class StageLimiter:
+    """Ограничение параллелизма этапа с приоритетной очередью ожидания"""
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self.avg_service = 1.0
+        self.admitted = 0
+        self.shed = 0
+        self.peak_queue = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _queue_limit(self, priority: int) -> int:
+        # Активные посетители могут занять вдвое более длинную очередь, прогрев — только половину
+        if priority == PRIORITY_ACTIVE:
+            return self.max_queue * 2
+        return self.max_queue // 2 if priority == PRIORITY_BACKGROUND else self.max_queue
+
+    def estimate_wait(self) -> float:
+        return (self.queued + 1) * self.avg_service / max(1, self.limit)
+
+    def check(self, priority: int):
+        if self.in_flight >= self.limit and self.queued >= self._queue_limit(priority):
+            self.shed += 1
+            raise AdmissionRejected(f"{self.name}: перегрузка", self.estimate_wait())
+
+    async def acquire(self, priority: int):
+        self.check(priority)
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        self.peak_queue = max(self.peak_queue, self.queued)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            elif future.done() and not future.cancelled():
+                # Слот уже был передан нам — отдаём следующему
+                self.release(0.0)
+            raise
+        self.admitted += 1
+
+    def release(self, service_time: float):
+        if service_time:
+            self.avg_service = 0.8 * self.avg_service + 0.2 * service_time
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Слот переходит ожидающему, in_flight не меняется
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @property
+    def load(self) -> float:
+        """(в работе + в очереди) / лимит: 1.0 — все слоты заняты"""
+        return (self.in_flight + self.queued) / self.limit
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "peak_queue": self.peak_queue,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_service": round(self.avg_service, 3),
+        }
+
+
+class AdmissionController:
+    def __init__(self, rate_limits: dict, stage_limits: dict, active_ttl: float = 1800):
+        """
+        rate_limits: {"chat": (токенов в секунду, burst), ...}
+        stage_limits: {"rvc": (одновременно, макс. очередь), ...}
+        """
+        self.rate_limits = rate_limits
+        self.stages = {name: StageLimiter(name, limit, queue) for name, (limit, queue) in stage_limits.items()}
+        self.active_ttl = active_ttl
+        self._buckets = {}
+        self._active = {}
+        self.rate_limited = {name: 0 for name in rate_limits}
+        self.accepted = {name: 0 for name in rate_limits}
+        self._last_cleanup = time.monotonic()
+
+    def touch(self, key: str):
+        """Отметить устройство как проходящее квест — после успешного распознавания, не при допуске"""
+        if key:
+            self._active[key] = time.monotonic()
+
+    def priority_for(self, key: str) -> int:
+        seen = self._active.get(key)
+        if seen is not None and time.monotonic() - seen < self.active_ttl:
+            return PRIORITY_ACTIVE
+        return PRIORITY_NEW
+
+    def check_rate(self, endpoint: str, key: str):
+        """Token bucket на (эндпоинт, устройство); бросает AdmissionRejected"""
+        self._cleanup()
+        rate, burst = self.rate_limits[endpoint]
+        bucket = self._buckets.get((endpoint, key))
+        if bucket is None:
+            bucket = self._buckets[(endpoint, key)] = TokenBucket(rate, burst)
+        wait = bucket.take()
+        if wait > 0:
+            self.rate_limited[endpoint] += 1
+            raise AdmissionRejected(f"{endpoint}: слишком частые запросы", wait)
+        self.accepted[endpoint] += 1
+
+    def admit(self, endpoint: str, key: str, stages=()):
+        """Проверка при входе: лимит частоты и заведомо переполненные очереди этапов"""
+        self.check_rate(endpoint, key)
+        priority = self.priority_for(key)
+        for name in stages:
+            self.stages[name].check(priority)
+        current_priority.set(priority)
+        return priority
+
+    @asynccontextmanager
+    async def stage(self, name: str):
+        limiter = self.stages[name]
+        await limiter.acquire(current_priority.get())
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            limiter.release(time.monotonic() - started)
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        # Полные корзины ничего не помнят — их можно выбросить
+        self._buckets = {k: b for k, b in self._buckets.items()
+                         if b.tokens + (now - b.updated) * b.rate < b.capacity}
+        self._active = {k: t for k, t in self._active.items() if now - t < self.active_ttl}
+
+    def snapshot(self) -> dict:
+        return {
+            "accepted": dict(self.accepted),
+            "rate_limited": dict(self.rate_limited),
+            "tracked_devices": len(self._active),
+            "stages": {name: limiter.snapshot() for name, limiter in self.stages.items()},
+        }
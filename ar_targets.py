@@ -0,0 +1,232 @@
+"""
+Наборы AR-маркеров по времени суток.
+
+index.html грузил assets/targets_all.mind: дневные и ночные снимки всех четырёх скульптур
+(индексы 0–7). Телефон скачивал вдвое больше данных, а MindAR сверял каждый кадр с восемью
+маркерами вместо четырёх. Здесь:
+
+- build — targets_all.mind (msgpack {"v", "dataList"}) режется на day/night без перекомпиляции:
+  данные маркеров те же байты, поэтому трекинг не меняется. Файлы с хешем в имени (и их .gz)
+  и manifest.json с соответствием индекс -> персонаж лежат в AR_TARGETS_DIR;
+- choose_variant — набор по высоте солнца над парком; подсказка освещённости от клиента
+  (датчик освещённости или средняя яркость кадра камеры) важнее расчёта. В сумерках,
+  когда неясно, какой снимок ближе, отдаётся полный набор.
+
+Сборка (сервер делает её и сам при старте, если исходник изменился):
+    python ar_targets.py build
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from asset_build import write_precompressed
+
+AR_TARGETS_SOURCE = os.environ.get("AR_TARGETS_SOURCE", os.path.join("assets", "targets_all.mind"))
+AR_TARGETS_DIR = os.environ.get("AR_TARGETS_DIR", os.path.join("build", "ar_targets"))
+# day | night | all | auto
+AR_TARGETS_VARIANT = os.environ.get("AR_TARGETS_VARIANT", "auto")
+
+# Координаты парка для расчёта высоты солнца
+PARK_LAT = float(os.environ.get("PARK_LAT", "55.75"))
+PARK_LON = float(os.environ.get("PARK_LON", "37.62"))
+# Солнце выше — день, ниже AR_NIGHT_ELEVATION — ночь (скульптуры уже в свете фонарей), между — сумерки
+AR_DAY_ELEVATION = float(os.environ.get("AR_DAY_ELEVATION", "-2"))
+AR_NIGHT_ELEVATION = float(os.environ.get("AR_NIGHT_ELEVATION", "-8"))
+
+# Пороги подсказок клиента: освещённость в люксах и средняя яркость кадра (0–255)
+LUX_NIGHT, LUX_DAY = 10.0, 60.0
+BRIGHTNESS_NIGHT, BRIGHTNESS_DAY = 50.0, 90.0
+
+# Порядок маркеров в targets_all.mind
+TARGET_LAYOUT = [
+    ("cheb", "day"), ("volc", "day"), ("gena", "day"), ("shap", "day"),
+    ("cheb", "night"), ("volc", "night"), ("gena", "night"), ("shap", "night"),
+]
+VARIANTS = ("day", "night")
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def manifest_path(out_dir: str = AR_TARGETS_DIR) -> str:
+    return os.path.join(out_dir, "manifest.json")
+
+
+def build(source: str = AR_TARGETS_SOURCE, out_dir: str = AR_TARGETS_DIR) -> dict:
+    """
+    Полный набор копируется как есть; day/night вырезаются из него (нужен msgpack).
+    Без msgpack в манифесте остаётся только полный набор.
+    """
+    with open(source, "rb") as f:
+        raw = f.read()
+    os.makedirs(out_dir, exist_ok=True)
+
+    def emit(variant: str, data: bytes, indexes: list) -> dict:
+        name = f"{variant}.{_sha256(data)[:12]}.mind"
+        path = os.path.join(out_dir, name)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+            # .mind — массивы чисел в msgpack, gzip уменьшает их вдвое
+            write_precompressed(path, data)
+        return {
+            "file": name,
+            "bytes": len(data),
+            "targets": [
+                {"index": i, "character": TARGET_LAYOUT[source_index][0], "variant": TARGET_LAYOUT[source_index][1]}
+                for i, source_index in enumerate(indexes)
+            ],
+        }
+
+    variants = {"all": emit("all", raw, list(range(len(TARGET_LAYOUT))))}
+    try:
+        import msgpack
+        compiled = msgpack.unpackb(raw, strict_map_key=False)
+        if len(compiled["dataList"]) != len(TARGET_LAYOUT):
+            raise ValueError(f"в {source} {len(compiled['dataList'])} маркеров, ожидалось {len(TARGET_LAYOUT)}")
+        for variant in VARIANTS:
+            indexes = [i for i, (_, v) in enumerate(TARGET_LAYOUT) if v == variant]
+            data = msgpack.packb({**compiled, "dataList": [compiled["dataList"][i] for i in indexes]})
+            variants[variant] = emit(variant, data, indexes)
+    except ImportError:
+        logging.getLogger("ar_targets").warning("msgpack не установлен: доступен только полный набор маркеров")
+
+    manifest = {"source": _sha256(raw), "variants": variants}
+    _write_atomic(manifest_path(out_dir), json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+
+    # Старые файлы с другим хешем больше не нужны
+    keep = {v["file"] for v in variants.values()}
+    for name in os.listdir(out_dir):
+        if name.endswith((".mind", ".mind.gz", ".mind.br")) and name.split(".mind")[0] + ".mind" not in keep:
+            os.remove(os.path.join(out_dir, name))
+    return manifest
+
+
+def load_manifest(source: str = AR_TARGETS_SOURCE, out_dir: str = AR_TARGETS_DIR) -> Optional[dict]:
+    """Манифест, пересобранный при изменении исходника; None, если исходника нет"""
+    if not os.path.exists(source):
+        return None
+    try:
+        with open(manifest_path(out_dir), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        with open(source, "rb") as f:
+            if manifest["source"] == _sha256(f.read()) and all(
+                os.path.exists(os.path.join(out_dir, v["file"])) for v in manifest["variants"].values()
+            ):
+                return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    return build(source, out_dir)
+
+
+# ---------- выбор набора ----------
+
+def sun_elevation(when: datetime, lat: float = PARK_LAT, lon: float = PARK_LON) -> float:
+    """Высота солнца в градусах (приближение NOAA, точность ~0.5° — для выбора набора достаточно)"""
+    when = when.astimezone(timezone.utc)
+    hour = when.hour + when.minute / 60 + when.second / 3600
+    g = 2 * math.pi / 365 * (when.timetuple().tm_yday - 1 + (hour - 12) / 24)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(g) - 0.032077 * math.sin(g)
+                       - 0.014615 * math.cos(2 * g) - 0.040849 * math.sin(2 * g))
+    decl = (0.006918 - 0.399912 * math.cos(g) + 0.070257 * math.sin(g) - 0.006758 * math.cos(2 * g)
+            + 0.000907 * math.sin(2 * g) - 0.002697 * math.cos(3 * g) + 0.00148 * math.sin(3 * g))
+    hour_angle = math.radians((hour * 60 + eqtime + 4 * lon) / 4 - 180)
+    lat_r = math.radians(lat)
+    cos_zenith = math.sin(lat_r) * math.sin(decl) + math.cos(lat_r) * math.cos(decl) * math.cos(hour_angle)
+    return 90 - math.degrees(math.acos(max(-1.0, min(1.0, cos_zenith))))
+
+
+def variant_by_sun(when: datetime) -> str:
+    elevation = sun_elevation(when)
+    if elevation >= AR_DAY_ELEVATION:
+        return "day"
+    if elevation <= AR_NIGHT_ELEVATION:
+        return "night"
+    return "all"
+
+
+def variant_by_light(lux: Optional[float], brightness: Optional[float]) -> Optional[str]:
+    if lux is not None:
+        if lux <= LUX_NIGHT:
+            return "night"
+        if lux >= LUX_DAY:
+            return "day"
+    if brightness is not None:
+        if brightness <= BRIGHTNESS_NIGHT:
+            return "night"
+        if brightness >= BRIGHTNESS_DAY:
+            return "day"
+    return None
+
+
+def seconds_until_change(when: datetime, variant: str, horizon: int = 2 * 3600, step: int = 300) -> int:
+    """Через сколько секунд расчёт по солнцу даст другой набор (не дальше horizon)"""
+    for offset in range(step, horizon + step, step):
+        if variant_by_sun(when + timedelta(seconds=offset)) != variant:
+            return offset
+    return horizon
+
+
+def choose_variant(manifest: dict, when: datetime = None, lux: float = None, brightness: float = None) -> dict:
+    """Набор маркеров для клиента: {variant, reason, valid_for, file, bytes, targets}"""
+    when = when or datetime.now(timezone.utc)
+    available = manifest["variants"]
+    by_sun = variant_by_sun(when)
+
+    if AR_TARGETS_VARIANT in available:
+        variant, reason = AR_TARGETS_VARIANT, "config"
+    else:
+        variant, reason = variant_by_light(lux, brightness), "light"
+        if variant is None:
+            variant, reason = by_sun, ("sun" if by_sun != "all" else "twilight")
+    if variant not in available:
+        variant, reason = "all", "fallback"
+
+    return {
+        "variant": variant,
+        "reason": reason,
+        # Подсказка клиента действует, пока не сменится время суток по расчёту
+        "valid_for": seconds_until_change(when, by_sun),
+        **available[variant],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Наборы AR-маркеров по времени суток")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="разрезать targets_all.mind на day/night")
+    p_build.add_argument("--source", default=AR_TARGETS_SOURCE)
+    p_build.add_argument("--out", default=AR_TARGETS_DIR)
+    p_show = sub.add_parser("show", help="какой набор выбран сейчас")
+    p_show.add_argument("--lux", type=float)
+    p_show.add_argument("--brightness", type=float)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if os.path.isdir(args.out):
+            shutil.rmtree(args.out)
+        manifest = build(args.source, args.out)
+        for variant, info in manifest["variants"].items():
+            print(f"{variant}: {info['file']} ({info['bytes'] / 1e6:.2f} МБ, {len(info['targets'])} маркеров)")
+    else:
+        choice = choose_variant(load_manifest(), lux=args.lux, brightness=args.brightness)
+        print(f"{choice['variant']} ({choice['reason']}), солнце {sun_elevation(datetime.now(timezone.utc)):.1f}°, "
+              f"действует {choice['valid_for'] // 60} мин")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+Сборка облегчённых вариантов статики из assets/ (запускается перед деплоем).
+
+- GLB: встроенные текстуры уменьшаются до MAX_TEXTURE_SIZE и пережимаются (JPEG, PNG —
+  только если альфа-канал реально используется); геометрия сжимается через gltf-transform,
+  если он установлен (Draco для статичных моделей — декодер A-Frame берёт с gstatic,
+  KHR_mesh_quantization для анимированных — декодер не нужен);
+- MP3: перекодируются в AAC (.m4a, играет везде, включая iOS): песни — стерео, реплики — моно.
+  Кроме dialogues/: клиент режет их в Blob'ы с типом audio/mpeg (и спрайты, и запасной
+  загрузчик по файлам), а спрайты всё равно собираются из исходных MP3 (audio_sprites.py);
+- JS, .mind, GLB: заранее сжатые .gz (и .br, если установлен brotli) — отдаются по Accept-Encoding.
+
+Результат — build/assets/ с хешем содержимого в именах и manifest.json. Сервер отдаёт
+облегчённый вариант по исходному URL /assets/..., а если исходник изменился после сборки
+или варианта нет — исходный файл.
+
+    python asset_build.py            # собрать и показать экономию по каждому файлу
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+from typing import Optional
+
+ASSETS_DIR = os.environ.get("ASSETS_DIR", "assets")
+ASSETS_BUILD_DIR = os.environ.get("ASSETS_BUILD_DIR", os.path.join("build", "assets"))
+MAX_TEXTURE_SIZE = int(os.environ.get("MAX_TEXTURE_SIZE", "1024"))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "85"))
+GLTF_TRANSFORM = os.environ.get("GLTF_TRANSFORM", "gltf-transform")
+SONG_BITRATE = os.environ.get("SONG_BITRATE", "96k")
+VOICE_BITRATE = os.environ.get("VOICE_BITRATE", "48k")
+PRECOMPRESS_EXTENSIONS = (".js", ".css", ".json", ".mind", ".glb")
+# Вариант берётся, только если он заметно меньше исходника
+MIN_SAVING = 0.05
+# Каталоги, где MP3 остаются MP3 (см. описание модуля)
+KEEP_MP3_DIRS = ("dialogues/",)
+
+MEDIA_TYPES = {
+    ".glb": "model/gltf-binary",
+    ".m4a": "audio/mp4",
+    ".mp3": "audio/mpeg",
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".json": "application/json",
+    ".mind": "application/octet-stream",
+}
+
+GLB_MAGIC = 0x46546C67
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# ==================== GLB ====================
+
+def read_glb(data: bytes):
+    magic, version, _ = struct.unpack_from("<III", data, 0)
+    if magic != GLB_MAGIC or version != 2:
+        raise ValueError("не GLB 2.0")
+    offset, gltf, binary = 12, None, b""
+    while offset < len(data):
+        length, kind = struct.unpack_from("<II", data, offset)
+        chunk = data[offset + 8:offset + 8 + length]
+        if kind == CHUNK_JSON:
+            gltf = json.loads(chunk)
+        elif kind == CHUNK_BIN:
+            binary = chunk
+        offset += 8 + length
+    return gltf, binary
+
+
+def write_glb(gltf: dict, binary: bytes) -> bytes:
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    binary += b"\0" * (-len(binary) % 4)
+    total = 12 + 8 + len(json_chunk) + (8 + len(binary) if binary else 0)
+    out = struct.pack("<III", GLB_MAGIC, 2, total) + struct.pack("<II", len(json_chunk), CHUNK_JSON) + json_chunk
+    if binary:
+        out += struct.pack("<II", len(binary), CHUNK_BIN) + binary
+    return out
+
+
+def recompress_image(data: bytes, max_size: int = MAX_TEXTURE_SIZE, quality: int = JPEG_QUALITY):
+    """(байты, mime) уменьшенной текстуры; None, если выгоды нет"""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if max(image.size) > max_size:
+        scale = max_size / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.Resampling.LANCZOS)
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        alpha = image.convert("RGBA").getchannel("A")
+        has_alpha = alpha.getextrema()[0] < 255
+
+    buffer = io.BytesIO()
+    if has_alpha:
+        image.convert("RGBA").save(buffer, format="PNG", optimize=True)
+        mime = "image/png"
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True, progressive=False)
+        mime = "image/jpeg"
+    result = buffer.getvalue()
+    return (result, mime) if len(result) < len(data) * (1 - MIN_SAVING) else None
+
+
+def optimize_textures(gltf: dict, binary: bytes) -> bytes:
+    """Пережимает изображения из bufferView и заново раскладывает BIN-буфер"""
+    views = gltf.get("bufferViews", [])
+    if any(view.get("buffer", 0) != 0 for view in views) or len(gltf.get("buffers", [])) > 1:
+        return binary
+
+    replaced = {}
+    for image in gltf.get("images", []):
+        index = image.get("bufferView")
+        if index is None:
+            continue
+        view = views[index]
+        start = view.get("byteOffset", 0)
+        result = recompress_image(binary[start:start + view["byteLength"]])
+        if result is not None:
+            replaced[index], image["mimeType"] = result
+
+    if not replaced:
+        return binary
+
+    out = bytearray()
+    for index, view in enumerate(views):
+        start = view.get("byteOffset", 0)
+        chunk = replaced.get(index, binary[start:start + view["byteLength"]])
+        out += b"\0" * (-len(out) % 4)
+        view["byteOffset"] = len(out)
+        view["byteLength"] = len(chunk)
+        out += chunk
+    gltf["buffers"][0]["byteLength"] = len(out)
+    return bytes(out)
+
+
+def compress_geometry(src: str, dst: str, animated: bool) -> Optional[str]:
+    """Сжатие геометрии внешним gltf-transform; None, если его нет или он не справился"""
+    method = "quantize" if animated else "draco"
+    try:
+        proc = subprocess.run([GLTF_TRANSFORM, method, src, dst], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        return None
+    return method if proc.returncode == 0 and os.path.exists(dst) else None
+
+
+def optimize_glb(path: str, work_dir: str):
+    """(байты, описание шагов)"""
+    with open(path, "rb") as f:
+        gltf, binary = read_glb(f.read())
+    steps = []
+    textured = optimize_textures(gltf, binary)
+    if textured is not binary:
+        steps.append(f"текстуры ≤{MAX_TEXTURE_SIZE}px")
+    data = write_glb(gltf, textured)
+
+    animated = bool(gltf.get("animations") or gltf.get("skins"))
+    src = os.path.join(work_dir, "textured.glb")
+    dst = os.path.join(work_dir, "compressed.glb")
+    with open(src, "wb") as f:
+        f.write(data)
+    method = compress_geometry(src, dst, animated)
+    if method:
+        with open(dst, "rb") as f:
+            data = f.read()
+        steps.append(method)
+    return data, steps
+
+
+# ==================== АУДИО ====================
+
+def transcode_audio(path: str, work_dir: str):
+    """MP3 -> AAC в MP4 (moov в начале файла, чтобы воспроизведение начиналось сразу)"""
+    song = "song" in os.path.basename(path)
+    out = os.path.join(work_dir, "audio.m4a")
+    cmd = ["ffmpeg", "-y", "-i", path, "-vn", "-c:a", "aac",
+           "-b:a", SONG_BITRATE if song else VOICE_BITRATE, "-ac", "2" if song else "1",
+           "-movflags", "+faststart", out]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", errors="ignore")[-500:])
+    with open(out, "rb") as f:
+        return f.read(), [f"aac {SONG_BITRATE if song else VOICE_BITRATE}"]
+
+
+# ==================== СБОРКА ====================
+
+def precompress(data: bytes) -> dict:
+    """{кодировка: байты} для вариантов, которые меньше хотя бы на 10%"""
+    variants = {"gzip": gzip.compress(data, 9, mtime=0)}
+    try:
+        import brotli
+        variants["br"] = brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data) * 0.9}
+
+
+def write_precompressed(path: str, data: bytes):
+    """Рядом с файлом — path.gz / path.br (для файлов, собираемых не здесь, например ar_targets)"""
+    for encoding, body in precompress(data).items():
+        _write(os.path.dirname(path), os.path.basename(path) + (".gz" if encoding == "gzip" else ".br"), body)
+
+
+def precompressed_file(path: str, accept_encoding: str):
+    """(путь, заголовки): заранее сжатый вариант файла, если он есть и клиент его принимает"""
+    accepted = {token.split(";")[0].strip() for token in accept_encoding.split(",")}
+    headers = {"Vary": "Accept-Encoding"}
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if encoding in accepted and os.path.exists(path + suffix):
+            headers["Content-Encoding"] = encoding
+            return path + suffix, headers
+    return path, headers
+
+
+def _write(out_dir: str, name: str, data: bytes):
+    tmp = os.path.join(out_dir, f".{name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, os.path.join(out_dir, name))
+
+
+def build_asset(path: str, rel: str, out_dir: str) -> Optional[dict]:
+    stem, ext = os.path.splitext(os.path.basename(rel))
+    with open(path, "rb") as f:
+        original = f.read()
+
+    data, out_ext, steps = original, ext, []
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            if ext == ".glb":
+                data, steps = optimize_glb(path, work_dir)
+            elif ext == ".mp3" and not rel.startswith(KEEP_MP3_DIRS):
+                data, steps = transcode_audio(path, work_dir)
+                out_ext = ".m4a"
+        except Exception as e:
+            print(f"  {rel}: оптимизация не удалась ({e}), остаётся исходник")
+            data, out_ext, steps = original, ext, []
+    if len(data) > len(original) * (1 - MIN_SAVING):
+        data, out_ext, steps = original, ext, []
+
+    encodings = precompress(data) if out_ext in PRECOMPRESS_EXTENSIONS else {}
+    if data is original and not encodings:
+        return None
+
+    digest = _sha256(data)[:12]
+    name = f"{stem}.{digest}{out_ext}"
+    _write(out_dir, name, data)
+    entry = {
+        "file": name,
+        "media_type": MEDIA_TYPES.get(out_ext, "application/octet-stream"),
+        "bytes": len(data),
+        "etag": digest,
+        "steps": steps,
+        "encodings": {},
+        "source": {"bytes": len(original), "mtime_ns": os.stat(path).st_mtime_ns},
+    }
+    for encoding, body in encodings.items():
+        suffix = ".gz" if encoding == "gzip" else ".br"
+        _write(out_dir, name + suffix, body)
+        entry["encodings"][encoding] = {"file": name + suffix, "bytes": len(body)}
+    return entry
+
+
+def build(assets_dir: str = ASSETS_DIR, out_dir: str = ASSETS_BUILD_DIR) -> dict:
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {"assets": {}}
+    for root, _, files in os.walk(assets_dir):
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            rel = os.path.relpath(path, assets_dir).replace(os.sep, "/")
+            if os.path.splitext(filename)[1] not in (".glb", ".mp3") + PRECOMPRESS_EXTENSIONS:
+                continue
+            entry = build_asset(path, rel, out_dir)
+            if entry is not None:
+                manifest["assets"][rel] = entry
+
+    _write(out_dir, "manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    keep = {"manifest.json"}
+    for entry in manifest["assets"].values():
+        keep.add(entry["file"])
+        keep.update(v["file"] for v in entry["encodings"].values())
+    for name in os.listdir(out_dir):
+        if name not in keep:
+            os.remove(os.path.join(out_dir, name))
+    return manifest
+
+
+def report(manifest: dict):
+    total_before = total_after = 0
+    print(f"{'файл':<36} {'было, КБ':>10} {'стало, КБ':>10} {'по сети, КБ':>12}  шаги")
+    for rel, entry in sorted(manifest["assets"].items()):
+        wire = min([entry["bytes"]] + [v["bytes"] for v in entry["encodings"].values()])
+        before = entry["source"]["bytes"]
+        total_before += before
+        total_after += wire
+        steps = ", ".join(entry["steps"] + sorted(entry["encodings"])) or "-"
+        print(f"{rel:<36} {before / 1024:>10.0f} {entry['bytes'] / 1024:>10.0f} {wire / 1024:>12.0f}  {steps}")
+    if total_before:
+        print(f"{'итого':<36} {total_before / 1024:>10.0f} {'':>10} {total_after / 1024:>12.0f}  "
+              f"-{100 * (1 - total_after / total_before):.0f}%")
+
+
+# ==================== ОТДАЧА ====================
+
+class AssetManifest:
+    """Облегчённые варианты для сервера; манифест перечитывается после новой сборки"""
+
+    def __init__(self, assets_dir: str = ASSETS_DIR, out_dir: str = ASSETS_BUILD_DIR):
+        self.assets_dir = assets_dir
+        self.out_dir = out_dir
+        self._path = os.path.join(out_dir, "manifest.json")
+        self._mtime = None
+        self._assets = {}
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except OSError:
+            self._assets, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            with open(self._path, "r", encoding="utf-8") as f:
+                self._assets = json.load(f)["assets"]
+            self._mtime = mtime
+
+    def resolve(self, rel: str, accept_encoding: str = ""):
+        """
+        (путь к файлу, media_type, заголовки) облегчённого варианта или None —
+        тогда отдаётся исходник (нет варианта или исходник изменился после сборки).
+        """
+        self._reload()
+        entry = self._assets.get(rel)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(os.path.join(self.assets_dir, rel))
+        except OSError:
+            return None
+        if stat.st_size != entry["source"]["bytes"] or stat.st_mtime_ns != entry["source"]["mtime_ns"]:
+            return None
+
+        headers = {"Cache-Control": "public, max-age=86400", "ETag": f'"{entry["etag"]}"'}
+        if entry["encodings"]:
+            headers["Vary"] = "Accept-Encoding"
+        accepted = {token.split(";")[0].strip() for token in accept_encoding.split(",")}
+        for encoding in ("br", "gzip"):
+            variant = entry["encodings"].get(encoding)
+            if variant and encoding in accepted:
+                headers["Content-Encoding"] = encoding
+                headers["ETag"] = f'"{entry["etag"]}-{encoding}"'
+                return os.path.join(self.out_dir, variant["file"]), entry["media_type"], headers
+        return os.path.join(self.out_dir, entry["file"]), entry["media_type"], headers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Облегчённые варианты статики из assets/")
+    parser.add_argument("--assets", default=ASSETS_DIR)
+    parser.add_argument("--out", default=ASSETS_BUILD_DIR)
+    args = parser.parse_args()
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg не найден: аудио останется в MP3")
+    if shutil.which(GLTF_TRANSFORM) is None:
+        print(f"{GLTF_TRANSFORM} не найден (npm i -g @gltf-transform/cli): геометрия GLB не сжимается")
+    report(build(args.assets, args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Аудиоспрайты сценарных реплик: по одному файлу на персонажа вместо 16 отдельных MP3.
+
+Реплики assets/dialogues/<персонаж>-<n>.mp3 склеиваются по MP3-кадрам без перекодирования
+(ID3-теги отбрасываются, кадры — те же байты). Манифест хранит для каждой реплики смещение
+и длину в байтах и время начала в спрайте: клиент скачивает спрайт одним запросом и режет
+его на Blob'ы по смещениям — каждый кусок остаётся самостоятельным MP3 и играет в <audio>
+как исходный файл, без неточной перемотки внутри спрайта на iOS.
+
+Спрайты с хешем содержимого в имени и manifest.json лежат в DIALOGUE_SPRITES_DIR и
+пересобираются, как только меняется состав, размер или время изменения исходных реплик.
+
+    python audio_sprites.py        # собрать и показать, что получилось
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+from typing import Optional
+
+DIALOGUES_DIR = os.environ.get("DIALOGUES_DIR", os.path.join("assets", "dialogues"))
+DIALOGUE_SPRITES_DIR = os.environ.get("DIALOGUE_SPRITES_DIR", os.path.join("build", "audio_sprites"))
+
+CLIP_NAME = re.compile(r"^(?P<character>[a-z]+)-(?P<index>\d+)\.mp3$")
+
+# Битрейты слоя III, кбит/с: MPEG-1 и MPEG-2/2.5
+_BITRATES_V1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_BITRATES_V2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# ---------- MP3 ----------
+
+def strip_tags(data: bytes) -> bytes:
+    """Аудиокадры без ID3v2 в начале и ID3v1 в конце"""
+    start = 0
+    while data[start:start + 3] == b"ID3":
+        flags = data[start + 5]
+        size = 0
+        for byte in data[start + 6:start + 10]:
+            size = (size << 7) | (byte & 0x7F)
+        start += 10 + size + (10 if flags & 0x10 else 0)
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    return data[start:end]
+
+
+def parse_frames(data: bytes):
+    """
+    (длительность звука, длительность потока, частота дискретизации) в секундах для MP3 слоя III.
+    Служебный кадр Xing/Info (заголовок LAME) звука не содержит и в длительность звука не входит,
+    но при сквозном воспроизведении спрайта звучит как тишина длиной в один кадр.
+    """
+    offset, samples, total, frames, sample_rate = 0, 0, 0, 0, None
+    while offset + 4 <= len(data):
+        header, = struct.unpack_from(">I", data, offset)
+        version = (header >> 19) & 0x3
+        layer = (header >> 17) & 0x3
+        bitrate_index = (header >> 12) & 0xF
+        rate_index = (header >> 10) & 0x3
+        if (header >> 21) != 0x7FF or version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            if frames:
+                break  # хвост после последнего кадра (APE-тег и т.п.)
+            raise ValueError(f"не MP3-кадр по смещению {offset}")
+        mpeg1 = version == 3
+        bitrate = (_BITRATES_V1 if mpeg1 else _BITRATES_V2)[bitrate_index] * 1000
+        rate = _SAMPLE_RATES[version][rate_index]
+        frame_samples = 1152 if mpeg1 else 576
+        length = frame_samples // 8 * bitrate // rate + ((header >> 9) & 0x1)
+
+        side_info = (32 if (header >> 6) & 0x3 != 3 else 17) if mpeg1 else (17 if (header >> 6) & 0x3 != 3 else 9)
+        tag = data[offset + 4 + side_info:offset + 8 + side_info]
+        if not (frames == 0 and tag in (b"Xing", b"Info")):
+            samples += frame_samples
+        total += frame_samples
+        sample_rate = sample_rate or rate
+        frames += 1
+        offset += length
+    if not frames:
+        raise ValueError("в файле нет MP3-кадров")
+    return samples / sample_rate, total / sample_rate, sample_rate
+
+
+# ---------- сборка ----------
+
+def source_clips(source_dir: str = DIALOGUES_DIR) -> dict:
+    """{персонаж: [имена реплик по порядку]}"""
+    clips = {}
+    try:
+        names = os.listdir(source_dir)
+    except OSError:
+        return {}
+    for name in names:
+        match = CLIP_NAME.match(name)
+        if match:
+            clips.setdefault(match["character"], []).append((int(match["index"]), name))
+    return {character: [name for _, name in sorted(items)] for character, items in sorted(clips.items())}
+
+
+def source_signature(source_dir: str = DIALOGUES_DIR) -> str:
+    """Отпечаток исходников по именам, размерам и mtime — дёшево проверять на каждом запросе"""
+    parts = []
+    for names in source_clips(source_dir).values():
+        for name in names:
+            stat = os.stat(os.path.join(source_dir, name))
+            parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return _sha256("\n".join(parts).encode("utf-8"))[:16]
+
+
+def build(source_dir: str = DIALOGUES_DIR, out_dir: str = DIALOGUE_SPRITES_DIR) -> dict:
+    os.makedirs(out_dir, exist_ok=True)
+    signature = source_signature(source_dir)
+    sprites = {}
+    for character, names in source_clips(source_dir).items():
+        sprite, clips, position = bytearray(), {}, 0.0
+        for name in names:
+            with open(os.path.join(source_dir, name), "rb") as f:
+                audio = strip_tags(f.read())
+            duration, stream, sample_rate = parse_frames(audio)
+            clips[name] = {
+                "offset": len(sprite),
+                "length": len(audio),
+                "start": round(position, 4),
+                "duration": round(duration, 4),
+                "sample_rate": sample_rate,
+            }
+            sprite += audio
+            position += stream
+
+        data = bytes(sprite)
+        file_name = f"{character}.{_sha256(data)[:12]}.mp3"
+        path = os.path.join(out_dir, file_name)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+        sprites[character] = {"file": file_name, "bytes": len(data), "etag": _sha256(data)[:12], "clips": clips}
+
+    manifest = {"source": signature, "sprites": sprites}
+    _write_atomic(os.path.join(out_dir, "manifest.json"),
+                  json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+
+    keep = {sprite["file"] for sprite in sprites.values()}
+    for name in os.listdir(out_dir):
+        if name.endswith(".mp3") and name not in keep:
+            os.remove(os.path.join(out_dir, name))
+    return manifest
+
+
+def load_manifest(source_dir: str = DIALOGUES_DIR, out_dir: str = DIALOGUE_SPRITES_DIR) -> Optional[dict]:
+    """Манифест спрайтов, пересобранный при изменении реплик; None, если реплик нет"""
+    if not source_clips(source_dir):
+        return None
+    try:
+        with open(os.path.join(out_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["source"] == source_signature(source_dir) and all(
+            os.path.exists(os.path.join(out_dir, s["file"])) for s in manifest["sprites"].values()
+        ):
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    return build(source_dir, out_dir)
+
+
+# ---------- отдача ----------
+
+def byte_range(range_header: Optional[str], size: int):
+    """
+    (start, end) включительно для заголовка Range: bytes=a-b | a- | -n.
+    None — заголовка нет или он не разобран (отдаётся весь файл), ValueError — диапазон вне файла.
+    Несколько диапазонов в одном запросе не поддерживаются: отдаётся первый.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    first = range_header[6:].split(",")[0].strip()
+    start, _, end = first.partition("-")
+    try:
+        if start:
+            start, end = int(start), (int(end) if end else size - 1)
+        else:
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(first)
+    return start, min(end, size - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аудиоспрайты сценарных реплик")
+    parser.add_argument("--source", default=DIALOGUES_DIR)
+    parser.add_argument("--out", default=DIALOGUE_SPRITES_DIR)
+    args = parser.parse_args()
+    if os.path.isdir(args.out):
+        shutil.rmtree(args.out)
+    manifest = build(args.source, args.out)
+    for character, sprite in manifest["sprites"].items():
+        clips = sprite["clips"]
+        total = sum(os.path.getsize(os.path.join(args.source, name)) for name in clips)
+        print(f"{character}: {sprite['file']} — {len(clips)} реплик, {sprite['bytes'] / 1024:.0f} КБ "
+              f"(было {total / 1024:.0f} КБ в {len(clips)} запросах), "
+              f"{sum(c['duration'] for c in clips.values()):.1f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Скорость и точность извлечения f0 на голосах TTS, которые идут в RVC (alena, ermil, jane, filipp).
+
+Для каждого голоса фраза синтезируется Yandex SpeechKit (или берётся из --samples-dir/<голос>.wav)
+и прогоняется через все доступные методы pitch.py. Печатаются:
+- RTF — время извлечения / длительность аудио (меньше — лучше);
+- ошибка тона относительно эталона: медиана в центах, доля грубых ошибок (> 50 центов),
+  доля расхождений вокализации.
+Эталон — harvest (pyworld), если установлен, иначе YIN. Дополнительно — синтетический
+сигнал с известным тоном (глиссандо 120→400 Гц) как проверка самих методов.
+
+Пример:
+    YANDEX_API_KEY=... YANDEX_FOLDER_ID=... python bench_f0.py --repeat 5
+    python bench_f0.py --samples-dir samples/
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import requests
+
+import pitch
+
+VOICES = ("alena", "ermil", "jane", "filipp")
+PHRASE = ("Привет! Я очень рад, что ты пришёл к нам в гости. "
+          "Давай вместе поищем апельсины и построим дом для всех, у кого нет друзей.")
+TTS_URL = "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize"
+
+
+def synthesize(voice: str, api_key: str, folder_id: str) -> np.ndarray:
+    """Сырой PCM 16 кГц из SpeechKit — без ffmpeg"""
+    response = requests.post(
+        TTS_URL,
+        headers={"Authorization": f"Api-Key {api_key}"},
+        data={"text": PHRASE, "lang": "ru-RU", "voice": voice, "folderId": folder_id,
+              "format": "lpcm", "sampleRateHertz": str(pitch.F0_SAMPLE_RATE)},
+        timeout=60,
+    )
+    response.raise_for_status()
+    return np.frombuffer(response.content, dtype="<i2").astype(np.float32) / 32768
+
+
+def load_sample(voice: str, args) -> np.ndarray:
+    if args.samples_dir:
+        path = os.path.join(args.samples_dir, f"{voice}.wav")
+        if os.path.exists(path):
+            return pitch.load_audio(path)
+    if not (args.api_key and args.folder_id):
+        raise SystemExit(f"Нет {voice}.wav в --samples-dir и не заданы YANDEX_API_KEY/YANDEX_FOLDER_ID")
+    audio = synthesize(voice, args.api_key, args.folder_id)
+    if args.samples_dir:
+        import soundfile as sf
+        os.makedirs(args.samples_dir, exist_ok=True)
+        sf.write(os.path.join(args.samples_dir, f"{voice}.wav"), audio, pitch.F0_SAMPLE_RATE)
+    return audio
+
+
+def glide(duration: float = 3.0) -> tuple:
+    """Гармонический сигнал с известным тоном, с паузами, и его эталонная кривая"""
+    sr, hop = pitch.F0_SAMPLE_RATE, pitch.F0_HOP
+    t = np.arange(int(duration * sr)) / sr
+    f0 = 120 * (400 / 120) ** (t / duration)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    signal = sum(np.sin(k * phase) / k for k in range(1, 6)).astype(np.float32) * 0.3
+    gate = (np.sin(2 * np.pi * t / duration * 3) > -0.7)
+    signal *= gate
+    reference = np.where(gate[::hop], f0[::hop], 0.0)[: len(signal) // hop + 1]
+    return signal, reference.astype(np.float32)
+
+
+def run_methods(audio: np.ndarray, reference, methods, repeat: int):
+    duration = len(audio) / pitch.F0_SAMPLE_RATE
+    for method in methods:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            f0 = pitch.extract_f0(method, audio)
+            times.append(time.perf_counter() - start)
+        rtf = min(times) / duration
+        line = f"  {method:<9} RTF {rtf:7.4f}"
+        if reference is not None:
+            error = pitch.pitch_error(f0, reference)
+            if error["median_cents"] is not None:
+                line += (f" | медиана {error['median_cents']:6.1f} центов"
+                         f" | грубые {error['gross_error'] * 100:5.1f}%")
+            line += f" | вокализация {error['voicing_error'] * 100:5.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voices", nargs="+", default=list(VOICES))
+    parser.add_argument("--methods", nargs="+", default=None, help="по умолчанию — все доступные")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--samples-dir", default="")
+    parser.add_argument("--api-key", default=os.environ.get("YANDEX_API_KEY", ""))
+    parser.add_argument("--folder-id", default=os.environ.get("YANDEX_FOLDER_ID", ""))
+    args = parser.parse_args()
+
+    methods = args.methods or pitch.available_methods()
+    reference_method = "harvest" if "harvest" in pitch.available_methods() else "yin"
+
+    print("Синтетика (глиссандо 120→400 Гц, эталон известен):")
+    signal, reference = glide()
+    run_methods(signal, reference, methods, args.repeat)
+
+    for voice in args.voices:
+        audio = load_sample(voice, args)
+        reference = pitch.extract_f0(reference_method, audio)
+        print(f"{voice} ({len(audio) / pitch.F0_SAMPLE_RATE:.1f} с, эталон {reference_method}):")
+        run_methods(audio, reference, [m for m in methods if m != reference_method] + [reference_method],
+                    args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Память и задержка поиска по индексам RVC: как в RvcWebUI (индекс в кучу + reconstruct_n
+на каждый вызов) против rvc_index (IVF-PQ + векторы через mmap, батч-поиск).
+
+Память меряется в N процессах-«воркерах» одновременно: RSS и PSS из /proc/self/smaps_rollup
+(PSS делит общие страницы между процессами — видно, что mmap-копия одна на всех).
+
+Пример:
+    python bench_index.py --model cheb --workers 4
+    python bench_index.py --synthetic 200000 --workers 4    # без logs/*.index
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import rvc_index
+
+FRAMES = 250  # ~5 секунд реплики: HuBERT даёт 50 кадров в секунду
+
+
+def memory_kb() -> dict:
+    result = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                result[key.lower()] = int(value.split()[0])
+    return result
+
+
+def make_synthetic(logs_dir: str, count: int, dim: int = 768) -> str:
+    """Индекс того же вида, что обучает RVC: IVF-Flat с nprobe=1"""
+    import faiss
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(64, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, 64, count)] + 0.3 * rng.normal(size=(count, dim)).astype(np.float32)
+    nlist = min(int(16 * np.sqrt(count)), count // 39)
+    index = faiss.index_factory(dim, f"IVF{nlist},Flat")
+    index.train(vectors)
+    index.add(vectors)
+    faiss.extract_index_ivf(index).nprobe = 1
+    faiss.write_index(index, os.path.join(logs_dir, "synthetic.index"))
+    return "synthetic"
+
+
+def rvcwebui_style(index_path: str, feats: np.ndarray, index_rate: float):
+    """Один вызов так, как это делает пайплайн RvcWebUI"""
+    import faiss
+
+    index = faiss.read_index(index_path)
+    big_npy = index.reconstruct_n(0, index.ntotal)
+    score, ix = index.search(feats, k=8)
+    weight = np.square(1 / score)
+    weight /= weight.sum(axis=1, keepdims=True)
+    retrieved = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+    return index_rate * retrieved + (1 - index_rate) * feats
+
+
+def worker(mode: str, paths: dict, feats: np.ndarray, repeat: int, barrier, results):
+    if mode == "heap":
+        run = lambda: rvcwebui_style(paths["source"], feats, 0.85)
+        keep = None
+    else:
+        retriever = rvc_index.IndexRetriever(paths["compact"], paths["vectors"])
+        retriever.blend(feats, 0.85)  # прогрев страниц
+        run = lambda: retriever.blend(feats, 0.85)
+        keep = retriever
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = run()
+        times.append(time.perf_counter() - start)
+    if mode == "heap":
+        # Держим восстановленные векторы, как процесс RvcWebUI между вызовами
+        import faiss
+        index = faiss.read_index(paths["source"])
+        keep = (index, index.reconstruct_n(0, index.ntotal))
+    barrier.wait()  # все воркеры держат данные одновременно
+    results.put({"median_ms": float(np.median(times)) * 1000, **memory_kb(), "shape": output.shape})
+    barrier.wait()
+    del keep
+
+
+def run_mode(mode: str, paths: dict, feats: np.ndarray, workers: int, repeat: int) -> list:
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(mode, paths, feats, repeat, barrier, results))
+                 for _ in range(workers)]
+    for p in processes:
+        p.start()
+    collected = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return collected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="")
+    parser.add_argument("--synthetic", type=int, default=100000, help="векторов в синтетическом индексе")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=rvc_index.RVC_INDEX_NPROBE)
+    args = parser.parse_args()
+
+    logs_dir = rvc_index.RVC_LOGS_DIR
+    model = args.model
+    if not model:
+        logs_dir = tempfile.mkdtemp()
+        model = make_synthetic(logs_dir, args.synthetic)
+
+    paths = rvc_index.index_paths(model, logs_dir)
+    if not os.path.exists(paths["compact"]):
+        info = rvc_index.convert_index(model, logs_dir, nprobe=args.nprobe)
+        print(f"Сконвертирован {model}: {info['source_mb']:.1f} МБ -> "
+              f"{info['compact_mb']:.1f} МБ + векторы {info['vectors_mb']:.1f} МБ")
+
+    import faiss
+    source = faiss.read_index(paths["source"])
+    feats = source.reconstruct_n(0, FRAMES) + np.float32(0.05)
+    del source
+
+    for mode, title in (("heap", "RvcWebUI (куча, reconstruct_n на вызов)"), ("mmap", "rvc_index (IVF-PQ + mmap)")):
+        results = run_mode(mode, paths, feats, args.workers, args.repeat)
+        rss = sum(r["rss"] for r in results) / 1024
+        pss = sum(r["pss"] for r in results) / 1024
+        latency = np.median([r["median_ms"] for r in results])
+        print(f"{title}:")
+        print(f"  {args.workers} воркеров: RSS {rss:8.1f} МБ, PSS {pss:8.1f} МБ (фактически занято)")
+        print(f"  поиск для {FRAMES} кадров: {latency:8.1f} мс")
+
+    # Точность компактного индекса относительно исходного (при одинаковом index_rate)
+    exact = rvcwebui_style(paths["source"], feats, 1.0)
+    approx = rvc_index.IndexRetriever(paths["compact"], paths["vectors"]).blend(feats, 1.0)
+    cosine = np.sum(exact * approx, axis=1) / (np.linalg.norm(exact, axis=1) * np.linalg.norm(approx, axis=1))
+    print(f"Сходство признаков IVF-PQ с исходным индексом: косинус {np.mean(cosine):.4f} (мин {np.min(cosine):.4f})")
+
+
+if __name__ == "__main__":
+    main()
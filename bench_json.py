@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Замер JSON-слоя на реалистичных объёмах: запрос к OpenRouter с картинкой в base64,
+ответ OpenRouter с картинкой и NDJSON-событие final с MP3 в base64.
+Сравнивается стандартный json со слоем serialization (orjson + потоковый разбор):
+время и пиковая память (tracemalloc).
+
+Пример:
+    python bench_json.py --sizes 2 5 10 --repeat 5
+"""
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import time
+import tracemalloc
+
+import serialization
+
+CHUNK = 256 * 1024
+
+
+def measure(fn, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def make_response(image_b64: str) -> bytes:
+    """Ответ chat/completions в формате OpenRouter с картинкой"""
+    return json.dumps({
+        "id": "gen-bench", "model": "google/gemini-2.5-flash-image",
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant", "content": "",
+                "images": [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}],
+            },
+        }],
+        "usage": {"prompt_tokens": 1290, "completion_tokens": 1290},
+    }).encode("utf-8")
+
+
+def chunks(data: bytes):
+    for i in range(0, len(data), CHUNK):
+        yield data[i:i + CHUNK]
+
+
+def report(title: str, baseline, fast):
+    (t0, m0), (t1, m1) = baseline, fast
+    print(f"  {title:<22} json: {t0 * 1000:8.1f} мс {m0 / 2**20:7.1f} МБ | "
+          f"fast: {t1 * 1000:8.1f} мс {m1 / 2**20:7.1f} МБ | x{t0 / max(t1, 1e-9):.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[2, 5, 10], help="размер картинки, МБ")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    prompt = "Перенеси людей с фото в мультфильм про Чебурашку, сохрани лица и позы."
+    for size in args.sizes:
+        image = os.urandom(int(size * 2**20))
+        image_b64 = base64.b64encode(image)
+        image_b64_str = image_b64.decode("ascii")
+        response = make_response(image_b64_str)
+        print(f"Картинка {size:g} МБ (base64 {len(image_b64) / 2**20:.1f} МБ):")
+
+        def request_json():
+            payload = {"model": "google/gemini-2.5-flash-image", "messages": [{"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64_str}"}},
+                {"type": "text", "text": prompt}]}]}
+            return json.dumps(payload).encode("utf-8")
+
+        def request_fast():
+            return serialization.build_image_edit_request("google/gemini-2.5-flash-image", prompt, image_b64)
+
+        assert json.loads(request_json()) == json.loads(request_fast())
+        report("запрос", measure(request_json, args.repeat), measure(request_fast, args.repeat))
+
+        def response_json():
+            url = json.loads(b"".join(chunks(response)))["choices"][0]["message"]["images"][0]["image_url"]["url"]
+            return base64.b64decode(url.split("base64,")[1])
+
+        def response_fast():
+            return serialization.extract_image_from_stream(chunks(response))
+
+        assert response_fast() == image
+        report("ответ", measure(response_json, args.repeat), measure(response_fast, args.repeat))
+
+        # Событие final: MP3 ответа ~ десятая часть картинки
+        audio_b64 = image_b64_str[: len(image_b64_str) // 10]
+        event = serialization.FinalEvent("Привет! Я Чебурашка. " * 5, audio_b64)
+
+        def event_json():
+            return json.dumps({"type": "final", "reply_text": event.reply_text, "audio_base64": audio_b64}) + "\n"
+
+        def event_fast():
+            return serialization.ndjson_line(event)
+
+        report("NDJSON final", measure(event_json, args.repeat), measure(event_fast, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Реестр персонажей из characters.json вместо констант в server.py и voice_generator.py.
+
+- load() читает и проверяет файл целиком: неизвестные поля, типы, методы f0 и бэкенды RVC.
+  Ошибки собираются все сразу (CharacterConfigError), на старте сервер с ними не поднимается;
+- CharacterSet — неизменяемый снимок. Запрос берёт персонажа один раз (characters.get(...))
+  и работает с ним до конца, поэтому правка файла посреди ответа не смешает старый промпт
+  с новым голосом;
+- CharacterRegistry.refresh() проверяет mtime файла и подменяет снимок одной операцией
+  присваивания; watch() делает это в фоне. Файл с ошибкой не применяется — остаётся прежний
+  снимок, ошибка видна в логе и в snapshot(). Вызывающий получает множество изменившихся
+  персонажей и прогревает только их;
+- revision / voice_revision — отпечатки настроек персонажа: по ним кеши ответов и заполнителей
+  отличают записи, сделанные со старыми промптом или голосом.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Awaitable, Callable, Optional
+
+from pitch import LOCAL_METHODS, RVC_NATIVE_METHODS
+
+CHARACTERS_FILE = os.environ.get("CHARACTERS_FILE", "characters.json")
+CHARACTERS_RELOAD_INTERVAL = float(os.environ.get("CHARACTERS_RELOAD_INTERVAL", "2"))
+
+RVC_BACKENDS = ("rvcwebui", "onnx")
+F0_METHODS = RVC_NATIVE_METHODS + LOCAL_METHODS
+
+# Для неизвестного персонажа — как раньше при .get(character, ...) по словарям
+FALLBACK_NAME = "Персонаж"
+FALLBACK_VOICE = "alena"
+FALLBACK_PROMPT = "Ты — дружелюбный помощник."
+
+log = logging.getLogger("characters")
+
+
+class CharacterConfigError(ValueError):
+    """Файл персонажей не прошёл проверку; errors — все найденные ошибки"""
+
+    def __init__(self, message: str, errors=()):
+        super().__init__(message)
+        self.errors = list(errors)
+
+
+@dataclass(frozen=True)
+class Character:
+    id: str
+    name: str
+    tts_voice: str
+    system_prompt: str
+    image_edit_prompt: str
+    # model, has_index, f0_method, offline_f0_method, backend; None — голос TTS без переозвучки
+    rvc: Optional[MappingProxyType] = None
+    context_budget: Optional[int] = None
+    fillers: tuple = ()
+    photo: bool = True
+    revision: str = field(default="", compare=False)
+    voice_revision: str = field(default="", compare=False)
+
+
+def _digest(value) -> str:
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+_FIELDS = {
+    "name": str, "tts_voice": str, "system_prompt": str, "image_edit_prompt": str,
+    "rvc": (dict, type(None)), "context_budget": (int, type(None)), "fillers": list, "photo": bool,
+}
+_REQUIRED = ("name", "tts_voice", "system_prompt", "image_edit_prompt")
+_RVC_FIELDS = {"model": str, "has_index": bool, "f0_method": str, "offline_f0_method": str, "backend": str}
+
+
+def _parse_rvc(character_id: str, raw: dict, errors: list) -> Optional[MappingProxyType]:
+    where = f"{character_id}.rvc"
+    for key in raw.keys() - _RVC_FIELDS.keys():
+        errors.append(f"{where}: неизвестное поле {key}")
+    for key, kind in _RVC_FIELDS.items():
+        if key in raw and not isinstance(raw[key], kind):
+            errors.append(f"{where}.{key}: ожидается {kind.__name__}")
+    if not raw.get("model"):
+        errors.append(f"{where}.model: не задана модель")
+    rvc = {
+        "model": raw.get("model"),
+        "has_index": raw.get("has_index", False),
+        "f0_method": raw.get("f0_method", "pm"),
+        "backend": raw.get("backend", "rvcwebui"),
+    }
+    rvc["offline_f0_method"] = raw.get("offline_f0_method", rvc["f0_method"])
+    for key in ("f0_method", "offline_f0_method"):
+        if rvc[key] not in F0_METHODS:
+            errors.append(f"{where}.{key}: {rvc[key]!r} не из {', '.join(F0_METHODS)}")
+    if rvc["backend"] not in RVC_BACKENDS:
+        errors.append(f"{where}.backend: {rvc['backend']!r} не из {', '.join(RVC_BACKENDS)}")
+    return MappingProxyType(rvc)
+
+
+def _parse_character(character_id: str, raw, errors: list) -> Optional[Character]:
+    if not isinstance(raw, dict):
+        errors.append(f"{character_id}: ожидается объект")
+        return None
+    if not character_id.isascii() or not character_id.isalpha() or not character_id.islower():
+        # id попадает в имена файлов (bg_<id>.png, dialogues/<id>-1.mp3) и ключи кешей
+        errors.append(f"{character_id}: id — только строчные латинские буквы")
+    for key in raw.keys() - _FIELDS.keys():
+        errors.append(f"{character_id}: неизвестное поле {key}")
+    for key in _REQUIRED:
+        if not raw.get(key):
+            errors.append(f"{character_id}.{key}: обязательное поле")
+    for key, kind in _FIELDS.items():
+        # bool — подкласс int: context_budget: true не должен пройти
+        if key in raw and (not isinstance(raw[key], kind) or (kind is not bool and isinstance(raw[key], bool))):
+            errors.append(f"{character_id}.{key}: неверный тип {type(raw[key]).__name__}")
+            return None
+    if raw.get("context_budget") is not None and raw["context_budget"] < 300:
+        errors.append(f"{character_id}.context_budget: меньше 300 токенов не хватит даже на промпт и ответ")
+    fillers = raw.get("fillers", [])
+    if not all(isinstance(text, str) and text.strip() for text in fillers):
+        errors.append(f"{character_id}.fillers: нужны непустые строки")
+
+    rvc = _parse_rvc(character_id, raw["rvc"], errors) if raw.get("rvc") is not None else None
+    voice = {"tts_voice": raw.get("tts_voice"), "rvc": dict(rvc) if rvc else None}
+    return Character(
+        id=character_id,
+        name=raw.get("name", ""),
+        tts_voice=raw.get("tts_voice", ""),
+        system_prompt=raw.get("system_prompt", ""),
+        image_edit_prompt=raw.get("image_edit_prompt", ""),
+        rvc=rvc,
+        context_budget=raw.get("context_budget"),
+        fillers=tuple(fillers),
+        photo=raw.get("photo", True),
+        revision=_digest(raw),
+        voice_revision=_digest(voice),
+    )
+
+
+class CharacterSet:
+    """Неизменяемый снимок реестра"""
+
+    def __init__(self, characters: dict, default: str, source: str = ""):
+        self.characters = characters
+        self.default = default
+        self.source = source
+        self.fallback = Character(
+            id="", name=FALLBACK_NAME, tts_voice=FALLBACK_VOICE, system_prompt=FALLBACK_PROMPT,
+            image_edit_prompt=characters[default].image_edit_prompt, photo=False,
+        )
+
+    def get(self, character_id: Optional[str]) -> Character:
+        return self.characters.get(character_id) or self.fallback
+
+    def __contains__(self, character_id) -> bool:
+        return character_id in self.characters
+
+    def __iter__(self):
+        return iter(self.characters)
+
+    def photo_characters(self) -> list:
+        return [c.id for c in self.characters.values() if c.photo]
+
+    def context_budgets(self) -> dict:
+        return {c.id: c.context_budget for c in self.characters.values() if c.context_budget}
+
+    def filler_phrases(self) -> dict:
+        return {c.id: list(c.fillers) for c in self.characters.values() if c.fillers}
+
+    def voice_revisions(self) -> dict:
+        return {c.id: c.voice_revision for c in self.characters.values()}
+
+    def changed(self, other: "CharacterSet") -> set:
+        """Персонажи, добавленные, удалённые или изменённые в other относительно self"""
+        ids = set(self.characters) | set(other.characters)
+        return {i for i in ids if i not in self.characters or i not in other.characters
+                or self.characters[i].revision != other.characters[i].revision}
+
+
+def parse(data, source: str = "") -> CharacterSet:
+    errors = []
+    if not isinstance(data, dict) or not isinstance(data.get("characters"), dict) or not data["characters"]:
+        raise CharacterConfigError(f"{source}: нужен объект с непустым полем characters")
+    for key in data.keys() - {"default", "characters"}:
+        errors.append(f"неизвестное поле верхнего уровня {key}")
+    characters = {}
+    for character_id, raw in data["characters"].items():
+        character = _parse_character(character_id, raw, errors)
+        if character is not None:
+            characters[character_id] = character
+    default = data.get("default", next(iter(data["characters"])))
+    if default not in characters:
+        errors.append(f"default: персонажа {default!r} нет в characters")
+    if errors:
+        raise CharacterConfigError(f"{source}: " + "; ".join(errors), errors)
+    return CharacterSet(characters, default, source)
+
+
+def load(path: str = CHARACTERS_FILE) -> CharacterSet:
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise CharacterConfigError(f"{path}: не JSON ({e})")
+    return parse(data, path)
+
+
+class CharacterRegistry:
+    def __init__(self, path: str = CHARACTERS_FILE):
+        self.path = path
+        self._mtime = os.stat(path).st_mtime_ns
+        # Ошибка в файле на старте — исключение: сервер не должен подняться с неполным реестром
+        self.current = load(path)
+        self.reloads = 0
+        self.last_error = None
+
+    def get(self, character_id: Optional[str]) -> Character:
+        return self.current.get(character_id)
+
+    def refresh(self) -> Optional[tuple]:
+        """
+        (старый снимок, новый, изменившиеся id), если файл изменился и прошёл проверку, иначе None.
+        Синхронный: в сервере вызывается через to_thread.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            self.last_error = str(e)
+            return None
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        try:
+            new = load(self.path)
+        except (OSError, CharacterConfigError) as e:
+            # Файл могли сохранить не целиком — применится следующая версия
+            self.last_error = str(e)
+            log.error("Персонажи не перезагружены, остаются прежние: %s", e)
+            return None
+        old, self.current = self.current, new
+        self.last_error = None
+        changed = old.changed(new)
+        if changed:
+            self.reloads += 1
+            log.info("Персонажи перезагружены, изменились: %s", ", ".join(sorted(changed)))
+        return old, new, changed
+
+    async def watch(self, on_change: Callable[[CharacterSet, CharacterSet, set], Awaitable[None]],
+                    interval: float = CHARACTERS_RELOAD_INTERVAL):
+        """Фоновая проверка файла; on_change получает только непустые изменения"""
+        while True:
+            await asyncio.sleep(interval)
+            result = await asyncio.to_thread(self.refresh)
+            if result is None or not result[2]:
+                continue
+            try:
+                await on_change(*result)
+            except Exception:
+                log.exception("Ошибка при применении новых настроек персонажей")
+
+    def snapshot(self) -> dict:
+        return {
+            "file": self.path,
+            "characters": {c.id: c.revision for c in self.current.characters.values()},
+            "reloads": self.reloads,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,160 @@
+"""
+Контекст диалога для LLM с бюджетом токенов.
+
+Раньше в каждый запрос уходили системный промпт и до 10 сырых реплик, и промпт рос с каждым
+ходом. Теперь:
+- у каждого персонажа бюджет токенов на контекст;
+- старые реплики сворачиваются в короткую сводку фоновой задачей после ответа
+  (вне критического пути), свёрнутые реплики убираются из истории;
+- порядок сообщений: системный промпт (байт в байт один и тот же) -> сводка -> свежие реплики,
+  поэтому префикс запроса стабилен и кеширование промпта на стороне LLM срабатывает.
+
+Токены оцениваются по числу символов; коэффициент подстраивается по usage.inputTextTokens
+из ответов YandexGPT.
+"""
+
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger("conversation")
+
+
+class ConversationContext:
+    def __init__(self, state, budgets: dict, default_budget: int = 900, reply_reserve: int = 200,
+                 keep_recent: int = 4, compact_ratio: float = 0.6, chars_per_token: float = 3.0,
+                 summary_ttl: float = 6 * 3600):
+        """
+        budgets — {персонаж: токенов на весь запрос}, включая reply_reserve под ответ.
+        Сводка строится, когда контекст занимает больше compact_ratio бюджета;
+        keep_recent последних сообщений всегда остаются дословно.
+        """
+        self.state = state
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.reply_reserve = reply_reserve
+        self.keep_recent = keep_recent
+        self.compact_ratio = compact_ratio
+        self.chars_per_token = chars_per_token
+        self.summary_ttl = summary_ttl
+        self.compactions = 0
+        self.compaction_failures = 0
+        self.dropped_turns = 0
+        self.prompt_tokens = []  # последние фактические размеры промптов
+
+    # ---------- токены ----------
+
+    def count_tokens(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token) + 4  # + служебные токены сообщения
+
+    def observe_usage(self, messages: list, input_tokens: int):
+        """Подстройка коэффициента символы/токен по фактическому usage LLM"""
+        if input_tokens <= 0:
+            return
+        chars = sum(len(m["text"]) for m in messages)
+        observed = chars / max(1, input_tokens - 4 * len(messages))
+        self.chars_per_token = 0.9 * self.chars_per_token + 0.1 * min(max(observed, 1.5), 6.0)
+        self.prompt_tokens.append(input_tokens)
+        del self.prompt_tokens[:-200]
+
+    def budget_for(self, character: str) -> int:
+        return self.budgets.get(character, self.default_budget)
+
+    # ---------- сборка запроса ----------
+
+    def _summary_key(self, device_id: str, character: str) -> str:
+        return f"summary:{device_id}:{character}"
+
+    async def get_summary(self, device_id: str, character: str) -> str:
+        summary = await self.state.get(self._summary_key(device_id, character))
+        return summary["text"] if summary else ""
+
+    def build_messages(self, character: str, system_prompt: str, summary: str, history: list,
+                       user_text: str) -> list:
+        """
+        Сообщения для LLM в пределах бюджета. Если сводка ещё не успела построиться,
+        самые старые реплики отбрасываются парами (вопрос-ответ).
+        """
+        messages = [{"role": "system", "text": system_prompt}]
+        if summary:
+            messages.append({"role": "system", "text": f"Краткое содержание разговора до этого: {summary}"})
+
+        available = (self.budget_for(character) - self.reply_reserve
+                     - sum(self.count_tokens(m["text"]) for m in messages) - self.count_tokens(user_text))
+        recent = list(history)
+        while recent and sum(self.count_tokens(m["text"]) for m in recent) > available:
+            drop = 2 if len(recent) > 1 and recent[0]["role"] == "user" else 1
+            del recent[:drop]
+            self.dropped_turns += 1
+
+        messages.extend(recent)
+        messages.append({"role": "user", "text": user_text})
+        return messages
+
+    # ---------- сводка ----------
+
+    def needs_compaction(self, character: str, system_prompt: str, summary: str, history: list) -> bool:
+        if len(history) <= self.keep_recent:
+            return False
+        used = (self.count_tokens(system_prompt) + self.count_tokens(summary)
+                + sum(self.count_tokens(m["text"]) for m in history) + self.reply_reserve)
+        return used > self.compact_ratio * self.budget_for(character)
+
+    async def compact(self, device_id: str, character: str, system_prompt: str, history: list,
+                      summarize: Callable[[str, list], Awaitable[str]]) -> bool:
+        """
+        Сворачивает всё, кроме keep_recent последних сообщений, в сводку.
+        summarize(предыдущая сводка, сообщения) -> новая сводка (вызов LLM).
+        Запускать фоном после ответа: на задержку текущего хода не влияет.
+        """
+        summary = await self.get_summary(device_id, character)
+        if not self.needs_compaction(character, system_prompt, summary, history):
+            return False
+        if not await self.state.try_lock(f"compact:{device_id}:{character}", 60):
+            return False
+
+        fold = history[:len(history) - self.keep_recent]
+        # Свёртка по границе пары, чтобы история начиналась с вопроса пользователя
+        if fold and fold[-1]["role"] == "user":
+            fold = fold[:-1]
+        if not fold:
+            return False
+
+        started = time.monotonic()
+        try:
+            new_summary = (await summarize(summary, fold)).strip()
+        except Exception as e:
+            self.compaction_failures += 1
+            log.warning("Не удалось свернуть историю %s/%s: %s", character, device_id, e)
+            return False
+        if not new_summary:
+            return False
+
+        await self.state.set(self._summary_key(device_id, character), {"text": new_summary}, self.summary_ttl)
+        await self.state.drop_history_head(device_id, character, len(fold))
+        self.compactions += 1
+        log.info("История %s свёрнута: %d сообщений -> %d токенов за %.2f сек", character, len(fold),
+                 self.count_tokens(new_summary), time.monotonic() - started)
+        return True
+
+    def snapshot(self) -> dict:
+        recent = self.prompt_tokens[-50:]
+        return {
+            "chars_per_token": round(self.chars_per_token, 2),
+            "compactions": self.compactions,
+            "compaction_failures": self.compaction_failures,
+            "dropped_turns": self.dropped_turns,
+            "avg_prompt_tokens": round(sum(recent) / len(recent), 1) if recent else None,
+            "max_prompt_tokens": max(recent) if recent else None,
+        }
+
+
+def format_for_summary(previous_summary: Optional[str], messages: list, character_name: str) -> str:
+    """Текст запроса на сводку: прежняя сводка + свёрнутые реплики"""
+    lines = []
+    if previous_summary:
+        lines.append(f"Прежнее краткое содержание: {previous_summary}")
+    for message in messages:
+        speaker = "Пользователь" if message["role"] == "user" else character_name
+        lines.append(f"{speaker}: {message['text']}")
+    return "\n".join(lines)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Экспорт голосовых моделей RVC в ONNX с динамическим int8-квантованием, проверка паритета
+с torch и замер RTF. Запускать на машине с RVC (нужны torch, fairseq, onnxruntime и код RVC).
+
+    python export_onnx.py export cheb gena shap volc --hubert hubert_base.pt --weights-dir weights
+    python export_onnx.py parity cheb --wav samples/alena.wav
+    python export_onnx.py bench cheb --wav samples/alena.wav --repeat 5
+
+Результат в RVC_ONNX_DIR (onnx/): contentvec_<версия>.{fp32,int8}.onnx, <модель>.{fp32,int8}.onnx,
+<модель>.json. Переключение персонажа: "backend": "onnx" в rvc персонажа (characters.json).
+
+Квантуются MatMul/Gather (трансформеры HuBERT и текстового энкодера генератора) — там основное
+время CPU. Свёртки декодера по умолчанию остаются fp32: ConvInteger на CPU часто не быстрее,
+а качество звука падает заметнее (--quantize-conv включает и их).
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pitch
+import rvc_index
+import rvc_onnx
+
+GENERATOR_INPUTS = ["phone", "phone_lengths", "pitch", "pitchf", "ds", "rnd"]
+QUANTIZED_OPS = ["MatMul", "Gather"]
+
+# Пороги parity: сквозной LSD относительно torch, дБ (--max-lsd-fp32/--max-lsd-int8)
+MAX_LSD_FP32 = 0.5
+MAX_LSD_INT8 = 3.0
+
+
+# ==================== TORCH-МОДЕЛИ ====================
+
+def import_synthesizer(rvc_root: str = ""):
+    """SynthesizerTrnMsNSFsidM — вариант генератора RVC для экспорта (входы как у ONNX-графа)"""
+    if rvc_root:
+        sys.path.insert(0, rvc_root)
+    for module in ("rvc_python.lib.infer_pack.models_onnx", "infer.lib.infer_pack.models_onnx",
+                   "lib.infer_pack.models_onnx"):
+        try:
+            return importlib.import_module(module).SynthesizerTrnMsNSFsidM
+        except ImportError:
+            continue
+    raise SystemExit("Не найден models_onnx из RVC: установите rvc-python или укажите --rvc-root")
+
+
+def load_checkpoint(model_name: str, weights_dir: str) -> dict:
+    import torch
+
+    cpt = torch.load(os.path.join(weights_dir, f"{model_name}.pth"), map_location="cpu", weights_only=False)
+    # Как в RVC: число спикеров берётся из весов, а не из конфига
+    cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]
+    return cpt
+
+
+def build_generator(cpt: dict, rvc_root: str = ""):
+    synthesizer = import_synthesizer(rvc_root)
+    net_g = synthesizer(*cpt["config"], is_half=False, version=cpt.get("version", "v1"))
+    net_g.load_state_dict(cpt["weight"], strict=False)
+    return net_g.float().eval()
+
+
+def build_content_encoder(hubert_path: str, version: str):
+    """HuBERT/ContentVec: v1 — 9-й слой + final_proj (256), v2 — 12-й слой (768)"""
+    import torch
+    from fairseq import checkpoint_utils
+
+    models, _, _ = checkpoint_utils.load_model_ensemble_and_task([hubert_path], suffix="")
+    hubert = models[0].float().eval()
+
+    class ContentEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.hubert = hubert
+            self.output_layer = 9 if version == "v1" else 12
+
+        def forward(self, source):
+            padding_mask = torch.zeros(source.shape, dtype=torch.bool)
+            feats = self.hubert.extract_features(
+                source=source, padding_mask=padding_mask, output_layer=self.output_layer
+            )[0]
+            return self.hubert.final_proj(feats) if version == "v1" else feats
+
+    return ContentEncoder().eval()
+
+
+class TorchVoiceConverter:
+    """Эталонный путь на torch с теми же входами, что у ONNX (для паритета и бенчмарка)"""
+
+    def __init__(self, model_name: str, args):
+        cpt = load_checkpoint(model_name, args.weights_dir)
+        self.version = cpt.get("version", "v1")
+        self.tgt_sr = cpt["config"][-1]
+        self.generator = build_generator(cpt, args.rvc_root)
+        self.encoder = build_content_encoder(args.hubert, self.version)
+
+    def content_features(self, audio: np.ndarray) -> np.ndarray:
+        import torch
+
+        with torch.no_grad():
+            return self.encoder(torch.from_numpy(audio.astype(np.float32))[None]).numpy()[0]
+
+    def generate(self, inputs: rvc_onnx.RvcInputs) -> np.ndarray:
+        import torch
+
+        feed = {name: torch.from_numpy(value) for name, value in inputs.feed().items()}
+        with torch.no_grad():
+            audio = self.generator(*(feed[name] for name in GENERATOR_INPUTS))
+        return audio.numpy().reshape(-1)
+
+
+# ==================== ЭКСПОРТ ====================
+
+def quantize(fp32_path: str, int8_path: str, op_types: list):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, op_types_to_quantize=op_types)
+
+
+def export_content_encoder(args, version: str) -> str:
+    import torch
+
+    name = f"contentvec_{version}"
+    fp32_path = os.path.join(args.output_dir, f"{name}.fp32.onnx")
+    if os.path.exists(fp32_path) and not args.force:
+        return name
+    encoder = build_content_encoder(args.hubert, version)
+    torch.onnx.export(
+        encoder, (torch.randn(1, 16000),), fp32_path,
+        input_names=["source"], output_names=["feats"],
+        dynamic_axes={"source": {1: "samples"}, "feats": {1: "frames"}},
+        opset_version=17, do_constant_folding=True,
+    )
+    quantize(fp32_path, os.path.join(args.output_dir, f"{name}.int8.onnx"), QUANTIZED_OPS)
+    print(f"✓ Кодировщик содержания {name}")
+    return name
+
+
+def export_model(model_name: str, args):
+    import torch
+
+    cpt = load_checkpoint(model_name, args.weights_dir)
+    version = cpt.get("version", "v1")
+    if not cpt.get("f0", 1):
+        raise SystemExit(f"{model_name}: модели без f0 ONNX-бэкендом не поддерживаются")
+    net_g = build_generator(cpt, args.rvc_root)
+
+    channels = 256 if version == "v1" else 768
+    frames = 200
+    dummy = (
+        torch.rand(1, frames, channels),
+        torch.tensor([frames]).long(),
+        torch.randint(size=(1, frames), low=5, high=255),
+        torch.rand(1, frames),
+        torch.LongTensor([0]),
+        torch.rand(1, 192, frames),
+    )
+    fp32_path = os.path.join(args.output_dir, f"{model_name}.fp32.onnx")
+    # Параметры экспорта — как в infer/modules/onnx/export.py RVC
+    torch.onnx.export(
+        net_g, dummy, fp32_path,
+        input_names=GENERATOR_INPUTS, output_names=["audio"],
+        dynamic_axes={"phone": [1], "pitch": [1], "pitchf": [1], "rnd": [2]},
+        opset_version=13, do_constant_folding=False,
+    )
+    op_types = QUANTIZED_OPS + (["Conv"] if args.quantize_conv else [])
+    quantize(fp32_path, os.path.join(args.output_dir, f"{model_name}.int8.onnx"), op_types)
+
+    meta = {
+        "model": model_name,
+        "version": version,
+        "tgt_sr": cpt["config"][-1],
+        "f0": cpt.get("f0", 1),
+        "content_encoder": export_content_encoder(args, version),
+        "has_index": os.path.exists(rvc_index.index_paths(model_name)["source"]),
+    }
+    with open(os.path.join(args.output_dir, f"{model_name}.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    sizes = {p: os.path.getsize(os.path.join(args.output_dir, f"{model_name}.{p}.onnx")) / 2**20
+             for p in ("fp32", "int8")}
+    print(f"✓ {model_name} ({version}, {meta['tgt_sr']} Гц): {sizes['fp32']:.1f} МБ -> int8 {sizes['int8']:.1f} МБ")
+
+
+# ==================== ПАРИТЕТ И БЕНЧМАРК ====================
+
+def snr_db(reference: np.ndarray, estimate: np.ndarray) -> float:
+    n = min(len(reference), len(estimate))
+    noise = reference[:n] - estimate[:n]
+    return float(10 * np.log10(np.sum(reference[:n] ** 2) / max(np.sum(noise ** 2), 1e-12)))
+
+
+def log_spectral_distance(reference: np.ndarray, estimate: np.ndarray, n_fft: int = 1024, hop: int = 256) -> float:
+    """Среднее по кадрам RMS-расхождение лог-спектров, дБ (нечувствительно к фазе)"""
+    n = min(len(reference), len(estimate))
+    window = np.hanning(n_fft)
+
+    def spectrum(x):
+        frames = np.lib.stride_tricks.sliding_window_view(x[:n], n_fft)[::hop]
+        return 20 * np.log10(np.abs(np.fft.rfft(frames * window, axis=1)) + 1e-5)
+
+    diff = spectrum(reference) - spectrum(estimate)
+    return float(np.mean(np.sqrt(np.mean(diff ** 2, axis=1))))
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    n = min(len(a), len(b))
+    a, b = a[:n], b[:n]
+    return float(np.mean(np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-12)))
+
+
+def run_pipeline(converter, audio: np.ndarray, retriever, args) -> np.ndarray:
+    inputs = rvc_onnx.prepare_inputs(converter.content_features(audio), audio, retriever,
+                                     f0_method=args.f0_method, index_rate=args.index_rate)
+    return converter.generate(inputs)
+
+
+def parity(model_name: str, args) -> bool:
+    audio = pitch.load_audio(args.wav)
+    reference = TorchVoiceConverter(model_name, args)
+    retriever = rvc_index.get_retriever(model_name)
+    torch_feats = reference.content_features(audio)
+    # Одинаковые входы генератора — сравнивается только сам граф
+    inputs = rvc_onnx.prepare_inputs(torch_feats, audio, retriever, f0_method=args.f0_method,
+                                     index_rate=args.index_rate)
+    torch_audio = reference.generate(inputs)
+    torch_e2e = run_pipeline(reference, audio, retriever, args)
+
+    ok = True
+    for precision, max_lsd in (("fp32", args.max_lsd_fp32), ("int8", args.max_lsd_int8)):
+        converter = rvc_onnx.OnnxVoiceConverter(model_name, precision, args.output_dir)
+        feats_cos = cosine(torch_feats, converter.content_features(audio))
+        graph_audio = converter.generate(inputs)
+        e2e_audio = run_pipeline(converter, audio, retriever, args)
+        lsd = log_spectral_distance(torch_e2e, e2e_audio)
+        passed = lsd <= max_lsd
+        ok &= passed
+        print(f"{model_name} {precision}: признаки cos {feats_cos:.4f} | генератор SNR {snr_db(torch_audio, graph_audio):5.1f} дБ"
+              f" | звук LSD {lsd:.2f} дБ (порог {max_lsd}) {'✓' if passed else '✗'}")
+    return ok
+
+
+def bench(model_name: str, args):
+    audio = pitch.load_audio(args.wav)
+    duration = len(audio) / pitch.F0_SAMPLE_RATE
+    retriever = rvc_index.get_retriever(model_name)
+
+    def measure(converter) -> float:
+        run_pipeline(converter, audio, retriever, args)  # прогрев
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            run_pipeline(converter, audio, retriever, args)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times)) / duration
+
+    results = {"torch fp32": measure(TorchVoiceConverter(model_name, args))}
+    for precision in ("fp32", "int8"):
+        results[f"onnx {precision}"] = measure(rvc_onnx.OnnxVoiceConverter(model_name, precision, args.output_dir))
+
+    print(f"{model_name}, {duration:.1f} с аудио:")
+    for name, rtf in results.items():
+        print(f"  {name:<11} RTF {rtf:.3f}  x{results['torch fp32'] / rtf:.2f}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "parity", "bench"])
+    parser.add_argument("models", nargs="+")
+    parser.add_argument("--hubert", default="hubert_base.pt")
+    parser.add_argument("--weights-dir", default="weights")
+    parser.add_argument("--rvc-root", default="", help="каталог RvcWebUI, если rvc-python не установлен")
+    parser.add_argument("--output-dir", default=rvc_onnx.RVC_ONNX_DIR)
+    parser.add_argument("--force", action="store_true", help="переэкспортировать кодировщик содержания")
+    parser.add_argument("--quantize-conv", action="store_true")
+    parser.add_argument("--wav", default="", help="реплика TTS для parity/bench")
+    parser.add_argument("--f0-method", default="yin")
+    parser.add_argument("--index-rate", type=float, default=0.85)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-lsd-fp32", type=float, default=MAX_LSD_FP32)
+    parser.add_argument("--max-lsd-int8", type=float, default=MAX_LSD_INT8)
+    return parser
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.command != "export" and not args.wav:
+        parser.error("для parity/bench нужен --wav")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.command == "export":
+        for model in args.models:
+            export_model(model, args)
+    elif args.command == "parity":
+        results = [parity(model, args) for model in args.models]
+        sys.exit(0 if all(results) else 1)
+    else:
+        for model in args.models:
+            bench(model, args)
+
+
+if __name__ == "__main__":
+    main()
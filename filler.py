@@ -0,0 +1,126 @@
+"""
+Короткие реплики-«заполнители» голосом персонажа ("Хм...", "Сейчас подумаю!", хихиканье Шапокляк),
+которые сервер отдаёт сразу после распознавания речи, пока LLM/TTS/RVC готовят ответ.
+
+Фразы берутся из реестра персонажей (characters.json). Клипы один раз синтезируются тем же
+голосовым конвейером при старте (один воркер), хранятся в общем состоянии под ключом из голоса
+и текста фразы и держатся в памяти каждого воркера: после правки фраз или голоса персонажа
+пересинтезируются только его клипы, а клипы прежнего голоса истекают по clip_ttl. Для одного устройства клипы идут по кругу,
+чтобы не повторяться подряд.
+"""
+
+import base64
+import hashlib
+import io
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger("filler")
+
+@dataclass
+class FillerClip:
+    text: str
+    audio_b64: str
+    duration: float
+
+
+def mp3_duration(audio_b64: str) -> float:
+    from pydub import AudioSegment
+
+    return AudioSegment.from_file(io.BytesIO(base64.b64decode(audio_b64)), format="mp3").duration_seconds
+
+
+class FillerBank:
+    def __init__(self, shared, phrases: dict, voices: dict = None, session_ttl: float = 6 * 3600,
+                 clip_ttl: float = 7 * 86400):
+        """
+        phrases — {персонаж: [фразы]}, voices — {персонаж: отпечаток голоса} для ключей клипов.
+        clip_ttl — срок клипа в общем состоянии; build продлевает действующие клипы
+        """
+        self.shared = shared
+        self.phrases = phrases
+        self.voices = voices or {}
+        self.session_ttl = session_ttl
+        self.clip_ttl = clip_ttl
+        self._clips = {}  # character -> [FillerClip]
+        self.emitted = 0
+        self.masked_total = 0.0
+        self.wait_total = 0.0
+
+    def _key(self, character: str, text: str) -> str:
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:10]
+        return f"filler:{character}:{self.voices.get(character, '')}:{digest}"
+
+    def update(self, phrases: dict, voices: dict, changed: set):
+        """Новые фразы и голоса; клипы изменившихся персонажей сбрасываются до следующего build"""
+        self.phrases = phrases
+        self.voices = voices
+        for character in changed:
+            self._clips.pop(character, None)
+
+    async def build(self, synthesize: Callable[[str, str], Awaitable[str]], owner: bool, only: set = None):
+        """
+        owner — этот воркер синтезирует недостающие клипы (взят замок),
+        остальные только подгружают готовые из общего состояния. only — только эти персонажи.
+        """
+        for character, phrases in list(self.phrases.items()):
+            if only is not None and character not in only:
+                continue
+            for index, text in enumerate(phrases):
+                key = self._key(character, text)
+                stored = await self.shared.get(key)
+                if stored is None and owner:
+                    try:
+                        audio_b64 = await synthesize(character, text)
+                        stored = {"text": text, "audio_b64": audio_b64, "duration": mp3_duration(audio_b64)}
+                        await self.shared.set(key, stored, self.clip_ttl)
+                        log.info("Заполнитель %s: %s (%.1f сек)", character, text, stored["duration"])
+                    except Exception as e:
+                        log.warning("Не удалось синтезировать заполнитель %s '%s': %s", character, text, e)
+                elif stored is not None and owner:
+                    # Клипы текущего голоса продлеваем, прежних ревизий — истекают сами
+                    await self.shared.set(key, stored, self.clip_ttl)
+                if stored is not None:
+                    self._add(character, index, FillerClip(**stored))
+
+    def _add(self, character: str, index: int, clip: FillerClip):
+        clips = self._clips.setdefault(character, [None] * len(self.phrases.get(character, [])))
+        if index < len(clips):  # фразы могли смениться, пока шёл build
+            clips[index] = clip
+
+    async def _load(self, character: str) -> list:
+        """Клипы, собранные другим воркером после нашего старта"""
+        for index, text in enumerate(self.phrases.get(character, [])):
+            stored = await self.shared.get(self._key(character, text))
+            if stored is not None:
+                self._add(character, index, FillerClip(**stored))
+        return [clip for clip in self._clips.get(character, []) if clip is not None]
+
+    async def pick(self, character: str, device_id: str) -> Optional[FillerClip]:
+        clips = [clip for clip in self._clips.get(character, []) if clip is not None]
+        if len(clips) < len(self.phrases.get(character, [])):
+            clips = await self._load(character)
+        if not clips:
+            return None
+        # Счётчик ходов устройства в общем состоянии — клипы по кругу на любом воркере,
+        # стартовая позиция своя у каждого устройства
+        turn = await self.shared.incr(f"filler_turn:{device_id}", self.session_ttl) if device_id else 0
+        offset = int(hashlib.md5(device_id.encode("utf-8")).hexdigest()[:4], 16) if device_id else 0
+        self.emitted += 1
+        return clips[(offset + turn) % len(clips)]
+
+    def record_wait(self, clip: FillerClip, wait: float) -> float:
+        """Сколько ожидания закрыл клип: пока он звучит, тишины нет"""
+        masked = min(clip.duration, wait)
+        self.masked_total += masked
+        self.wait_total += wait
+        return masked
+
+    def snapshot(self) -> dict:
+        return {
+            "clips": {character: sum(1 for c in clips if c) for character, clips in self._clips.items()},
+            "emitted": self.emitted,
+            "masked_seconds": round(self.masked_total, 1),
+            "masked_share": round(self.masked_total / self.wait_total, 3) if self.wait_total else None,
+        }
@@ -0,0 +1,28 @@
+"""
+Production-запуск на Linux:
+    RUN_MODE=production SHARED_STATE_URL=redis://localhost:6379/0 \
+    RVC_URLS=http://rvc-1:7897,http://rvc-2:7897 gunicorn server:app -c gunicorn.conf.py
+
+Воркеры не делят память: история и кеш ответов — в Redis, RVC — отдельные инстансы.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Длинные чат-запросы (STT -> LLM -> TTS -> RVC) не должны убиваться раньше таймаутов внешних сервисов
+timeout = 180
+graceful_timeout = 30
+keepalive = 5
+# Перезапуск воркеров ограничивает рост памяти (torch, PIL) при долгой работе
+max_requests = 2000
+max_requests_jitter = 200
+
+# server.py читает число воркеров из окружения, чтобы делить лимиты частоты
+os.environ.setdefault("WEB_CONCURRENCY", str(workers))
+os.environ.setdefault("RUN_MODE", "production")
+
+certfile = os.environ.get("SSL_CERTFILE") or None
+keyfile = os.environ.get("SSL_KEYFILE") or None
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Локальная проверка многопроцессного режима: заглушки внешних сервисов + N воркеров сервера,
+нагрузка на /api/chat-stream и замер пропускной способности.
+
+Пример:
+    python local_cluster.py                                   # один воркер, без Redis
+    python local_cluster.py --workers 1 2 4 --requests 200 --concurrency 32
+    python local_cluster.py --workers 4 --state redis://localhost:6379/0
+
+Требуется ffmpeg. Несколько воркеров без общего состояния сервер не запускает: без --state
+поднимается временный redis-server на REDIS_PORT (нужен в PATH).
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from serialization import loads
+
+MOCK_PORT = 9000
+SERVER_PORT = 8800
+REDIS_PORT = 6390
+
+
+def make_test_webm(path: str):
+    """Двухсекундная «реплика» в webm/opus, как из MediaRecorder"""
+    subprocess.run(
+        ["ffmpeg", "-y", "-f", "lavfi", "-i", "sine=frequency=300:duration=2",
+         "-acodec", "libopus", "-ac", "1", path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
+
+
+def wait_for(url: str, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} не поднялся за {timeout} сек")
+
+
+def start_mocks() -> subprocess.Popen:
+    env = dict(os.environ, MOCK_PORT=str(MOCK_PORT))
+    proc = subprocess.Popen([sys.executable, "mock_backends.py"], env=env)
+    wait_for(f"http://127.0.0.1:{MOCK_PORT}/docs")
+    return proc
+
+
+def start_redis() -> subprocess.Popen:
+    """Временный Redis без сохранения на диск"""
+    proc = subprocess.Popen(["redis-server", "--port", str(REDIS_PORT), "--save", "", "--appendonly", "no"],
+                            stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", REDIS_PORT), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"redis-server не поднялся на порту {REDIS_PORT}")
+
+
+def start_server(workers: int, state_url: str) -> subprocess.Popen:
+    mock = f"http://127.0.0.1:{MOCK_PORT}"
+    env = dict(
+        os.environ,
+        RUN_MODE="production",
+        WEB_CONCURRENCY=str(workers),
+        PORT=str(SERVER_PORT),
+        SSL_KEYFILE="",
+        SSL_CERTFILE="",
+        SHARED_STATE_URL=state_url,
+        YANDEX_STT_URL=f"{mock}/stt",
+        YANDEX_LLM_URL=f"{mock}/llm",
+        YANDEX_TTS_URL=f"{mock}/tts",
+        OPENROUTER_URL=f"{mock}/openrouter",
+        RVC_URLS=f"{mock}/rvc",
+    )
+    proc = subprocess.Popen([sys.executable, "server.py"], env=env)
+    wait_for(f"http://127.0.0.1:{SERVER_PORT}/api/metrics")
+    return proc
+
+
+async def one_turn(client: httpx.AsyncClient, audio: bytes, device_id: str) -> bool:
+    files = {"audio": ("voice.webm", audio, "audio/webm")}
+    data = {"character": "cheb", "device_id": device_id}
+    async with client.stream("POST", f"http://127.0.0.1:{SERVER_PORT}/api/chat-stream",
+                             files=files, data=data) as response:
+        if response.status_code != 200:
+            return False
+        async for line in response.aiter_lines():
+            if line and loads(line).get("type") == "final":
+                return True
+    return False
+
+
+async def load_test(audio: bytes, total: int, concurrency: int) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    ok = 0
+
+    async def worker(i: int):
+        nonlocal ok
+        async with semaphore:
+            # Новое устройство на каждый запрос — нагрузку не режут лимиты частоты
+            if await one_turn(client, audio, f"load-{i}-{uuid.uuid4().hex[:6]}"):
+                ok += 1
+
+    async with httpx.AsyncClient(timeout=120) as client:
+        started = time.time()
+        await asyncio.gather(*(worker(i) for i in range(total)))
+        elapsed = time.time() - started
+    return ok, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--state", default="",
+                        help="SHARED_STATE_URL, например redis://localhost:6379/0; без него для нескольких "
+                             "воркеров поднимается временный redis-server")
+    args = parser.parse_args()
+    start_local_redis = max(args.workers) > 1 and not args.state
+    if start_local_redis and not shutil.which("redis-server"):
+        parser.error("для нескольких воркеров нужен --state redis://... или redis-server в PATH")
+
+    webm_path = os.path.join(tempfile.mkdtemp(), "voice.webm")
+    make_test_webm(webm_path)
+    with open(webm_path, "rb") as f:
+        audio = f.read()
+
+    redis_proc = None
+    if start_local_redis:
+        redis_proc = start_redis()
+        args.state = f"redis://127.0.0.1:{REDIS_PORT}/0"
+    mocks = start_mocks()
+    results = []
+    try:
+        for workers in args.workers:
+            server = start_server(workers, args.state)
+            try:
+                ok, elapsed = asyncio.run(load_test(audio, args.requests, args.concurrency))
+                results.append((workers, ok, elapsed))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        mocks.terminate()
+        mocks.wait()
+        if redis_proc is not None:
+            redis_proc.terminate()
+            redis_proc.wait()
+
+    print("\n" + "=" * 60)
+    print(f"{'воркеры':>8} {'успешно':>8} {'время, с':>10} {'req/s':>8} {'масштаб':>8}")
+    base = None
+    for workers, ok, elapsed in results:
+        rps = ok / elapsed if elapsed else 0
+        base = base or rps
+        print(f"{workers:>8} {ok:>8} {elapsed:>10.1f} {rps:>8.2f} {rps / base if base else 0:>7.2f}x")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Структурированные логи, не блокирующие event loop.
+
+- логгер в потоке запроса только кладёт запись в очередь; форматирование и запись в консоль
+  (на Windows-консоли она заметно тормозит) делает фоновый поток QueueListener;
+- записи — JSON-строки с request_id, персонажем и полями из extra (LOG_FORMAT=text — читаемый вид);
+- аргументы форматируются лениво (log.info("... %s", x)), выключенный уровень ничего не стоит;
+- подробные строки по этапам пишутся только для доли запросов LOG_SAMPLE_RATE,
+  а итоговая строка с таймингами всех этапов — для каждого запроса.
+
+Использование:
+    log = get_logger(__name__)
+    begin_request(character=character, device_id=device_id)
+    record_stage("tts", 0.84)
+    log.info("ответ готов", extra={"timings": stage_timings()})
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import traceback
+import uuid
+
+import profiling
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json | text
+# Доля запросов, для которых пишутся подробные строки по этапам (1.0 — все)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.1"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# Поля текущего запроса: request_id, character, device_id, ...; служебные — sampled и timings
+_context = contextvars.ContextVar("log_context", default={})
+_PRIVATE_FIELDS = ("sampled", "timings")
+
+# Атрибуты LogRecord, которые не являются пользовательскими полями из extra
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "ctx"}
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+# ---------- контекст запроса ----------
+
+def begin_request(request_id: str = None, **fields) -> str:
+    """
+    Открывает контекст запроса в текущей задаче asyncio. Задачи, запущенные из неё (spawn),
+    наследуют request_id, поэтому фоновая работа по запросу попадает в тот же след.
+    """
+    request_id = request_id or uuid.uuid4().hex[:12]
+    _context.set({
+        "request_id": request_id,
+        **fields,
+        "sampled": random.random() < LOG_SAMPLE_RATE,
+        "timings": {},
+    })
+    return request_id
+
+
+def bind(**fields):
+    """Добавляет поля к контексту текущего запроса (например, персонажа после разбора формы)"""
+    _context.set({**_context.get(), **fields})
+
+
+def is_verbose() -> bool:
+    """Попал ли запрос в выборку подробных логов"""
+    return _context.get().get("sampled", True)
+
+
+def record_stage(stage: str, seconds: float, **fields):
+    """
+    Тайминг этапа: копится для итоговой строки, подробная строка — только для выборки.
+    Если запрос профилируется, этап попадает в его след span'ом.
+    """
+    profiling.add_span(stage, seconds, fields)
+    ctx = _context.get()
+    timings = ctx.get("timings")
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 3)
+    if ctx.get("sampled", True):
+        _stage_log.info("%s: %.2f сек", stage, seconds,
+                        extra={"stage": stage, "duration": round(seconds, 3), **fields})
+
+
+def stage_timings() -> dict:
+    return dict(_context.get().get("timings") or {})
+
+
+class StageTimer:
+    """with StageTimer("stt"): ... — то же, что record_stage по прошедшему времени"""
+
+    def __init__(self, stage: str, **fields):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.stage, time.perf_counter() - self.started, **self.fields)
+        return False
+
+
+# ---------- очередь и фоновая запись ----------
+
+class _SamplingFilter(logging.Filter):
+    """Записи с extra={"verbose": True} проходят только для запросов из выборки"""
+
+    def filter(self, record):
+        if getattr(record, "verbose", False) and record.levelno < logging.WARNING:
+            return _context.get().get("sampled", True)
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    В отличие от стандартного QueueHandler, сообщение здесь не форматируется:
+    msg % args собирается в фоновом потоке. Сразу снимается только контекст запроса
+    (contextvars видны лишь в задаче-источнике) и текст исключения.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        ctx = _context.get()
+        record.ctx = {k: v for k, v in ctx.items() if k not in _PRIVATE_FIELDS}
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Консоль не успевает — теряем запись, но не тормозим запрос
+            self.dropped += 1
+
+
+def _extra_fields(record) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS and k != "verbose"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "ctx", {}),
+            **_extra_fields(record),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        ctx = getattr(record, "ctx", {})
+        prefix = f"[{ctx['request_id']}] " if "request_id" in ctx else ""
+        fields = " ".join(f"{k}={v}" for k, v in _extra_fields(record).items())
+        line = (f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} "
+                f"{prefix}{record.getMessage()}{'  ' + fields if fields else ''}")
+        if record.exc_text:
+            line += "\n" + record.exc_text.rstrip()
+        return line
+
+
+_handler = None
+_listener = None
+_stage_log = logging.getLogger("stage")
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Подключает очередь к корневому логгеру. Повторный вызов ничего не делает."""
+    global _handler, _listener
+    if _handler is not None:
+        return
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _handler = _QueueHandler(log_queue)
+    _handler.addFilter(_SamplingFilter())
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, console)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+
+def snapshot() -> dict:
+    if _handler is None:
+        return {}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped, "sample_rate": LOG_SAMPLE_RATE}
@@ -0,0 +1,133 @@
+"""
+Локальные заглушки внешних сервисов (Yandex STT/LLM/TTS, OpenRouter, RvcWebUI) для проверки
+таймаутов, хеджирования и предохранителей без платных вызовов.
+
+Запуск:
+    python mock_backends.py            # http://localhost:9000
+
+Сервер направляется на заглушки через окружение:
+    YANDEX_STT_URL=http://localhost:9000/stt
+    YANDEX_LLM_URL=http://localhost:9000/llm
+    YANDEX_TTS_URL=http://localhost:9000/tts
+    OPENROUTER_URL=http://localhost:9000/openrouter
+    RVC_URL=http://localhost:9000/rvc
+
+Сбой имитируется на лету:
+    curl -X POST localhost:9000/mock/config -H "Content-Type: application/json" \\
+         -d '{"backend": "rvc", "delay": 40, "error_rate": 0.5}'
+"""
+
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+app = FastAPI(title="Mock upstream backends")
+
+# Задержка (сек), доля ошибок 500 и доля «зависших» ответов для каждого бэкенда
+MOCK_CONFIG = {
+    name: {"delay": float(os.environ.get("MOCK_DELAY", "0.2")), "error_rate": 0.0, "hang_rate": 0.0}
+    for name in ("stt", "llm", "tts", "openrouter", "rvc")
+}
+
+MOCK_DIR = tempfile.mkdtemp(prefix="mock_backends_")
+MOCK_OGG = os.path.join(MOCK_DIR, "tone.ogg")
+
+
+def make_tone_ogg():
+    """Короткий тон в OGG Opus вместо синтезированной речи"""
+    subprocess.run(
+        ["ffmpeg", "-y", "-f", "lavfi", "-i", "sine=frequency=220:duration=1.5",
+         "-acodec", "libopus", "-ar", "48000", "-ac", "1", MOCK_OGG],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+    )
+
+
+async def simulate(backend: str):
+    """Задержка/ошибка по текущей конфигурации; возвращает ответ-ошибку или None"""
+    cfg = MOCK_CONFIG[backend]
+    if random.random() < cfg["hang_rate"]:
+        await asyncio.sleep(600)
+    await asyncio.sleep(cfg["delay"] * random.uniform(0.8, 1.2))
+    if random.random() < cfg["error_rate"]:
+        return JSONResponse({"error": f"mock {backend} failure"}, status_code=500)
+    return None
+
+
+@app.post("/mock/config")
+async def mock_config(request: Request):
+    body = await request.json()
+    cfg = MOCK_CONFIG[body["backend"]]
+    for key in ("delay", "error_rate", "hang_rate"):
+        if key in body:
+            cfg[key] = float(body[key])
+    return MOCK_CONFIG
+
+
+@app.post("/stt")
+async def mock_stt(request: Request):
+    await request.body()
+    return await simulate("stt") or {"result": "привет как тебя зовут"}
+
+
+@app.post("/llm")
+async def mock_llm(request: Request):
+    body = await request.json()
+    user_text = body["messages"][-1]["text"]
+    prompt_chars = sum(len(m["text"]) for m in body["messages"])
+    return await simulate("llm") or {
+        "result": {
+            "alternatives": [{"message": {"role": "assistant", "text": f"Ты сказал: {user_text}"}}],
+            "usage": {"inputTextTokens": str(prompt_chars // 3 + 4 * len(body["messages"]))},
+        }
+    }
+
+
+@app.post("/tts")
+async def mock_tts(request: Request):
+    await request.body()
+    error = await simulate("tts")
+    if error:
+        return error
+    with open(MOCK_OGG, "rb") as f:
+        return Response(content=f.read(), media_type="audio/ogg")
+
+
+@app.post("/openrouter")
+async def mock_openrouter(request: Request):
+    body = await request.json()
+    error = await simulate("openrouter")
+    if error:
+        return error
+    # Возвращаем исходную картинку в формате ответа Nano Banana
+    image_url = body["messages"][0]["content"][0]["image_url"]["url"]
+    return {"choices": [{"message": {"role": "assistant", "images": [{"image_url": {"url": image_url}}]}}]}
+
+
+@app.post("/rvc/run/infer_set")
+async def mock_rvc_set(request: Request):
+    await request.json()
+    return await simulate("rvc") or {"data": [{"visible": True}, 0.33, 0.33]}
+
+
+@app.post("/rvc/run/infer_convert")
+async def mock_rvc_convert(request: Request):
+    body = await request.json()
+    error = await simulate("rvc")
+    if error:
+        return error
+    # «Переозвучка» — копия входного файла, как RvcWebUI отдаёт путь к результату
+    out_path = os.path.join(MOCK_DIR, f"rvc_{random.randrange(1 << 30)}.wav")
+    shutil.copy(body["data"][1], out_path)
+    return {"data": ["Success", {"name": out_path}]}
+
+
+if __name__ == "__main__":
+    make_tone_ogg()
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("MOCK_PORT", "9000")))
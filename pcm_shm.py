@@ -0,0 +1,269 @@
+"""
+PCM между веб-сервером и процессами переозвучки через общую память (multiprocessing.shared_memory).
+
+Вместо tts.wav/rvc_out.wav на диске и pickle массивов по пайпам процессы передают друг другу
+только имя сегмента и число отсчётов; сами отсчёты (float32, моно) лежат в общей памяти,
+и каждая сторона работает с ними как с numpy-массивом без копирования.
+
+- PcmArena — кольцо слотов фиксированного размера (PCM_SLOTS по PCM_SLOT_SECONDS секунд при
+  PCM_SLOT_RATE Гц), сегменты создаются при первом использовании и дальше переиспользуются:
+  под нагрузкой нет ни создания/удаления сегментов, ни роста памяти. Реплика длиннее слота
+  или запрос при занятых слотах получает отдельный сегмент (oversize/overflow в snapshot),
+  который удаляется при освобождении, — конвейер не ждёт;
+- PcmLease — слот у одного владельца; отпускается release() или выходом из with.
+  Утечки видны: забытый lease возвращается в кольцо сборщиком мусора и считается (leaked),
+  занятый дольше PCM_LEASE_TIMEOUT попадает в stuck, при close() перечисляются неосвобождённые;
+- сегменты регистрируются в resource_tracker веб-сервера (воркеры, запущенные им, делят тот же
+  трекер), поэтому при падении процесса их удаляет трекер; если убит и он (kill -9 группы),
+  сегменты удаляет sweep_stale() при следующем старте — в имени сегмента pid создателя;
+- attach()/open_array() — сторона воркера: сегменты слотов открываются один раз на процесс.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+PCM_SLOTS = int(os.environ.get("PCM_SLOTS", "8"))
+PCM_SLOT_SECONDS = float(os.environ.get("PCM_SLOT_SECONDS", "20"))
+PCM_SLOT_RATE = int(os.environ.get("PCM_SLOT_RATE", "48000"))
+PCM_LEASE_TIMEOUT = float(os.environ.get("PCM_LEASE_TIMEOUT", "120"))
+PCM_PREFIX = "pcm"
+SHM_DIR = "/dev/shm"
+
+SAMPLE_BYTES = np.dtype(np.float32).itemsize
+
+log = logging.getLogger("pcm_shm")
+
+
+def _close(shm: shared_memory.SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # На буфер ещё смотрит numpy-массив; отображение закроется вместе с ним
+        pass
+
+
+def _unlink(shm: shared_memory.SharedMemory):
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep_stale(shm_dir: str = SHM_DIR) -> int:
+    """Удаляет сегменты арен процессов, которых уже нет (после падения или kill -9)"""
+    if not os.path.isdir(shm_dir):
+        return 0
+    removed = 0
+    for name in os.listdir(shm_dir):
+        parts = name.split("_")
+        if len(parts) != 3 or parts[0] != PCM_PREFIX or not parts[1].isdigit():
+            continue
+        if _pid_alive(int(parts[1])):
+            continue
+        try:
+            os.remove(os.path.join(shm_dir, name))
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        log.warning("Удалено %s сегментов PCM от завершившихся процессов", removed)
+    return removed
+
+
+class PcmLease:
+    """Слот арены у одного владельца: имя сегмента, число записанных отсчётов и частота"""
+
+    def __init__(self, arena: "PcmArena", shm: shared_memory.SharedMemory, slot, owner: str):
+        self.name = shm.name
+        self.slot = slot
+        self.owner = owner
+        self.capacity = shm.size // SAMPLE_BYTES
+        self.frames = 0
+        self.sample_rate = 0
+        self.acquired = time.monotonic()
+        self._shm = shm
+        self._arena = arena
+        self._busy = None
+        # Аргументы финализатора не должны ссылаться на сам lease
+        self._finalizer = weakref.finalize(self, arena._reclaim, shm, slot, owner, self.acquired)
+
+    def array(self, frames: int = None) -> np.ndarray:
+        """Вид на общую память без копирования (по умолчанию — записанные отсчёты)"""
+        frames = self.frames if frames is None else frames
+        return np.ndarray((frames,), dtype=np.float32, buffer=self._shm.buf)
+
+    def write(self, samples, sample_rate: int):
+        """Записывает отсчёты (numpy-массив или байты f32le) в начало слота"""
+        samples = np.frombuffer(samples, dtype=np.float32) if isinstance(samples, (bytes, bytearray)) else samples
+        if len(samples) > self.capacity:
+            raise ValueError(f"{len(samples)} отсчётов не помещаются в слот на {self.capacity}")
+        self.array(len(samples))[:] = samples
+        self.frames = len(samples)
+        self.sample_rate = sample_rate
+
+    def buffer(self) -> memoryview:
+        """Записанные отсчёты как байты f32le — например, для stdin ffmpeg"""
+        return self._shm.buf[:self.frames * SAMPLE_BYTES]
+
+    def hold_until(self, future):
+        """release() до завершения future откладывается: воркер ещё читает или пишет слот"""
+        self._busy = future
+
+    def release(self):
+        busy, self._busy = self._busy, None
+        if busy is not None and not busy.done():
+            busy.add_done_callback(lambda _: self.release())
+            return
+        if self._finalizer.detach() is not None:
+            self._arena._release(self._shm, self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class PcmArena:
+    def __init__(self, slots: int = PCM_SLOTS, slot_seconds: float = PCM_SLOT_SECONDS,
+                 slot_rate: int = PCM_SLOT_RATE, lease_timeout: float = PCM_LEASE_TIMEOUT):
+        self.slot_frames = int(slot_seconds * slot_rate)
+        self.lease_timeout = lease_timeout
+        self.pid = os.getpid()
+        self._segments = [None] * slots
+        self._free = list(range(slots - 1, -1, -1))
+        self._held = {}  # имя сегмента -> (владелец, время захвата)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {"acquired": 0, "oversize": 0, "overflow": 0, "leaked": 0}
+        self._reported_stuck = set()
+
+    def _create(self, suffix: str, frames: int) -> shared_memory.SharedMemory:
+        return shared_memory.SharedMemory(name=f"{PCM_PREFIX}_{self.pid}_{suffix}", create=True,
+                                          size=frames * SAMPLE_BYTES)
+
+    def acquire(self, frames: int, owner: str = "") -> PcmLease:
+        """Слот минимум на frames отсчётов; не ждёт — при нехватке выдаёт отдельный сегмент"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("PCM-арена закрыта")
+            self.stats["acquired"] += 1
+            slot = None
+            if frames > self.slot_frames:
+                self.stats["oversize"] += 1
+            elif self._free:
+                slot = self._free.pop()
+            else:
+                self.stats["overflow"] += 1
+            if slot is not None and self._segments[slot] is None:
+                self._segments[slot] = self._create(str(slot), self.slot_frames)
+            shm = self._segments[slot] if slot is not None else None
+        if shm is None:
+            shm = self._create(f"x{uuid.uuid4().hex[:12]}", frames)
+        lease = PcmLease(self, shm, slot, owner)
+        with self._lock:
+            self._held[shm.name] = (owner, lease.acquired)
+        return lease
+
+    def _release(self, shm: shared_memory.SharedMemory, slot):
+        with self._lock:
+            self._held.pop(shm.name, None)
+            self._reported_stuck.discard(shm.name)
+            if slot is not None and not self._closed:
+                self._free.append(slot)
+                return
+        if slot is None:
+            _close(shm)
+            _unlink(shm)
+
+    def _reclaim(self, shm: shared_memory.SharedMemory, slot, owner: str, acquired: float):
+        """Lease собран сборщиком мусора без release(): слот возвращается, утечка считается"""
+        with self._lock:
+            self.stats["leaked"] += 1
+        log.warning("PCM-слот %s (%s) не освобождён и собран GC через %.1f с", shm.name, owner or "?",
+                    time.monotonic() - acquired)
+        self._release(shm, slot)
+
+    def stuck(self) -> list:
+        """Слоты, занятые дольше lease_timeout, — вероятно, потерянные или зависший воркер"""
+        now = time.monotonic()
+        with self._lock:
+            held = list(self._held.items())
+        result = []
+        for name, (owner, acquired) in held:
+            age = now - acquired
+            if age > self.lease_timeout:
+                result.append({"name": name, "owner": owner, "age": round(age, 1)})
+                if name not in self._reported_stuck:
+                    self._reported_stuck.add(name)
+                    log.warning("PCM-слот %s (%s) занят уже %.0f с", name, owner or "?", age)
+        return result
+
+    def snapshot(self) -> dict:
+        stuck = self.stuck()
+        with self._lock:
+            return {
+                "slots": len(self._segments),
+                "allocated": sum(shm is not None for shm in self._segments),
+                "free": len(self._free),
+                "held": len(self._held),
+                "slot_mb": round(self.slot_frames * SAMPLE_BYTES / 1e6, 2),
+                "stuck": stuck,
+                **self.stats,
+            }
+
+    def close(self):
+        """Удаляет сегменты арены (при остановке процесса); неосвобождённые слоты — в лог"""
+        with self._lock:
+            self._closed = True
+            held = dict(self._held)
+            segments, self._segments = self._segments, [None] * len(self._segments)
+        for name, (owner, acquired) in held.items():
+            log.warning("PCM-слот %s (%s) не освобождён к остановке (%.1f с)", name, owner or "?",
+                        time.monotonic() - acquired)
+        for shm in segments:
+            if shm is not None:
+                _close(shm)
+                _unlink(shm)
+
+
+# ---------- сторона воркера ----------
+
+_attached = {}
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """Сегмент слота открывается один раз на процесс; отдельные (oversize) — на каждый вызов"""
+    shm = _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        if "_x" not in name:
+            _attached[name] = shm
+    return shm
+
+
+def detach(name: str, shm: shared_memory.SharedMemory):
+    if name not in _attached:
+        _close(shm)
+
+
+def open_array(shm: shared_memory.SharedMemory, frames: int) -> np.ndarray:
+    return np.ndarray((frames,), dtype=np.float32, buffer=shm.buf)
@@ -0,0 +1,120 @@
+"""
+Выходная стадия /remove: отдаём картинку с минимумом перекодирований.
+
+- если формат ответа Nano Banana подходит клиенту и размер в пределах нормы — байты идут как есть;
+- иначе одно декодирование и одно кодирование в выбранный формат (WebP/JPEG/PNG);
+- по запросу в том же проходе делается лёгкая миниатюра для чата;
+- ETag по содержимому для повторных запросов.
+"""
+
+import hashlib
+import io
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Больше этой стороны картинку уменьшаем — телефону не нужен кадр крупнее экрана
+PHOTO_MAX_SIDE = 2048
+THUMBNAIL_SIDE = 320
+JPEG_QUALITY = 88
+WEBP_QUALITY = 85
+
+
+@dataclass
+class PhotoOutput:
+    body: bytes
+    media_type: str
+    etag: str
+    thumbnail: Optional[bytes] = None
+    thumbnail_media_type: Optional[str] = None
+    passthrough: bool = False
+
+    def headers(self) -> dict:
+        return {"ETag": self.etag, "Cache-Control": "private, max-age=3600"}
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """Формат по сигнатуре, без декодирования"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def accepts(accept: str, fmt: str) -> bool:
+    if not accept:
+        return True
+    accept = accept.lower()
+    return "*/*" in accept or "image/*" in accept or MEDIA_TYPES[fmt] in accept
+
+
+def choose_format(accept: str, requested: Optional[str], source_format: Optional[str]) -> str:
+    """Явно запрошенный формат > исходный (если клиент его принимает) > WebP > JPEG"""
+    if requested in MEDIA_TYPES:
+        return requested
+    if source_format and accepts(accept, source_format):
+        return source_format
+    if accept and "image/webp" in accept.lower():
+        return "webp"
+    return "jpeg"
+
+
+def encode(image: Image.Image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    elif fmt == "webp":
+        image.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=4)
+    else:
+        # compress_level=3 заметно быстрее стандартного 6 при почти том же размере
+        image.save(buffer, format="PNG", compress_level=3)
+    return buffer.getvalue()
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def _thumbnail(image: Image.Image, fmt: str) -> bytes:
+    thumb = image.copy()
+    thumb.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.Resampling.BILINEAR)
+    return encode(thumb, "webp" if fmt == "webp" else "jpeg")
+
+
+def render_photo(data: bytes, accept: str = "", requested: Optional[str] = None,
+                 with_thumbnail: bool = False) -> PhotoOutput:
+    """Готовит ответ из закодированных байт (например, от Nano Banana)"""
+    source_format = sniff_format(data)
+    fmt = choose_format(accept, requested, source_format)
+
+    if fmt == source_format and not with_thumbnail:
+        # Размер читается из заголовка файла, пиксели не декодируются
+        with Image.open(io.BytesIO(data)) as probe:
+            oversized = max(probe.size) > PHOTO_MAX_SIDE
+        if not oversized:
+            return PhotoOutput(data, MEDIA_TYPES[fmt], make_etag(data), passthrough=True)
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return render_image(image, fmt, with_thumbnail, source_bytes=data if fmt == source_format else None)
+
+
+def render_image(image: Image.Image, fmt: str, with_thumbnail: bool = False,
+                 source_bytes: Optional[bytes] = None) -> PhotoOutput:
+    """Одно кодирование картинки (и миниатюры) в выбранный формат"""
+    if max(image.size) > PHOTO_MAX_SIDE:
+        image = image.copy()
+        image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.Resampling.LANCZOS)
+        source_bytes = None
+    body = source_bytes if source_bytes is not None else encode(image, fmt)
+    output = PhotoOutput(body, MEDIA_TYPES[fmt], make_etag(body), passthrough=source_bytes is not None)
+    if with_thumbnail:
+        output.thumbnail = _thumbnail(image, fmt)
+        output.thumbnail_media_type = "image/webp" if fmt == "webp" else "image/jpeg"
+    return output
@@ -0,0 +1,101 @@
+"""
+Быстрое локальное превью ИИ-фото: сегментация людей на CPU (ONNX-модель через rembg)
+и подстановка фона персонажа assets/bg_*.png вместе с AR-слоем.
+
+Используется как мгновенный ответ /remove/preview, пока Nano Banana готовит стилизованный
+вариант, и как полноценный запасной вариант, если Nano Banana недоступен или исчерпан бюджет.
+"""
+
+import logging
+import os
+import threading
+from functools import lru_cache
+
+from PIL import Image
+
+# u2netp — маленькая (~4 МБ) ONNX-модель, укладывается в доли секунды на CPU
+PREVIEW_SEGMENTATION_MODEL = os.environ.get("PREVIEW_SEGMENTATION_MODEL", "u2netp")
+# Сегментацию считаем на уменьшенной копии, маску растягиваем обратно
+SEGMENTATION_SIDE = 320
+# Максимальная сторона превью
+PREVIEW_MAX_SIDE = 1280
+
+BACKGROUNDS_DIR = "assets"
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Ленивая загрузка ONNX-сессии; None, если rembg/onnxruntime не установлены"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                try:
+                    from rembg import new_session
+                    _session = new_session(PREVIEW_SEGMENTATION_MODEL)
+                except Exception as e:
+                    logging.getLogger("photo_preview").warning(
+                        "Сегментация недоступна (%s), превью будет без замены фона", e)
+                    _session = False
+    return _session or None
+
+
+def warm_up(characters=("cheb", "gena", "shap", "volc"), model: bool = True):
+    """Загрузить модель и фоны заранее, чтобы первое превью не ждало инициализации"""
+    session = get_session() if model else None
+    if session is not None:
+        segment_people(Image.new("RGB", (SEGMENTATION_SIDE, SEGMENTATION_SIDE)))
+    for character in characters:
+        load_background(character, (720, 1280))
+
+
+def segment_people(image: Image.Image):
+    """Маска людей (L) в размере исходного изображения или None без модели"""
+    session = get_session()
+    if session is None:
+        return None
+    from rembg import remove
+
+    small = image.convert("RGB")
+    small.thumbnail((SEGMENTATION_SIDE, SEGMENTATION_SIDE), Image.Resampling.BILINEAR)
+    mask = remove(small, session=session, only_mask=True)
+    return mask.convert("L").resize(image.size, Image.Resampling.BILINEAR)
+
+
+@lru_cache(maxsize=16)
+def load_background(character: str, size: tuple) -> Image.Image:
+    """Фон персонажа, обрезанный по пропорциям кадра (cover) и приведённый к размеру"""
+    path = os.path.join(BACKGROUNDS_DIR, f"bg_{character}.png")
+    if not os.path.exists(path):
+        path = os.path.join(BACKGROUNDS_DIR, "bg_cheb.png")
+    bg = Image.open(path).convert("RGBA")
+
+    target_w, target_h = size
+    scale = max(target_w / bg.width, target_h / bg.height)
+    resized = bg.resize((max(target_w, round(bg.width * scale)), max(target_h, round(bg.height * scale))),
+                        Image.Resampling.BILINEAR)
+    left = (resized.width - target_w) // 2
+    top = (resized.height - target_h) // 2
+    return resized.crop((left, top, left + target_w, top + target_h))
+
+
+def compose_preview(photo: Image.Image, ar_layer, character: str) -> Image.Image:
+    """Люди с фото на фоне персонажа + AR-слой поверх"""
+    photo = photo.convert("RGBA")
+    if max(photo.size) > PREVIEW_MAX_SIDE:
+        photo.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE), Image.Resampling.BILINEAR)
+
+    mask = segment_people(photo)
+    if mask is None:
+        result = photo.copy()
+    else:
+        result = load_background(character, photo.size).copy()
+        result.paste(photo, (0, 0), mask)
+
+    if ar_layer is not None:
+        if ar_layer.size != result.size:
+            ar_layer = ar_layer.resize(result.size, Image.Resampling.BILINEAR)
+        result.paste(ar_layer, (0, 0), ar_layer)
+    return result
@@ -0,0 +1,266 @@
+"""
+Извлечение основного тона (f0) для RVC.
+
+RvcWebUI сам умеет pm/harvest/crepe/rmvpe, но метод был жёстко зашит ("pm").
+Здесь:
+- локальные векторизованные извлекатели на NumPy (YIN и автокорреляция) — все кадры
+  считаются одним FFT, без цикла по кадрам в Python;
+- обёртки pm (parselmouth) и harvest (pyworld), если библиотеки установлены, — для бенчмарка
+  и как эталон;
+- выбор метода: по персонажу из characters.json (rvc.f0_method) и с понижением до более быстрого под нагрузкой.
+
+Кривая локального метода передаётся в RvcWebUI как f0-файл (строки "время,частота"),
+а сам RvcWebUI при этом считает самый дешёвый pm — его кривая заменяется нашей.
+"""
+
+import os
+from typing import Callable, Dict
+
+import numpy as np
+
+# Параметры, с которыми RVC работает с f0: 16 кГц, шаг 10 мс
+F0_SAMPLE_RATE = 16000
+F0_HOP = 160
+F0_MIN = 50.0
+F0_MAX = 1100.0
+
+# Методы самого RvcWebUI
+RVC_NATIVE_METHODS = ("pm", "harvest", "crepe", "rmvpe")
+
+# От качественного к быстрому: под нагрузкой спускаемся по этой лестнице. Порядок — по RTF
+# из bench_f0.py (CPU, глиссандо 10 с, лучшее из 5): harvest 0.161, yin 0.0037, pm 0.0049.
+# Локальные методы идут до pm: RvcWebUI при f0-файле всё равно считает pm,
+# так что их цена — своя плюс pm. autocorr (0.0052) в лестнице нет: yin и быстрее,
+# и реже ошибается (грубые 0.0% против 0.1%, вокализация 0.3% против 1.0%), так что
+# под нагрузкой autocorr понижается сразу до yin. rmvpe в RvcWebUI на GPU — наверху по качеству.
+# crepe на CPU медленнее harvest, поэтому в лестнице его нет: под нагрузкой он
+# понижается как rmvpe, сразу до harvest
+F0_LADDER = ("rmvpe", "harvest", "yin", "pm")
+_LADDER_ALIASES = {"crepe": "rmvpe", "autocorr": "harvest"}
+
+
+# ==================== ЗАГРУЗКА АУДИО ====================
+
+def load_audio(path: str, sr: int = F0_SAMPLE_RATE) -> np.ndarray:
+    """Моно float32 с частотой sr (линейная передискретизация достаточна для f0)"""
+    import soundfile as sf
+
+    audio, source_sr = sf.read(path, dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if source_sr != sr:
+        duration = len(audio) / source_sr
+        target_len = int(round(duration * sr))
+        audio = np.interp(
+            np.linspace(0, len(audio) - 1, target_len), np.arange(len(audio)), audio
+        ).astype(np.float32)
+    return audio
+
+
+def _frames(audio: np.ndarray, frame_len: int, hop: int, center: int = None) -> np.ndarray:
+    """
+    Кадры (n_frames, frame_len) без копирования. Точка анализа (по умолчанию середина кадра)
+    кадра i приходится на отсчёт i * hop, как в RVC.
+    """
+    pad = frame_len // 2 if center is None else center
+    padded = np.pad(audio.astype(np.float64), (pad, pad + frame_len))
+    n_frames = len(audio) // hop + 1
+    return np.lib.stride_tricks.sliding_window_view(padded, frame_len)[::hop][:n_frames]
+
+
+# ==================== ЛОКАЛЬНЫЕ ИЗВЛЕКАТЕЛИ ====================
+
+def yin_f0(audio: np.ndarray, sr: int = F0_SAMPLE_RATE, hop: int = F0_HOP,
+           fmin: float = F0_MIN, fmax: float = F0_MAX, threshold: float = 0.15,
+           silence_db: float = -50.0) -> np.ndarray:
+    """
+    YIN (de Cheveigné, Kawahara 2002), векторизованный по всем кадрам.
+    Разностная функция d(τ) = e(0) + e(τ) - 2·r(τ): r — через rfft, энергии — через cumsum.
+    Возвращает f0 на каждый шаг hop, 0 — невокализованный кадр.
+    """
+    min_lag = max(2, int(sr / fmax))
+    max_lag = int(np.ceil(sr / fmin))
+    window = max_lag + 1
+    # Сравниваются первые window отсчётов кадра — их середина и есть точка анализа
+    frames = _frames(audio, window + max_lag, hop, center=window // 2)
+
+    n_fft = 1 << int(np.ceil(np.log2(frames.shape[1] + window)))
+    spectrum = np.fft.rfft(frames, n_fft, axis=1)
+    head = np.fft.rfft(frames[:, :window], n_fft, axis=1)
+    corr = np.fft.irfft(spectrum * np.conj(head), n_fft, axis=1)[:, :max_lag + 1]
+
+    squares = np.cumsum(np.pad(frames ** 2, ((0, 0), (1, 0))), axis=1)
+    lags = np.arange(max_lag + 1)
+    energy = squares[:, lags + window] - squares[:, lags]
+    diff = np.maximum(energy[:, :1] + energy - 2 * corr, 0.0)
+
+    # Кумулятивно нормированная разностная функция
+    cumulative = np.cumsum(diff[:, 1:], axis=1)
+    cmnd = np.ones_like(diff)
+    cmnd[:, 1:] = diff[:, 1:] * lags[1:] / np.maximum(cumulative, 1e-12)
+
+    # Первый провал ниже порога: кадр ниже порога и не выше следующего
+    search = cmnd[:, min_lag:max_lag]
+    following = cmnd[:, min_lag + 1:max_lag + 1]
+    candidates = (search < threshold) & (search <= following)
+    voiced = candidates.any(axis=1)
+    tau = np.argmax(candidates, axis=1) + min_lag
+
+    # Параболическая интерполяция по d(τ): у нормированной функции минимум смещён
+    rows = np.arange(len(tau))
+    left = diff[rows, tau - 1]
+    center = diff[rows, tau]
+    right = diff[rows, np.minimum(tau + 1, max_lag)]
+    denom = left - 2 * center + right
+    shift = np.where(np.abs(denom) > 1e-12, 0.5 * (left - right) / np.where(denom == 0, 1, denom), 0.0)
+    period = tau + np.clip(shift, -1, 1)
+
+    level = 10 * np.log10(energy[:, 0] / window + 1e-12)
+    voiced &= level > silence_db
+    return np.where(voiced, sr / period, 0.0).astype(np.float32)
+
+
+def autocorr_f0(audio: np.ndarray, sr: int = F0_SAMPLE_RATE, hop: int = F0_HOP,
+                fmin: float = F0_MIN, fmax: float = F0_MAX, voicing_threshold: float = 0.45,
+                octave_cost: float = 0.05, silence_db: float = -50.0) -> np.ndarray:
+    """
+    Нормированная автокорреляция окна Ханна (в духе praat ac), векторизованная по кадрам.
+    Окно длиннее, чем у YIN: точнее на ровном тоне, но сильнее сглаживает быстрые изменения.
+    """
+    min_lag = max(2, int(sr / fmax))
+    max_lag = int(np.ceil(sr / fmin))
+    # Три периода нижней границы тона, как в praat
+    frame_len = 3 * max_lag
+    frames = _frames(audio, frame_len, hop)
+    frames = frames - frames.mean(axis=1, keepdims=True)
+
+    window = np.hanning(frame_len)
+    n_fft = 1 << int(np.ceil(np.log2(2 * frame_len)))
+    power = np.abs(np.fft.rfft(frames * window, n_fft, axis=1)) ** 2
+    acf = np.fft.irfft(power, n_fft, axis=1)[:, :max_lag + 2]
+    # Поправка на автокорреляцию самого окна
+    window_acf = np.fft.irfft(np.abs(np.fft.rfft(window, n_fft)) ** 2, n_fft)[:max_lag + 2]
+    normalized = acf / np.maximum(acf[:, :1], 1e-12) / np.maximum(window_acf / window_acf[0], 1e-6)
+
+    # Штраф за низкие частоты (octave cost) против ошибок на октаву вниз
+    search = normalized[:, min_lag:max_lag + 1]
+    lags = np.arange(min_lag, max_lag + 1)
+    tau = np.argmax(search - octave_cost * np.log2(lags / min_lag), axis=1) + min_lag
+    peak = search[np.arange(len(tau)), tau - min_lag]
+
+    rows = np.arange(len(tau))
+    left = normalized[rows, tau - 1]
+    right = normalized[rows, tau + 1]
+    denom = left - 2 * peak + right
+    shift = np.where(np.abs(denom) > 1e-12, 0.5 * (left - right) / np.where(denom == 0, 1, denom), 0.0)
+    period = tau + np.clip(shift, -1, 1)
+
+    level = 10 * np.log10(acf[:, 0] / frame_len + 1e-12)
+    voiced = (peak > voicing_threshold) & (level > silence_db)
+    return np.where(voiced, sr / period, 0.0).astype(np.float32)
+
+
+def pm_f0(audio: np.ndarray, sr: int = F0_SAMPLE_RATE, hop: int = F0_HOP,
+          fmin: float = F0_MIN, fmax: float = F0_MAX) -> np.ndarray:
+    """praat to_pitch_ac с параметрами RVC (нужен praat-parselmouth)"""
+    import parselmouth
+
+    f0 = parselmouth.Sound(audio, sr).to_pitch_ac(
+        time_step=hop / sr, voicing_threshold=0.6, pitch_floor=fmin, pitch_ceiling=fmax
+    ).selected_array["frequency"]
+    return _fit_length(np.asarray(f0, dtype=np.float32), len(audio) // hop + 1)
+
+
+def harvest_f0(audio: np.ndarray, sr: int = F0_SAMPLE_RATE, hop: int = F0_HOP,
+               fmin: float = F0_MIN, fmax: float = F0_MAX) -> np.ndarray:
+    """WORLD harvest + stonemask (нужен pyworld); медленный, но самый устойчивый на CPU"""
+    import pyworld
+
+    x = audio.astype(np.double)
+    f0, t = pyworld.harvest(x, fs=sr, f0_ceil=fmax, f0_floor=fmin, frame_period=1000 * hop / sr)
+    f0 = pyworld.stonemask(x, f0, t, sr)
+    return _fit_length(f0.astype(np.float32), len(audio) // hop + 1)
+
+
+def _fit_length(f0: np.ndarray, length: int) -> np.ndarray:
+    if len(f0) >= length:
+        return f0[:length]
+    return np.pad(f0, (0, length - len(f0)))
+
+
+EXTRACTORS: Dict[str, Callable[..., np.ndarray]] = {
+    "yin": yin_f0,
+    "autocorr": autocorr_f0,
+    "pm": pm_f0,
+    "harvest": harvest_f0,
+}
+
+# Методы, которые считаются здесь и передаются в RvcWebUI f0-файлом
+LOCAL_METHODS = ("yin", "autocorr")
+
+
+def available_methods() -> list:
+    """Локально доступные извлекатели (pm/harvest — при установленных библиотеках)"""
+    methods = list(LOCAL_METHODS)
+    for name, module in (("pm", "parselmouth"), ("harvest", "pyworld")):
+        try:
+            __import__(module)
+            methods.append(name)
+        except ImportError:
+            pass
+    return methods
+
+
+def extract_f0(method: str, audio: np.ndarray, sr: int = F0_SAMPLE_RATE, hop: int = F0_HOP) -> np.ndarray:
+    return EXTRACTORS[method](audio, sr=sr, hop=hop)
+
+
+def write_f0_file(f0: np.ndarray, path: str, hop_seconds: float = F0_HOP / F0_SAMPLE_RATE) -> str:
+    """f0-файл в формате RvcWebUI: строки "время_в_секундах,частота" (0 — без тона)"""
+    times = np.arange(len(f0)) * hop_seconds
+    np.savetxt(path, np.column_stack([times, f0]), fmt="%.3f", delimiter=",")
+    return path
+
+
+def prepare_f0_file(method: str, input_audio: str, output_dir: str) -> str:
+    """Считает кривую локальным методом и пишет f0-файл рядом с временными файлами"""
+    f0 = extract_f0(method, load_audio(input_audio))
+    return write_f0_file(f0, os.path.join(output_dir, f"f0_{method}.csv"))
+
+
+# ==================== ВЫБОР МЕТОДА ====================
+
+def choose_f0_method(preferred: str, load: float, degrade_at: float = 0.5, fastest_at: float = 1.0) -> str:
+    """
+    Метод с учётом нагрузки на RVC.
+    load — (в работе + в очереди) / лимит этапа: от degrade_at спускаемся на ступень
+    по F0_LADDER, от fastest_at — сразу самый быстрый pm.
+    """
+    step = _LADDER_ALIASES.get(preferred, preferred)
+    if step not in F0_LADDER:
+        return preferred
+    if load >= fastest_at:
+        return F0_LADDER[-1]
+    if load >= degrade_at:
+        return F0_LADDER[min(F0_LADDER.index(step) + 1, len(F0_LADDER) - 1)]
+    return preferred
+
+
+# ==================== МЕТРИКИ ====================
+
+def pitch_error(estimate: np.ndarray, reference: np.ndarray) -> dict:
+    """
+    Сравнение с эталонной кривой: медианная ошибка в центах и доля грубых ошибок (> 50 центов)
+    на кадрах, вокализованных в обеих; плюс доля расхождений вокализации.
+    """
+    length = min(len(estimate), len(reference))
+    estimate, reference = estimate[:length], reference[:length]
+    both = (estimate > 0) & (reference > 0)
+    voicing_error = float(np.mean((estimate > 0) != (reference > 0))) if length else 0.0
+    if not both.any():
+        return {"median_cents": None, "gross_error": None, "voicing_error": voicing_error}
+    cents = np.abs(1200 * np.log2(estimate[both] / reference[both]))
+    return {
+        "median_cents": float(np.median(cents)),
+        "gross_error": float(np.mean(cents > 50)),
+        "voicing_error": voicing_error,
+    }
@@ -0,0 +1,286 @@
+"""
+Профилирование по запросу, без передеплоя.
+
+- Запрос с заголовком X-Profile (или ?profile=) получает след из вложенных span'ов
+  (stt/llm/tts/rvc/ffmpeg/image) и, по желанию, профиль только на время этого запроса:
+      X-Profile: trace      — только span'ы (Chrome trace, открывается в chrome://tracing и speedscope)
+      X-Profile: cprofile   — + cProfile (.prof для pstats/snakeviz)
+      X-Profile: sample     — + сэмплирующий профиль потоков (.speedscope.json)
+  Файлы пишутся в PROFILE_DIR под request_id (он же в заголовке X-Request-ID ответа).
+- sample_process(seconds) — сэмплирование всего живого процесса (админский эндпоинт).
+
+Без PROFILING_TOKEN профилирование выключено полностью: сервер смотрит в интернет,
+а профиль держит поток и пишет файлы.
+
+Выключенное профилирование стоит одной проверки contextvar на span.
+cProfile и сэмплер видят весь поток event loop, то есть и соседние запросы:
+на нагруженном сервере читать их нужно вместе со следом span'ов.
+"""
+
+import asyncio
+import contextvars
+import cProfile
+import json
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Профилирование включается только с заголовком X-Profile-Token с этим значением; пусто — выключено
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "")
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))
+# Предел для сэмплирования процесса: всё это время занят поток пула
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "30"))
+PROFILE_MODES = ("trace", "cprofile", "sample")
+
+_trace = contextvars.ContextVar("profile_trace", default=None)
+# cProfile нельзя включить дважды в одном потоке: одновременно профилируется один запрос
+_cprofile_lock = threading.Lock()
+
+
+# request_id из заголовка клиента попадает в имена файлов: только безопасные символы
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+def safe_id(value: Optional[str]) -> Optional[str]:
+    return value if value and _SAFE_ID.match(value) else None
+
+
+def authorized(headers) -> bool:
+    """Профилирование разрешено: PROFILING_TOKEN задан и совпадает с X-Profile-Token"""
+    token = headers.get("x-profile-token") or ""
+    return bool(PROFILING_TOKEN) and hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+
+def requested_mode(headers, query_params) -> Optional[str]:
+    """Режим профилирования, запрошенный клиентом, или None"""
+    mode = headers.get("x-profile") or query_params.get("profile")
+    if not mode or not authorized(headers):
+        return None
+    mode = mode.lower()
+    return mode if mode in PROFILE_MODES else "trace"
+
+
+# ---------- span'ы ----------
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.events = []
+        self.closed = False
+        self._tids = {}
+
+    def _tid(self) -> int:
+        """Дорожка в просмотрщике: своя у каждой задачи asyncio и каждого потока"""
+        try:
+            key = id(asyncio.current_task())
+        except RuntimeError:
+            key = threading.get_ident()
+        return self._tids.setdefault(key, len(self._tids) + 1)
+
+    def add(self, name: str, start: float, duration: float, args: dict = None):
+        if self.closed:
+            return
+        self.events.append({
+            "name": name, "cat": name.split(":")[0], "ph": "X", "pid": os.getpid(), "tid": self._tid(),
+            "ts": round((start - self.started) * 1e6, 1), "dur": round(duration * 1e6, 1),
+            "args": args or {},
+        })
+
+    def chrome_trace(self) -> dict:
+        return {"traceEvents": self.events, "displayTimeUnit": "ms", "otherData": {"name": self.name}}
+
+
+@contextmanager
+def _span(trace: Trace, name: str, args: dict):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter() - start, args)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **args):
+    """with span("tts", voice=...): ... — span в след текущего запроса, если он профилируется"""
+    trace = _trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _span(trace, name, args)
+
+
+def add_span(name: str, seconds: float, args: dict = None):
+    """Span, закончившийся только что (для мест, где известна лишь длительность)"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter() - seconds, seconds, args)
+
+
+# ---------- сэмплер ----------
+
+class StackSampler:
+    """Периодически снимает стеки потоков через sys._current_frames (без зависимостей)"""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids  # None — все потоки, кроме самого сэмплера
+        self.stacks = {}  # tid -> Counter(stack)
+        self.started = self.stopped = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stopped = time.perf_counter()
+        return self
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me or (self.thread_ids is not None and tid not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks.setdefault(tid, Counter())[tuple(reversed(stack))] += 1
+
+    def speedscope(self, name: str) -> dict:
+        frames, index = [], {}
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        profiles = []
+        duration = (self.stopped or time.perf_counter()) - self.started
+        for tid, counter in self.stacks.items():
+            samples, weights = [], []
+            for stack, count in counter.most_common():
+                ids = []
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                    ids.append(index[frame])
+                samples.append(ids)
+                weights.append(round(count * self.interval, 6))
+            profiles.append({
+                "type": "sampled", "name": thread_names.get(tid, str(tid)), "unit": "seconds",
+                "startValue": 0, "endValue": round(duration, 6), "samples": samples, "weights": weights,
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name, "exporter": "profiling.py",
+            "shared": {"frames": frames}, "profiles": profiles,
+        }
+
+    def top(self, limit: int = 20) -> list:
+        """Самые частые функции на вершине стека (self time) по всем потокам"""
+        leaf = Counter()
+        total = 0
+        for counter in self.stacks.values():
+            for stack, count in counter.items():
+                if stack:
+                    name, filename, line = stack[-1]
+                    leaf[f"{name} ({os.path.basename(filename)}:{line})"] += count
+                total += count
+        return [{"function": name, "share": round(count / total, 3)} for name, count in leaf.most_common(limit)]
+
+
+# ---------- профиль запроса ----------
+
+def _write_json(path: str, data: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+class RequestProfile:
+    """
+    След и профиль одного запроса. stop() — в том же потоке и контексте, где профиль начат
+    (cProfile выключается только в своём потоке); write() можно звать из to_thread.
+    """
+
+    def __init__(self, mode: str, request_id: str, name: str):
+        self.mode = mode
+        self.request_id = request_id
+        self.trace = Trace(name)
+        self._token = _trace.set(self.trace)
+        self._profiler = None
+        self._sampler = None
+        self._root_started = time.perf_counter()
+        if mode == "cprofile" and _cprofile_lock.acquire(blocking=False):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif mode == "sample":
+            # Все потоки: RVC, ffmpeg и PIL работают в to_thread
+            self._sampler = StackSampler().start()
+
+    def stop(self):
+        self.trace.add(self.trace.name, self._root_started, time.perf_counter() - self._root_started,
+                       {"mode": self.mode})
+        self.trace.closed = True
+        try:
+            _trace.reset(self._token)
+        except ValueError:
+            # stop из другого контекста — след уже закрыт, новые span'ы в него не попадут
+            _trace.set(None)
+        if self._profiler is not None:
+            self._profiler.disable()
+            _cprofile_lock.release()
+        if self._sampler is not None:
+            self._sampler.stop()
+
+    def write(self) -> list:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, safe_id(self.request_id) or time.strftime("request_%Y%m%d_%H%M%S"))
+        paths = [base + ".trace.json"]
+        _write_json(paths[0], self.trace.chrome_trace())
+        if self._profiler is not None:
+            self._profiler.dump_stats(base + ".prof")
+            paths.append(base + ".prof")
+        if self._sampler is not None:
+            _write_json(base + ".speedscope.json", self._sampler.speedscope(self.trace.name))
+            paths.append(base + ".speedscope.json")
+        return paths
+
+
+def start_request(mode: Optional[str], request_id: str, name: str) -> Optional[RequestProfile]:
+    return RequestProfile(mode, request_id, name) if mode else None
+
+
+def sample_process(seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL, name: str = None) -> dict:
+    """Сэмплирование всех потоков процесса; блокирует вызывающий поток на seconds"""
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    sampler = StackSampler(interval).start()
+    time.sleep(seconds)
+    sampler.stop()
+    name = safe_id(name) or time.strftime(f"process_{os.getpid()}_%Y%m%d_%H%M%S")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name + ".speedscope.json")
+    _write_json(path, sampler.speedscope(name))
+    return {"file": path, "seconds": seconds, "samples": sum(sum(c.values()) for c in sampler.stacks.values()),
+            "top": sampler.top()}
@@ -0,0 +1,246 @@
+"""
+Устойчивость к медленным и падающим внешним сервисам (Yandex, OpenRouter, RvcWebUI).
+
+Для каждого бэкенда:
+- таймаут подстраивается под наблюдаемую задержку (p95 * множитель, в пределах min/max);
+- «хеджирование»: если ответа нет дольше p95, параллельно уходит дубль запроса, берётся первый успешный;
+- circuit breaker размыкается при всплеске ошибок или медленных ответов и сразу отдаёт CircuitOpenError,
+  чтобы вызывающий код ушёл в деградированный режим, а не ждал таймаут;
+- ограниченное число повторов с экспоненциальной задержкой и jitter.
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+
+class UpstreamError(Exception):
+    """Внешний сервис вернул 5xx/429 или не ответил вовремя"""
+
+
+class CircuitOpenError(UpstreamError):
+    """Предохранитель разомкнут — вызов не выполнялся"""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Ошибки клиента (4xx, кроме 429) не повторяем и не считаем сбоем сервиса"""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        return True
+    return status >= 500 or status == 429
+
+
+def check_response(response):
+    """Превращает ответ 5xx/429 в исключение, чтобы он учитывался как сбой"""
+    status = getattr(response, "status_code", 200)
+    if status >= 500 or status == 429:
+        raise UpstreamError(f"HTTP {status}")
+    return response
+
+
+class CircuitBreaker:
+    """closed -> open (после всплеска сбоев) -> half_open (одна пробная попытка) -> closed/open"""
+
+    def __init__(self, window: int = 20, min_calls: int = 5, failure_ratio: float = 0.5,
+                 consecutive_failures: int = 5, reset_timeout: float = 30.0):
+        self.window = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.consecutive_limit = consecutive_failures
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.consecutive = 0
+        self.trips = 0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def abandon(self):
+        """Вызов отменён, не дойдя до результата: о сервисе это ничего не говорит, пробу можно повторить"""
+        if self.state == "half_open":
+            self._probe_in_flight = False
+
+    def record(self, ok: bool):
+        self.window.append(ok)
+        if ok:
+            self.consecutive = 0
+            if self.state == "half_open":
+                self.state = "closed"
+                self.window.clear()
+            return
+
+        self.consecutive += 1
+        if self.state == "half_open":
+            self._trip()
+            return
+        failures = self.window.count(False)
+        if (self.consecutive >= self.consecutive_limit or
+                (len(self.window) >= self.min_calls and failures / len(self.window) >= self.failure_ratio)):
+            self._trip()
+
+    def _trip(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._probe_in_flight = False
+
+
+@dataclass
+class BackendPolicy:
+    name: str
+    min_timeout: float
+    max_timeout: float
+    default_latency: float          # ожидаемая задержка, пока нет статистики
+    hedge: bool = False             # дублировать ли медленный запрос
+    max_retries: int = 1
+    timeout_multiplier: float = 3.0
+    slow_call: float = None         # успешный ответ дольше этого считается сбоем для breaker
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    latencies: deque = field(default_factory=lambda: deque(maxlen=200))
+    calls: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    rejected: int = 0
+
+    def p95(self) -> float:
+        if len(self.latencies) < 10:
+            return self.default_latency
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def timeout(self) -> float:
+        return max(self.min_timeout, min(self.max_timeout, self.p95() * self.timeout_multiplier))
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "p95": round(self.p95(), 3),
+            "timeout": round(self.timeout(), 3),
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "rejected": self.rejected,
+            "trips": self.breaker.trips,
+        }
+
+
+class Resilience:
+    """Реестр политик и единая точка вызова внешних сервисов"""
+
+    def __init__(self):
+        self.backends = {}
+
+    def register(self, name: str, **kwargs) -> BackendPolicy:
+        policy = BackendPolicy(name=name, **kwargs)
+        self.backends[name] = policy
+        return policy
+
+    def timeout_for(self, name: str) -> float:
+        return self.backends[name].timeout()
+
+    def is_available(self, name: str) -> bool:
+        """Можно ли сейчас обращаться к сервису (без учёта пробного вызова half-open)"""
+        breaker = self.backends[name].breaker
+        if breaker.state == "open" and time.monotonic() - breaker.opened_at < breaker.reset_timeout:
+            return False
+        return True
+
+    def snapshot(self) -> dict:
+        return {name: policy.snapshot() for name, policy in self.backends.items()}
+
+    async def call(self, name: str, fn):
+        """
+        Вызывает fn() — функцию без аргументов, возвращающую awaitable, — по политике бэкенда.
+        Бросает CircuitOpenError, если предохранитель разомкнут, и UpstreamError при исчерпании попыток.
+        """
+        policy = self.backends[name]
+        attempt = 0
+        while True:
+            if not policy.breaker.allow():
+                policy.rejected += 1
+                raise CircuitOpenError(f"{name}: circuit open")
+            policy.calls += 1
+            started = time.monotonic()
+            try:
+                result = await self._hedged(policy, fn)
+            except Exception as e:
+                if not is_retryable(e):
+                    policy.breaker.record(True)
+                    raise
+                policy.failures += 1
+                policy.breaker.record(False)
+                attempt += 1
+                if attempt > policy.max_retries:
+                    raise
+                # Экспоненциальная задержка с полным jitter
+                await asyncio.sleep(random.uniform(0, min(2.0, 0.2 * 2 ** attempt)))
+                continue
+            except BaseException:
+                # CancelledError (клиент отключился посреди стрима): без этого half-open проба
+                # осталась бы «в полёте» навсегда и предохранитель не замкнулся бы до перезапуска
+                policy.breaker.abandon()
+                raise
+
+            latency = time.monotonic() - started
+            policy.latencies.append(latency)
+            policy.breaker.record(policy.slow_call is None or latency <= policy.slow_call)
+            return result
+
+    async def _hedged(self, policy: BackendPolicy, fn):
+        timeout = policy.timeout()
+        deadline = time.monotonic() + timeout
+        tasks = [asyncio.ensure_future(fn())]
+        try:
+            if policy.hedge:
+                hedge_delay = min(policy.p95(), timeout)
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done and time.monotonic() < deadline:
+                    policy.hedges += 1
+                    tasks.append(asyncio.ensure_future(fn()))
+
+            pending = set(tasks)
+            last_exc = None
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        last_exc = task.exception()
+                        continue
+                    try:
+                        result = check_response(task.result())
+                    except UpstreamError as e:
+                        last_exc = e
+                        continue
+                    if len(tasks) > 1 and task is tasks[1]:
+                        policy.hedge_wins += 1
+                    return result
+
+            if pending:
+                policy.timeouts += 1
+                policy.latencies.append(timeout)
+                raise UpstreamError(f"{policy.name}: timeout {timeout:.1f}s")
+            raise last_exc
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
@@ -0,0 +1,216 @@
+"""
+Семантический кеш ответов персонажей для частых вопросов посетителей.
+
+Ключ — (персонаж, нормализованный вопрос, отпечаток последних реплик истории).
+Похожие формулировки («как тебя зовут?» / «а как тебя зовут») находятся через
+косинусную близость символьных триграмм, без внешних моделей эмбеддингов, — но только
+для подготовленных ответов (curated: частые вопросы, приветствие). Ответы из живого трафика
+находятся лишь по точному совпадению нормализованного вопроса: триграммы не видят разницы
+между «меня зовут маша» и «меня зовут миша» или отрицанием («ты не любишь апельсины»).
+При общем состоянии (shared_state) точные совпадения видны всем воркерам.
+revision(персонаж) — версия его настроек, она входит в ключ: после правки промпта или голоса
+старые ответы просто перестают находиться.
+"""
+
+import hashlib
+import math
+import re
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Нижний регистр, ё -> е, без пунктуации и лишних пробелов"""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def trigram_vector(normalized: str) -> Counter:
+    """Частоты символьных триграмм (с границами слов)"""
+    padded = f"  {normalized}  "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def cosine_similarity(a: Counter, b: Counter) -> float:
+    if not a or not b:
+        return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    norm_a = math.sqrt(sum(v * v for v in a.values()))
+    norm_b = math.sqrt(sum(v * v for v in b.values()))
+    return dot / (norm_a * norm_b)
+
+
+def history_fingerprint(history: list, turns: int = 2) -> str:
+    """Короткий отпечаток последних реплик, чтобы ответ совпадал и по контексту"""
+    tail = history[-turns:] if turns else []
+    if not tail:
+        return ""
+    joined = "\n".join(f"{m['role']}:{normalize_text(m['text'])}" for m in tail)
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class CachedReply:
+    character: str
+    question: str
+    fingerprint: str
+    reply_text: str
+    audio_b64: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    hits: int = 0
+    curated: bool = False
+    vector: Counter = field(default_factory=Counter, repr=False)
+
+
+class ResponseCache:
+    """
+    LRU-кеш ответов с порогом похожести и TTL.
+    Кандидаты ищутся по инвертированному индексу триграмм, поэтому поиск не сканирует весь кеш;
+    в индекс попадают только подготовленные ответы.
+    """
+
+    def __init__(self, threshold: float = 0.82, ttl: float = 6 * 3600, max_entries: int = 500,
+                 history_turns: int = 2, shared=None, revision: Callable[[str], str] = None):
+        self.shared = shared
+        self.revision = revision
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.history_turns = history_turns
+        self._entries = OrderedDict()  # (character, fingerprint, question) -> CachedReply
+        self._index = {}  # (character, fingerprint, trigram) -> set ключей
+        self.hits = 0
+        self.misses = 0
+
+    def namespace(self, character: str) -> str:
+        return f"{character}@{self.revision(character)}" if self.revision else character
+
+    def _key(self, entry: CachedReply):
+        return (entry.character, entry.fingerprint, entry.question)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for gram in entry.vector:
+            bucket = self._index.get((entry.character, entry.fingerprint, gram))
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._index[(entry.character, entry.fingerprint, gram)]
+
+    def lookup(self, character: str, user_text: str, history: list) -> Optional[CachedReply]:
+        question = normalize_text(user_text)
+        if not question:
+            return None
+        character = self.namespace(character)
+        fingerprint = history_fingerprint(history, self.history_turns)
+        now = time.time()
+
+        key = (character, fingerprint, question)
+        best, best_score = self._entries.get(key), 1.0
+        if best is None:
+            vector = trigram_vector(question)
+            candidates = set()
+            for gram in vector:
+                candidates.update(self._index.get((character, fingerprint, gram), ()))
+            best_score = 0.0
+            for candidate_key in candidates:
+                candidate = self._entries[candidate_key]
+                score = cosine_similarity(vector, candidate.vector)
+                if score > best_score:
+                    best, best_score = candidate, score
+
+        if best is not None and now - best.created_at > self.ttl:
+            self._remove(self._key(best))
+            best = None
+
+        if best is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+
+        best.hits += 1
+        self.hits += 1
+        self._entries.move_to_end(self._key(best))
+        return best
+
+    def store(self, character: str, user_text: str, history: list, reply_text: str,
+              audio_b64: Optional[str] = None, curated: bool = False) -> Optional[CachedReply]:
+        question = normalize_text(user_text)
+        if not question or not reply_text:
+            return None
+        character = self.namespace(character)
+        entry = CachedReply(
+            character=character,
+            question=question,
+            fingerprint=history_fingerprint(history, self.history_turns),
+            reply_text=reply_text,
+            audio_b64=audio_b64,
+            curated=curated,
+            vector=trigram_vector(question) if curated else Counter(),
+        )
+        key = self._key(entry)
+        self._remove(key)
+        self._entries[key] = entry
+        for gram in entry.vector:
+            self._index.setdefault((character, entry.fingerprint, gram), set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+        return entry
+
+    def _shared_key(self, character: str, user_text: str, history: list) -> str:
+        fingerprint = history_fingerprint(history, self.history_turns)
+        digest = hashlib.sha1(normalize_text(user_text).encode("utf-8")).hexdigest()[:20]
+        return f"reply:{self.namespace(character)}:{fingerprint}:{digest}"
+
+    async def fetch(self, character: str, user_text: str, history: list) -> Optional[CachedReply]:
+        """Локальный поиск похожих вопросов, затем точное совпадение в общем хранилище"""
+        entry = self.lookup(character, user_text, history)
+        if entry is not None or self.shared is None:
+            return entry
+        item = await self.shared.get(self._shared_key(character, user_text, history))
+        if item is None:
+            return None
+        # Ответ, подготовленный другим воркером, кладём и в локальный индекс
+        entry = self.store(character, user_text, history, item["reply_text"], item.get("audio_b64"),
+                           item.get("curated", False))
+        if entry is not None:
+            entry.created_at = item.get("created_at", entry.created_at)
+            entry.hits += 1
+            self.hits += 1
+            self.misses -= 1
+        return entry
+
+    async def publish(self, character: str, user_text: str, history: list, reply_text: str,
+                      audio_b64: Optional[str] = None, curated: bool = False) -> Optional[CachedReply]:
+        """Сохранить ответ локально и в общем хранилище; curated — находить и по похожим вопросам"""
+        entry = self.store(character, user_text, history, reply_text, audio_b64, curated)
+        if entry is not None and self.shared is not None:
+            await self.shared.set(
+                self._shared_key(character, user_text, history),
+                {"reply_text": reply_text, "audio_b64": audio_b64, "created_at": entry.created_at,
+                 "curated": curated},
+                self.ttl,
+            )
+        return entry
+
+    def drop_stale(self, character: str) -> int:
+        """Убирает из памяти ответы персонажа, сделанные со старыми настройками"""
+        current = self.namespace(character)
+        stale = [key for key, entry in self._entries.items()
+                 if entry.character != current and entry.character.split("@")[0] == character]
+        for key in stale:
+            self._remove(key)
+        return len(stale)
+
+    def __len__(self):
+        return len(self._entries)
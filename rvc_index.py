@@ -0,0 +1,161 @@
+"""
+Индексы поиска признаков RVC (logs/<модель>.index) для index_rate.
+
+RvcWebUI на каждый вызов читает IVF-Flat индекс целиком в кучу и восстанавливает все векторы
+(reconstruct_n), а при нескольких процессах у каждого своя копия. Здесь:
+
+- convert_index — компактный IVF-PQ вариант (logs/<модель>.ivfpq.index, nprobe сохраняется
+  в файле) и векторы отдельно в .npy (float16), которые можно отображать в память;
+- IndexRetriever — индекс читается с IO_FLAG_MMAP, векторы через np.load(mmap_mode="r"):
+  страницы общие для всех воркеров через page cache, в куче процесса их нет;
+- blend — поиск соседей одним батчем для всех кадров реплики и смешивание с index_rate,
+  как в пайплайне RVC.
+
+Компактный вариант — только для ONNX-пути (IndexRetriever): PQ там служит лишь для поиска
+соседей, а смешиваются точные векторы из .npy. RvcWebUI достаёт векторы из самого индекса
+через reconstruct_n, и из IVF-PQ это были бы PQ-приближения (заметно хуже голос), да ещё
+в куче каждого процесса — поэтому ему всегда отдаётся исходный индекс.
+
+Конвертация (один раз, на машине с RVC):
+    python rvc_index.py convert cheb gena shap --nprobe 8
+"""
+
+import argparse
+import math
+import os
+import threading
+
+import numpy as np
+
+RVC_LOGS_DIR = os.environ.get("RVC_LOGS_DIR", "logs")
+# Сколько списков IVF просматривать при поиске (больше — точнее и медленнее)
+RVC_INDEX_NPROBE = int(os.environ.get("RVC_INDEX_NPROBE", "8"))
+RVC_INDEX_MMAP = os.environ.get("RVC_INDEX_MMAP", "1") == "1"
+# Сколько соседей смешивается на кадр — как в RVC
+RETRIEVAL_K = 8
+
+
+def index_paths(model_name: str, logs_dir: str = RVC_LOGS_DIR) -> dict:
+    return {
+        "source": os.path.join(logs_dir, f"{model_name}.index"),
+        "compact": os.path.join(logs_dir, f"{model_name}.ivfpq.index"),
+        "vectors": os.path.join(logs_dir, f"{model_name}.vectors.npy"),
+    }
+
+
+def rvcwebui_index_path(model_name: str) -> str:
+    """Путь к индексу для infer_convert: всегда исходный (IVF-Flat), см. описание модуля"""
+    return index_paths(model_name)["source"]
+
+
+def convert_index(model_name: str, logs_dir: str = RVC_LOGS_DIR, nlist: int = 0, pq_m: int = 64,
+                  nprobe: int = RVC_INDEX_NPROBE, fp16: bool = True) -> dict:
+    """
+    Исходный индекс RVC -> IVF-PQ индекс + векторы в .npy.
+    nlist по умолчанию — как при обучении индекса в RVC: min(16·√N, N/39).
+    """
+    import faiss
+
+    paths = index_paths(model_name, logs_dir)
+    source = faiss.read_index(paths["source"])
+    vectors = source.reconstruct_n(0, source.ntotal).astype(np.float32)
+    count, dim = vectors.shape
+
+    np.save(paths["vectors"], vectors.astype(np.float16) if fp16 else vectors)
+
+    nlist = nlist or max(1, min(int(16 * math.sqrt(count)), count // 39))
+    if dim % pq_m:
+        raise ValueError(f"Размерность {dim} не делится на число подвекторов PQ {pq_m}")
+    index = faiss.index_factory(dim, f"IVF{nlist},PQ{pq_m}")
+    index.train(vectors)
+    index.add(vectors)
+    faiss.extract_index_ivf(index).nprobe = nprobe
+    faiss.write_index(index, paths["compact"])
+
+    return {
+        "model": model_name,
+        "vectors": count,
+        "dim": dim,
+        "nlist": nlist,
+        "source_mb": os.path.getsize(paths["source"]) / 2**20,
+        "compact_mb": os.path.getsize(paths["compact"]) / 2**20,
+        "vectors_mb": os.path.getsize(paths["vectors"]) / 2**20,
+    }
+
+
+class IndexRetriever:
+    """Поиск соседей для index_rate по отображённому в память индексу"""
+
+    def __init__(self, index_path: str, vectors_path: str = "", nprobe: int = RVC_INDEX_NPROBE,
+                 mmap: bool = RVC_INDEX_MMAP):
+        import faiss
+
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        self.index = faiss.read_index(index_path, flags)
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and nprobe:
+            ivf.nprobe = nprobe
+
+        if vectors_path and os.path.exists(vectors_path):
+            self.vectors = np.load(vectors_path, mmap_mode="r" if mmap else None)
+        else:
+            # Без .npy векторы восстанавливаются в кучу — как в RvcWebUI, без общего доступа
+            self.vectors = self.index.reconstruct_n(0, self.index.ntotal)
+
+    def blend(self, feats: np.ndarray, index_rate: float, k: int = RETRIEVAL_K) -> np.ndarray:
+        """
+        feats (T, dim) — признаки всех кадров реплики. Один батч-поиск, соседи взвешиваются
+        по 1/расстояние², результат смешивается с исходными признаками в пропорции index_rate.
+        """
+        if index_rate <= 0:
+            return feats
+        query = np.ascontiguousarray(feats, dtype=np.float32)
+        distances, ids = self.index.search(query, k)
+
+        weight = np.square(1 / np.maximum(distances, 1e-9))
+        weight[ids < 0] = 0
+        weight /= np.maximum(weight.sum(axis=1, keepdims=True), 1e-12)
+
+        neighbours = np.asarray(self.vectors[np.maximum(ids, 0).ravel()], dtype=np.float32)
+        retrieved = np.einsum("tkd,tk->td", neighbours.reshape(len(query), k, -1), weight)
+        return (index_rate * retrieved + (1 - index_rate) * query).astype(feats.dtype, copy=False)
+
+
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+
+def get_retriever(model_name: str):
+    """Ретривер модели (один на процесс); компактный вариант, если он сконвертирован. None без индекса"""
+    with _retrievers_lock:
+        if model_name not in _retrievers:
+            paths = index_paths(model_name)
+            if os.path.exists(paths["compact"]):
+                _retrievers[model_name] = IndexRetriever(paths["compact"], paths["vectors"])
+            elif os.path.exists(paths["source"]):
+                _retrievers[model_name] = IndexRetriever(paths["source"], paths["vectors"])
+            else:
+                _retrievers[model_name] = None
+        return _retrievers[model_name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Компактные индексы RVC для общего доступа через mmap")
+    sub = parser.add_subparsers(dest="command", required=True)
+    convert = sub.add_parser("convert")
+    convert.add_argument("models", nargs="+")
+    convert.add_argument("--logs-dir", default=RVC_LOGS_DIR)
+    convert.add_argument("--nlist", type=int, default=0)
+    convert.add_argument("--pq-m", type=int, default=64)
+    convert.add_argument("--nprobe", type=int, default=RVC_INDEX_NPROBE)
+    convert.add_argument("--fp32", action="store_true", help="хранить векторы в float32")
+    args = parser.parse_args()
+
+    for model in args.models:
+        info = convert_index(model, args.logs_dir, args.nlist, args.pq_m, args.nprobe, not args.fp32)
+        print(f"{model}: {info['vectors']}×{info['dim']}, nlist={info['nlist']}, "
+              f"{info['source_mb']:.1f} МБ -> индекс {info['compact_mb']:.1f} МБ + векторы {info['vectors_mb']:.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
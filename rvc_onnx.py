@@ -0,0 +1,193 @@
+"""
+Локальная переозвучка RVC через ONNX Runtime (CPU, int8) — альтернатива RvcWebUI
+для персонажей с "backend": "onnx" в rvc персонажа (characters.json).
+
+Модели готовит export_onnx.py:
+    onnx/contentvec_v2.int8.onnx — кодировщик содержания (HuBERT/ContentVec), общий для всех голосов;
+    onnx/<модель>.int8.onnx      — генератор голоса персонажа;
+    onnx/<модель>.json           — версия, частота дискретизации и имя кодировщика.
+
+Пайплайн повторяет RVC: признаки 50 кадров/с -> смешивание с индексом (rvc_index, index_rate)
+-> растяжение до 100 кадров/с -> f0 (pitch.py) -> защита глухих согласных (protect) -> генератор.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+import pitch
+import rvc_index
+
+RVC_ONNX_DIR = os.environ.get("RVC_ONNX_DIR", "onnx")
+# "int8" (по умолчанию) или "fp32" — какие файлы брать из RVC_ONNX_DIR
+RVC_ONNX_PRECISION = os.environ.get("RVC_ONNX_PRECISION", "int8")
+# Потоков ORT на одну сессию; 0 — решает ORT
+RVC_ORT_THREADS = int(os.environ.get("RVC_ORT_THREADS", "0"))
+
+# Шкала квантования f0 в RVC
+F0_MEL_MIN = 1127 * np.log(1 + pitch.F0_MIN / 700)
+F0_MEL_MAX = 1127 * np.log(1 + pitch.F0_MAX / 700)
+
+
+def model_files(model_name: str, precision: str = RVC_ONNX_PRECISION, onnx_dir: str = RVC_ONNX_DIR) -> dict:
+    meta_path = os.path.join(onnx_dir, f"{model_name}.json")
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    return {
+        "meta": meta,
+        "generator": os.path.join(onnx_dir, f"{model_name}.{precision}.onnx"),
+        "content_encoder": os.path.join(onnx_dir, f"{meta['content_encoder']}.{precision}.onnx"),
+    }
+
+
+def create_session(path: str):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if RVC_ORT_THREADS:
+        options.intra_op_num_threads = RVC_ORT_THREADS
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def coarse_pitch(f0: np.ndarray) -> np.ndarray:
+    """f0 (Гц) -> номера 1..255 на mel-шкале, как pitch в RVC"""
+    f0_mel = 1127 * np.log(1 + f0 / 700)
+    voiced = f0_mel > 0
+    f0_mel[voiced] = (f0_mel[voiced] - F0_MEL_MIN) * 254 / (F0_MEL_MAX - F0_MEL_MIN) + 1
+    return np.rint(np.clip(f0_mel, 1, 255)).astype(np.int64)
+
+
+class RvcInputs:
+    """Входы генератора; отдельно, чтобы сравнивать ONNX и torch на одинаковых данных"""
+
+    def __init__(self, phone, pitch_coarse, pitchf, rnd):
+        self.phone = phone
+        self.pitch = pitch_coarse
+        self.pitchf = pitchf
+        self.rnd = rnd
+
+    def feed(self) -> dict:
+        return {
+            "phone": self.phone,
+            "phone_lengths": np.array([self.phone.shape[1]], dtype=np.int64),
+            "pitch": self.pitch,
+            "pitchf": self.pitchf,
+            "ds": np.array([0], dtype=np.int64),
+            "rnd": self.rnd,
+        }
+
+
+def prepare_inputs(feats: np.ndarray, audio: np.ndarray, retriever, f0_up_key: int = 0,
+                   f0_method: str = "yin", index_rate: float = 0.75, protect: float = 0.33,
+                   seed: int = 0) -> RvcInputs:
+    """
+    feats (T, C) — выход кодировщика содержания (50 кадров/с) для audio (16 кГц).
+    Всё остальное — как в pipeline.vc RVC, векторизованно по всей реплике.
+    """
+    original = feats
+    if retriever is not None and index_rate > 0:
+        feats = retriever.blend(feats, index_rate)
+
+    # 50 -> 100 кадров/с (nearest, как F.interpolate в RVC)
+    feats = np.repeat(feats, 2, axis=0)
+    original = np.repeat(original, 2, axis=0)
+
+    f0 = pitch.extract_f0(f0_method if f0_method in pitch.EXTRACTORS else "yin", audio)
+    f0 = f0 * 2 ** (f0_up_key / 12)
+
+    p_len = min(len(feats), len(audio) // pitch.F0_HOP)
+    feats, original, f0 = feats[:p_len], original[:p_len], f0[:p_len]
+    if len(f0) < p_len:
+        f0 = np.pad(f0, (0, p_len - len(f0)))
+
+    if protect < 0.5:
+        # На глухих кадрах оставляем исходные признаки — согласные не «размазываются» индексом
+        weight = np.where(f0 > 0, 1.0, protect)[:, None]
+        feats = feats * weight + original * (1 - weight)
+
+    rng = np.random.default_rng(seed)
+    return RvcInputs(
+        phone=feats[None].astype(np.float32),
+        pitch_coarse=coarse_pitch(f0.copy())[None],
+        pitchf=f0[None].astype(np.float32),
+        rnd=rng.standard_normal((1, 192, p_len), dtype=np.float32),
+    )
+
+
+class OnnxVoiceConverter:
+    def __init__(self, model_name: str, precision: str = RVC_ONNX_PRECISION, onnx_dir: str = RVC_ONNX_DIR):
+        files = model_files(model_name, precision, onnx_dir)
+        self.model_name = model_name
+        self.meta = files["meta"]
+        if not self.meta.get("f0", 1):
+            raise ValueError(f"Модель {model_name} без f0 не поддерживается ONNX-бэкендом")
+        self.tgt_sr = self.meta["tgt_sr"]
+        self.content_encoder = get_content_encoder(files["content_encoder"])
+        self.generator = create_session(files["generator"])
+        self.retriever = rvc_index.get_retriever(model_name) if self.meta.get("has_index", True) else None
+
+    def content_features(self, audio: np.ndarray) -> np.ndarray:
+        session = self.content_encoder
+        (feats,) = session.run(None, {session.get_inputs()[0].name: audio[None].astype(np.float32)})
+        return feats[0]
+
+    def generate(self, inputs: RvcInputs) -> np.ndarray:
+        (audio,) = self.generator.run(None, inputs.feed())
+        return audio.reshape(-1)
+
+    def convert_array(self, audio: np.ndarray, f0_up_key: int = 0, f0_method: str = "yin",
+                      index_rate: float = 0.75, protect: float = 0.33, use_index: bool = True) -> np.ndarray:
+        """audio — моно 16 кГц; результат — с частотой tgt_sr, пик не выше 0.99"""
+        inputs = prepare_inputs(
+            self.content_features(audio), audio, self.retriever if use_index else None,
+            f0_up_key, f0_method, index_rate, protect,
+        )
+        result = self.generate(inputs)
+        peak = np.abs(result).max()
+        if peak > 0.99:
+            result = result / peak * 0.99
+        return result
+
+    def convert(self, input_audio: str, output_audio: str, f0_up_key: int = 0, f0_method: str = "yin",
+                index_rate: float = 0.75, protect: float = 0.33, use_index: bool = True) -> str:
+        import soundfile as sf
+
+        result = self.convert_array(pitch.load_audio(input_audio), f0_up_key, f0_method, index_rate, protect,
+                                    use_index)
+        sf.write(output_audio, result, self.tgt_sr)
+        return output_audio
+
+
+_content_encoders = {}
+_converters = {}
+_lock = threading.Lock()
+
+
+def get_content_encoder(path: str):
+    """Кодировщик содержания общий для всех персонажей процесса"""
+    with _lock:
+        if path not in _content_encoders:
+            _content_encoders[path] = create_session(path)
+        return _content_encoders[path]
+
+
+def get_converter(model_name: str) -> OnnxVoiceConverter:
+    with _lock:
+        converter = _converters.get(model_name)
+    if converter is None:
+        converter = OnnxVoiceConverter(model_name)
+        with _lock:
+            converter = _converters.setdefault(model_name, converter)
+    return converter
+
+
+def onnx_convert(input_audio: str, output_audio: str, model_name: str, has_index: bool = True,
+                 f0_up_key: int = 0, f0_method: str = "yin", index_rate: float = 0.75,
+                 protect: float = 0.33) -> str:
+    """Синхронная переозвучка (вызывать через asyncio.to_thread)"""
+    return get_converter(model_name).convert(
+        input_audio, output_audio, f0_up_key, f0_method, index_rate, protect, use_index=has_index
+    )
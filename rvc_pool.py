@@ -0,0 +1,176 @@
+"""
+Пул инстансов RvcWebUI для масштабирования переозвучки отдельно от веб-сервера.
+
+Адреса задаются списком (RVC_URLS). Запрос уходит на наименее загруженный инстанс,
+при равной загрузке — на тот, где уже выбран нужный голос (не нужен повторный infer_set).
+RvcWebUI хранит выбранную модель в своём состоянии, поэтому пара infer_set + infer_convert
+на одном инстансе выполняется под замком.
+
+Если инстансы делят несколько воркеров или машин (задан lock_url — Redis общего состояния),
+замок на пару infer_set + infer_convert берётся и в Redis (SET NX PX на rvc:lock:<url>),
+а выбранный голос отмечается там же (rvc:model:<url>): иначе соседний процесс мог бы
+переключить голос между infer_set и infer_convert. Без lock_url инстансы считаются
+закреплёнными за этим процессом: замок и отметка — в его памяти.
+"""
+
+import itertools
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+import requests
+
+
+class RvcInstance:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        self.loaded_model = None
+        self.completed = 0
+        self.lock_waits = 0  # сколько раз ждали замок, занятый другим процессом
+        self.lock = threading.Lock()
+
+
+# Снять замок, только если он всё ещё наш (мог истечь и достаться другому процессу)
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RvcPool:
+    def __init__(self, urls, shared_dir: str = "", lock_url: str = "", prefix: str = "cheb:"):
+        """
+        shared_dir — каталог, видимый и веб-серверу, и RVC-хостам (например, сетевой диск).
+        Без него входной файл передаётся по локальному пути, как при RvcWebUI на той же машине.
+        lock_url — redis://, если инстансы доступны другим процессам; пусто — только этому.
+        """
+        self.instances = [RvcInstance(url) for url in urls if url.strip()]
+        self.shared_dir = shared_dir
+        self.prefix = prefix
+        self._redis = None
+        if lock_url:
+            import redis
+
+            self._redis = redis.from_url(lock_url, decode_responses=True)
+        self._rr = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def exclusive(self) -> bool:
+        return self._redis is None
+
+    @contextmanager
+    def hold(self, instance: RvcInstance, timeout: float):
+        """
+        Инстанс в единоличном пользовании на время infer_set + infer_convert: замок процесса
+        и, при общих инстансах, замок в Redis. Срок замка в Redis — timeout с запасом,
+        чтобы упавший процесс не держал инстанс вечно.
+        """
+        with instance.lock:
+            if self._redis is None:
+                yield
+                return
+            key = f"{self.prefix}rvc:lock:{instance.url}"
+            token = uuid.uuid4().hex
+            deadline = time.monotonic() + timeout
+            waited = False
+            while not self._redis.set(key, token, nx=True, px=int((timeout + 10) * 1000)):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{instance.url} занят другим воркером дольше {timeout:.0f} с")
+                waited = True
+                time.sleep(0.05)
+            if waited:
+                instance.lock_waits += 1
+            try:
+                yield
+            finally:
+                self._redis.eval(_RELEASE_SCRIPT, 1, key, token)
+
+    def mark_loaded(self, instance: RvcInstance, model_name: Optional[str]):
+        """Отметка выбранного голоса; вызывать под hold()"""
+        instance.loaded_model = model_name
+        if self._redis is not None:
+            key = f"{self.prefix}rvc:model:{instance.url}"
+            if model_name:
+                self._redis.set(key, model_name)
+            else:
+                self._redis.delete(key)
+
+    def acquire(self, model_name: str) -> RvcInstance:
+        with self._lock:
+            offset = next(self._rr)
+            count = len(self.instances)
+            ordered = [self.instances[(offset + i) % count] for i in range(count)]
+            instance = min(ordered, key=lambda inst: (inst.in_flight, inst.loaded_model != model_name))
+            instance.in_flight += 1
+            return instance
+
+    def needs_select(self, instance: RvcInstance, model_name: str) -> bool:
+        """Нужен ли infer_set перед переозвучкой на instance; вызывать под hold()"""
+        if self._redis is not None:
+            # Голос мог переключить другой процесс — верна только общая отметка
+            instance.loaded_model = self._redis.get(f"{self.prefix}rvc:model:{instance.url}")
+        return instance.loaded_model != model_name
+
+    def acquire_idle(self, model_name: str) -> Optional[RvcInstance]:
+        """
+        Свободный инстанс, чтобы выбрать голос заранее. None — голос уже выбран на каком-то инстансе
+        или свободных нет. Единственную копию другого голоса не вытесняем.
+        При общих с другими процессами инстансах выбор заранее бесполезен — всегда None.
+        """
+        if not self.exclusive:
+            return None
+        with self._lock:
+            loaded = [inst.loaded_model for inst in self.instances]
+            if model_name in loaded:
+                return None
+            idle = sorted((inst for inst in self.instances if inst.in_flight == 0),
+                          key=lambda inst: inst.loaded_model is not None)
+            for instance in idle:
+                if instance.loaded_model is None or loaded.count(instance.loaded_model) > 1:
+                    instance.in_flight += 1
+                    return instance
+            return None
+
+    def release(self, instance: RvcInstance):
+        with self._lock:
+            instance.in_flight -= 1
+            instance.completed += 1
+
+    def stage_input(self, input_audio: str) -> str:
+        """Путь к входному файлу (аудио или f0-кривой), доступный RVC-хосту"""
+        if not self.shared_dir:
+            return input_audio
+        os.makedirs(self.shared_dir, exist_ok=True)
+        extension = os.path.splitext(input_audio)[1] or ".wav"
+        shared_path = os.path.join(self.shared_dir, f"{uuid.uuid4().hex}{extension}")
+        shutil.copy(input_audio, shared_path)
+        return shared_path
+
+    def fetch_result(self, instance: RvcInstance, result_path: str, output_audio: str, timeout: float):
+        """Забираем результат: локально, если файл виден, иначе через файловый эндпоинт Gradio"""
+        if os.path.exists(result_path):
+            shutil.copy(result_path, output_audio)
+            return
+        response = requests.get(f"{instance.url}/file={result_path}", timeout=timeout)
+        response.raise_for_status()
+        with open(output_audio, "wb") as f:
+            f.write(response.content)
+
+    def cleanup_input(self, staged_path: str, input_audio: str):
+        if staged_path != input_audio and os.path.exists(staged_path):
+            os.remove(staged_path)
+
+    def snapshot(self) -> list:
+        return [
+            {"url": inst.url, "in_flight": inst.in_flight, "loaded_model": inst.loaded_model,
+             "completed": inst.completed, "lock_waits": inst.lock_waits}
+            for inst in self.instances
+        ]
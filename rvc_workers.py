@@ -0,0 +1,147 @@
+"""
+Переозвучка ONNX в отдельных процессах (RVC_ONNX_WORKERS > 0) с передачей звука через pcm_shm.
+
+В процессе веб-сервера ONNX Runtime делит ядра CPU с event loop и обработкой остальных
+запросов, а при переносе в процессы массивы пришлось бы сериализовать через пайпы.
+Здесь воркеру уходят только имена сегментов и числа: вход (16 кГц) он читает из общей памяти
+как numpy-массив, результат пишет в выходной слот, который веб-сервер отдаёт в stdin ffmpeg.
+
+Пул создаётся при первой переозвучке. Воркеры запускаются через spawn: fork процесса с event
+loop и фоновыми потоками небезопасен. Под gunicorn главный модуль — сам gunicorn, и воркер
+импортирует только rvc_workers/rvc_onnx; при `python server.py` spawn заново импортирует
+server.py (как и перезапуск uvicorn с reload=True). Модели в воркере грузятся один раз
+(rvc_onnx.get_converter). Если воркер упал, пул пересоздаётся при следующем вызове,
+а текущая реплика уходит в запасной путь (голос TTS).
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pcm_shm
+
+RVC_ONNX_WORKERS = int(os.environ.get("RVC_ONNX_WORKERS", "0"))
+# Результат генератора длиннее входа в tgt_sr / 16000 раз; слот выделяется с запасом под 48 кГц
+INPUT_RATE = 16000
+MAX_OUTPUT_RATE = 48000
+
+log = logging.getLogger("rvc_workers")
+
+
+def _init_worker():
+    import logs
+    logs.setup_logging()
+
+
+def _load(model_name: str):
+    import rvc_onnx
+
+    rvc_onnx.get_converter(model_name)
+
+
+def _convert(model_name: str, has_index: bool, in_name: str, in_frames: int, out_name: str, out_capacity: int,
+             f0_up_key: int, f0_method: str, index_rate: float, protect: float):
+    """Выполняется в воркере: (число отсчётов результата, частота)"""
+    import rvc_onnx
+
+    converter = rvc_onnx.get_converter(model_name)
+    source = pcm_shm.attach(in_name)
+    target = pcm_shm.attach(out_name)
+    try:
+        audio = pcm_shm.open_array(source, in_frames)
+        result = converter.convert_array(audio, f0_up_key, f0_method, index_rate, protect, use_index=has_index)
+        del audio
+        if len(result) > out_capacity:
+            raise ValueError(f"результат ({len(result)} отсчётов) не помещается в слот ({out_capacity})")
+        out = pcm_shm.open_array(target, len(result))
+        out[:] = result
+        del out
+        return len(result), converter.tgt_sr
+    finally:
+        pcm_shm.detach(in_name, source)
+        pcm_shm.detach(out_name, target)
+
+
+class RvcWorkerPool:
+    def __init__(self, workers: int, arena: pcm_shm.PcmArena):
+        self.workers = workers
+        self.arena = arena
+        self._executor = None
+        self._lock = threading.Lock()
+        self.restarts = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+                )
+            return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self.restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def convert(self, source: pcm_shm.PcmLease, model_name: str, has_index: bool = True,
+                      f0_up_key: int = 0, f0_method: str = "yin", index_rate: float = 0.75,
+                      protect: float = 0.33) -> pcm_shm.PcmLease:
+        """
+        source — моно 16 кГц в общей памяти. Возвращает lease с результатом;
+        освобождает его вызывающий.
+        """
+        if source.sample_rate != INPUT_RATE:
+            raise ValueError(f"на вход нужен {INPUT_RATE} Гц, а не {source.sample_rate}")
+        out_capacity = source.frames * MAX_OUTPUT_RATE // INPUT_RATE + MAX_OUTPUT_RATE // 10
+        target = self.arena.acquire(out_capacity, owner=f"rvc:{model_name}")
+        executor = self._get_executor()
+        try:
+            future = executor.submit(
+                _convert, model_name, has_index, source.name, source.frames, target.name,
+                target.capacity, f0_up_key, f0_method, index_rate, protect,
+            )
+            # При отмене запроса воркер доделывает реплику: слоты вернутся в кольцо только после него
+            source.hold_until(future)
+            target.hold_until(future)
+            frames, sample_rate = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            log.warning("Воркер переозвучки упал, пул будет пересоздан")
+            self._reset(executor)
+            target.release()
+            raise
+        except BaseException:
+            target.release()
+            raise
+        target.frames, target.sample_rate = frames, sample_rate
+        return target
+
+    async def warm_up(self, model_name: str):
+        """
+        Запустить процессы пула и загрузить модель заранее. Загрузит её один из воркеров (какой —
+        решает пул), но главное — первая реплика не ждёт запуска процессов.
+        """
+        executor = self._get_executor()
+        try:
+            await asyncio.wrap_future(executor.submit(_load, model_name))
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise
+
+    def snapshot(self) -> dict:
+        return {"workers": self.workers, "running": self._executor is not None, "restarts": self.restarts}
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,177 @@
+"""
+Быстрая сериализация: NDJSON-события чата и большие JSON-payload'ы с картинками.
+
+- orjson, если установлен (иначе стандартный json с тем же интерфейсом);
+- типизированные события stt_partial/stt/filler/final/error;
+- тело запроса к OpenRouter собирается без экранирования многомегабайтного base64;
+- картинка из ответа OpenRouter вынимается потоково: base64 декодируется по мере чтения,
+  весь документ не превращается в Python-объекты.
+"""
+
+import base64
+import binascii
+from dataclasses import dataclass, asdict
+from typing import Iterable, Optional
+
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(data):
+        return orjson.loads(data)
+
+except ImportError:  # pragma: no cover - запасной путь без orjson
+    import json
+
+    def dumps(obj) -> bytes:
+        if hasattr(obj, "__dataclass_fields__"):
+            obj = asdict(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
+
+
+# ==================== СОБЫТИЯ ЧАТА ====================
+
+@dataclass
+class SttPartialEvent:
+    user_text: str
+    type: str = "stt_partial"
+
+
+@dataclass
+class SttEvent:
+    user_text: str
+    type: str = "stt"
+
+
+@dataclass
+class FillerEvent:
+    text: str
+    audio_base64: str
+    duration: float
+    type: str = "filler"
+
+
+@dataclass
+class FinalEvent:
+    reply_text: str
+    audio_base64: str
+    type: str = "final"
+
+
+@dataclass
+class ErrorEvent:
+    message: str
+    retry_after: Optional[int] = None
+    type: str = "error"
+
+
+def ndjson_line(event) -> bytes:
+    """Строка NDJSON для StreamingResponse"""
+    return dumps(event) + b"\n"
+
+
+def event_text(event) -> str:
+    """Текстовый кадр для WebSocket (клиент делает JSON.parse)"""
+    return dumps(event).decode("utf-8")
+
+
+# ==================== БОЛЬШИЕ PAYLOAD'Ы С КАРТИНКАМИ ====================
+
+_PLACEHOLDER = "__IMAGE_BASE64_PLACEHOLDER__"
+
+
+def build_image_edit_request(model: str, prompt: str, image_base64: bytes, mime: str = "image/png") -> bytes:
+    """
+    Тело chat/completions с картинкой. base64 не содержит символов, требующих экранирования,
+    поэтому вставляется в готовый JSON как есть, без прохода сериализатора по мегабайтам.
+    """
+    payload = {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{_PLACEHOLDER}"}},
+                    {"type": "text", "text": prompt},
+                ],
+            }
+        ],
+    }
+    head, tail = dumps(payload).split(_PLACEHOLDER.encode("ascii"))
+    return b"".join((head, image_base64, tail))
+
+
+class ImageExtractionError(ValueError):
+    """В ответе нет картинки в формате data:image/...;base64"""
+
+
+def extract_image_from_stream(chunks: Iterable[bytes], max_prefix: int = 1 << 20) -> bytes:
+    """
+    Потоково вынимает первую картинку из choices[0].message.images ответа OpenRouter.
+    base64 декодируется кусками, кратными 4 символам, — в памяти одновременно только
+    декодированный результат и небольшой хвост.
+    """
+    marker_images = b'"images"'
+    marker_data = b"data:image"
+    marker_b64 = b";base64,"
+
+    state = "images"
+    prefix = b""       # непросмотренный текст до начала base64
+    carry = b""        # недекодированный остаток base64 (< 4 символов)
+    out = bytearray()
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if state != "data":
+            prefix += chunk
+            if state == "images":
+                pos = prefix.find(marker_images)
+                if pos < 0:
+                    # Небольшой ответ держим целиком (для текста ошибки), большой — только хвост
+                    if len(prefix) > max_prefix:
+                        prefix = prefix[-len(marker_images):]
+                    continue
+                prefix = prefix[pos + len(marker_images):]
+                state = "header"
+            if state == "header":
+                pos = prefix.find(marker_data)
+                end = prefix.find(marker_b64, pos) if pos >= 0 else -1
+                if end < 0:
+                    continue
+                chunk = prefix[end + len(marker_b64):]
+                prefix = b""
+                state = "data"
+
+        quote = chunk.find(b'"')
+        piece = chunk if quote < 0 else chunk[:quote]
+        if b"\\" in piece:
+            # Некоторые сериализаторы экранируют "/" как "\/"
+            piece = piece.replace(b"\\", b"")
+        data = carry + piece
+        usable = len(data) - len(data) % 4
+        try:
+            out += base64.b64decode(data[:usable])
+        except binascii.Error as e:
+            raise ImageExtractionError(f"Повреждённый base64: {e}")
+        carry = data[usable:]
+        if quote >= 0:
+            if carry:
+                out += base64.b64decode(carry + b"=" * (-len(carry) % 4))
+            return bytes(out)
+
+    raise ImageExtractionError(_describe_prefix(prefix) if state != "data" else "Ответ оборван посреди картинки")
+
+
+def _describe_prefix(prefix: bytes) -> str:
+    """Короткое описание ответа без картинки — для логов и текста ошибки"""
+    try:
+        message = loads(prefix)["choices"][0]["message"]
+        return f"В ответе нет images: {list(message.keys())}"
+    except Exception:
+        return "Неверный формат ответа API"
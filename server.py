@@ -9,10 +9,9 @@ import requests
 import torch
 import soundfile as sf
 import time
-import json
 from pathlib import Path
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import StreamingResponse, FileResponse, HTMLResponse, Response
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import StreamingResponse, FileResponse, HTMLResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
@@ -21,11 +20,90 @@ import uvicorn
 import fairseq
 import random
 import shutil
+import asyncio
+import uuid
+from urllib.parse import urlsplit
+from contextlib import aclosing
+from stt_stream import FfmpegTranscoder, create_recognizer
+from response_cache import ResponseCache
+from resilience import Resilience, CircuitOpenError
+from admission import AdmissionController, AdmissionRejected, current_priority, PRIORITY_BACKGROUND
+from shared_state import create_state
+from rvc_pool import RvcPool
+from pitch import LOCAL_METHODS, choose_f0_method, prepare_f0_file
+from rvc_index import rvcwebui_index_path
+from rvc_onnx import onnx_convert
+import pcm_shm
+from rvc_workers import RvcWorkerPool, RVC_ONNX_WORKERS
+from conversation import ConversationContext, format_for_summary
+from filler import FillerBank
+from characters import CharacterRegistry
+import rvc_onnx
+import ar_targets
+import audio_sprites
+from asset_build import AssetManifest, precompressed_file
+from logs import setup_logging, get_logger, begin_request, bind, record_stage, stage_timings, StageTimer
+import logs
+import profiling
+from profiling import span
+from starlette.datastructures import Headers, QueryParams
+from photo_preview import compose_preview, warm_up as warm_up_photo_preview
+from photo_output import render_photo, render_image, choose_format
+from serialization import (
+    SttEvent, SttPartialEvent, FillerEvent, FinalEvent, ErrorEvent, ndjson_line, event_text, loads,
+    build_image_edit_request, extract_image_from_stream, ImageExtractionError,
+)
 
 torch.serialization.add_safe_globals([fairseq.data.dictionary.Dictionary])
 
+# Логи уходят в фоновый поток через очередь (logs.py), print на горячем пути не используется
+setup_logging()
+log = get_logger("server")
+
 app = FastAPI(title="Cheburashka AI with Nano Banana")
 
+class ProfilingMiddleware:
+    """
+    Профиль одного запроса по заголовку X-Profile / ?profile= (см. profiling.py).
+    ASGI-обёртка, а не BaseHTTPMiddleware: для стриминга и WebSocket след закрывается
+    только после последнего отправленного байта. Без флага — одна проверка заголовка.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        mode = profiling.requested_mode(headers, QueryParams(scope.get("query_string", b"")))
+        if mode is None:
+            return await self.app(scope, receive, send)
+
+        # Тот же id попадает в логи (begin_request берёт его из заголовка) и в имена файлов профиля,
+        # поэтому id клиента принимается только из безопасных символов
+        request_id = profiling.safe_id(headers.get("x-request-id")) or uuid.uuid4().hex[:12]
+        scope["headers"] = [(k, v) for k, v in scope["headers"] if k != b"x-request-id"]
+        scope["headers"].append((b"x-request-id", request_id.encode("latin-1")))
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1")),
+                    (b"access-control-expose-headers", b"X-Request-ID"),
+                ]
+            await send(message)
+
+        profile = profiling.start_request(mode, request_id, f"{scope.get('method', 'WS')} {scope['path']}")
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profile.stop()
+            paths = await asyncio.to_thread(profile.write)
+            log.info("Профиль запроса %s (%s): %s", request_id, mode, ", ".join(paths),
+                     extra={"profile_files": paths})
+
+app.add_middleware(ProfilingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -41,77 +119,181 @@ FOLDER_ID = ""
 # OpenRouter API credentials
 OPENROUTER_API_KEY = ""  # Получить на https://openrouter.ai/
 
-# Промпты для редактирования изображений для каждого персонажа
-IMAGE_EDIT_PROMPTS = {
-    "cheb": "Удали фон у всех людей и фигур на фото и помести их в мир мультика Чебурашка. Фон должен быть уютным и добрым, в стиле советского мультфильма про Чебурашку. При необходимости перемести фигуры так, чтобы они стояли на полу и были вписаны в окружение. Чебурашка на фото уже есть, не добавляй еще одного.",
-    "gena": "Удали фон у всех людей и фигур на фото и помести их в мир Крокодила Гены из кукольного мультфильма Чебурашка. Объемная кукольная анимация с картонными декорациями. Зоопарк или вечерние или утренние  улицы кукольного советского города. Красивое освещение, не тусклая картинка. Интеллигентная, слегка меланхоличная атмосфера. Гена носит костюм и шляпу, работает в зоопарке. Можно показать голубой вагон. При необходимости перемести фигуры так, чтобы они стояли на полу и были вписаны в окружение. Крокодил Гена на фото уже есть, не добавляй еще одного. Чебурашку тоже не добавляй.",
-    "shap": "Удали фон у всех людей и фигур на фото и помести их в мир Старухи Шапокляк из кукольного мультфильма Чебурашка. Объемная кукольная анимация с картонными декорациями. Темные подъезды, дворы, заброшенные уголки. Контрастное освещение, драматичные серо-коричневые тона с яркими акцентами. Озорная хулиганская атмосфера приключений и проказ. При необходимости перемести фигуры так, чтобы они стояли на полу и были вписаны в окружение. Старуха Шапокляк на фото уже есть, не добавляй еще одну.",
-    "volc": "Удали фон у всех людей и фигур на фото и помести их в мир рисованного мультфильма Ну, погоди! Классическая рисованная советская анимация. Фон должен быть динамичным и ярким, в стиле советского мультфильма. Яркие насыщенные цвета, четкие черные контуры, плоскостная графика. Советская среда. При необходимости перемести фигуры так, чтобы они стояли на полу и были вписаны в окружение. Но обязательно чтобы выглядело хорошо. Волк на фото уже есть, не добавляй еще одного."
+# Адреса внешних сервисов. Переопределяются через окружение, например на mock_backends.py для локальных тестов
+YANDEX_STT_URL = os.environ.get("YANDEX_STT_URL", "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize")
+YANDEX_LLM_URL = os.environ.get("YANDEX_LLM_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+YANDEX_TTS_URL = os.environ.get("YANDEX_TTS_URL", "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize")
+OPENROUTER_URL = os.environ.get("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+RVC_URL = os.environ.get("RVC_URL", "http://localhost:7897")
+
+# ==================== PRODUCTION / MULTI-WORKER ====================
+# RUN_MODE=production запускает несколько воркеров без reload (см. __main__ и gunicorn.conf.py)
+RUN_MODE = os.environ.get("RUN_MODE", "dev")
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# redis://host:6379/0 — история и кеш ответов общие для всех воркеров; пусто — память процесса
+# (только при одном воркере: с несколькими сервер не стартует)
+SHARED_STATE_URL = os.environ.get("SHARED_STATE_URL", "")
+# Инстансы RvcWebUI через запятую; запросы распределяются по наименьшей загрузке
+RVC_URLS = os.environ.get("RVC_URLS", RVC_URL).split(",")
+# Общий каталог для входных wav, если RVC работает на другой машине
+RVC_SHARED_DIR = os.environ.get("RVC_SHARED_DIR", "")
+
+state = create_state(SHARED_STATE_URL, workers=WORKERS)
+# С общим состоянием (несколько воркеров или машин) инстансы RvcWebUI общие: выбор голоса
+# и переозвучка идут под замком в Redis. Без него инстансы закреплены за этим процессом
+rvc_pool = RvcPool(RVC_URLS, RVC_SHARED_DIR, lock_url=SHARED_STATE_URL)
+
+# Политики таймаутов/хеджирования/предохранителей для каждого внешнего вызова
+upstream = Resilience()
+upstream.register("yandex_stt", min_timeout=3, max_timeout=20, default_latency=1.5, hedge=True, slow_call=10)
+upstream.register("yandex_llm", min_timeout=4, max_timeout=30, default_latency=3, hedge=True, slow_call=15)
+upstream.register("yandex_tts", min_timeout=3, max_timeout=20, default_latency=1.5, hedge=True, slow_call=10)
+# RVC и Nano Banana не дублируем: это тяжёлые (и платные) вызовы, только таймаут и предохранитель
+upstream.register("rvc", min_timeout=5, max_timeout=45, default_latency=6, max_retries=0, slow_call=30)
+upstream.register("nano_banana", min_timeout=15, max_timeout=60, default_latency=20, max_retries=0, slow_call=50)
+
+# Общий клиент чата: соединения с Yandex живут между запросами, TLS-рукопожатие — не на каждую реплику
+http_client = httpx.AsyncClient(timeout=120.0, limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60))
+
+# Контроль допуска: частота запросов на устройство (токенов/сек, burst) по эндпоинтам.
+# Корзины живут в каждом воркере, а запросы устройства расходятся по воркерам, поэтому скорость делится
+RATE_LIMITS = {
+    "chat": (0.2 / WORKERS, 5),
+    "remove": (0.1 / WORKERS, 3),
+    "warmup": (0.5 / WORKERS, 4),
 }
+# Одновременных задач и максимальная очередь на каждый этап конвейера
+STAGE_LIMITS = {
+    "stt": (16, 32),
+    "llm": (16, 32),
+    "tts": (16, 32),
+    "rvc": (2, 8),
+    "image": (4, 8),
+}
+admission = AdmissionController(RATE_LIMITS, STAGE_LIMITS)
+
+# Платных вызовов Nano Banana в сутки; сверх бюджета фото делается локально
+NANO_BANANA_DAILY_BUDGET = int(os.environ.get("NANO_BANANA_DAILY_BUDGET", "1000"))
+# Сколько хранится результат фоновой стилизации для /remove/result
+PHOTO_JOB_TTL = 600
+
+
+class BudgetExceeded(Exception):
+    """Дневной бюджет платного сервиса исчерпан"""
+
+# Потоковый STT для /api/chat-ws: "yandex" (SpeechKit v3 gRPC) или "mock" для локальных тестов
+STT_STREAMING_BACKEND = os.environ.get("STT_STREAMING_BACKEND", "yandex")
 
 RVC_DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
 
-TTS_VOICES = {
-    "cheb": "alena",
-    "gena": "ermil",
-    "shap": "jane",
-    "volc": "filipp"
-}
+# Голос, модель RVC, промпты, бюджет контекста и заполнители персонажей — в characters.json.
+# rvc.f0_method — извлечение основного тона: метод RvcWebUI (pm/harvest/crepe/rmvpe)
+# или локальный из pitch.py (yin/autocorr). Под нагрузкой RVC понижается до более быстрого.
+# rvc.backend — "rvcwebui" (пул RVC_URLS) или "onnx" (после `python export_onnx.py export`).
+# Файл перечитывается на лету; прогреваются только изменившиеся персонажи.
+characters = CharacterRegistry()
+ADAPTIVE_F0 = os.environ.get("ADAPTIVE_F0", "1") == "1"
+# RVC_ONNX_WORKERS > 0 — "onnx" переозвучивается в отдельных процессах, звук передаётся через общую память
+pcm_arena = pcm_shm.PcmArena()
+rvc_workers = RvcWorkerPool(RVC_ONNX_WORKERS, pcm_arena)
 
-RVC_MODELS = {
-    "cheb": {"model": "cheb", "has_index": True},
-    "gena": {"model": "gena", "has_index": True},
-    "shap": {"model": "shap", "has_index": True},
-    "volc": {"model": "volc", "has_index": False}
-}
+class OptimizedStaticFiles(StaticFiles):
+    """/assets/...: облегчённый вариант из build/assets (asset_build.py), иначе исходный файл"""
 
-SYSTEM_PROMPTS = {
-    "cheb": "Ты — Чебурашка. Отвечай дружелюбно, коротко и по-детски.",
-    "gena": "Ты — Крокодил Гена. Отвечай вежливо, рассудительно и немного меланхолично, как в мультфильме. Обращайся к собеседнику 'мой друг'.",
-    "shap": "Ты — Старуха Шапокляк. Отвечай вредно, с сарказмом, поучай и иногда хихикай.",
-    "volc": "Ты — Волк из 'Ну, погоди!'. Отвечай немного грубовато, но с юмором, и можешь в конце добавить 'Ну, Заяц, погоди!'"
-}
+    def __init__(self, *args, manifest: AssetManifest, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest = manifest
+
+    async def get_response(self, path: str, scope):
+        headers = Headers(scope=scope)
+        resolved = self.manifest.resolve(path.replace(os.sep, "/"), headers.get("accept-encoding", ""))
+        if resolved is None:
+            return await super().get_response(path, scope)
+        file_path, media_type, response_headers = resolved
+        if headers.get("if-none-match") == response_headers["ETag"]:
+            return Response(status_code=304, headers=response_headers)
+        return FileResponse(file_path, media_type=media_type, headers=response_headers)
 
 if os.path.exists("assets"):
-    app.mount("/assets", StaticFiles(directory="assets"), name="assets")
+    app.mount("/assets", OptimizedStaticFiles(directory="assets", manifest=AssetManifest()), name="assets")
 
 INDEX_PATH = "index.html"
 
-sessions = {}
+# Жёсткий предел хранимой истории; размер промпта ограничивает бюджет токенов (conversation.py)
+HISTORY_MAX_MESSAGES = 40
 
-def add_to_history(device_id: str, character: str, role: str, text: str):
+# Токенов на весь запрос к LLM (системный промпт + сводка + реплики + запас под ответ) — context_budget
+conversation = ConversationContext(state, characters.current.context_budgets())
+
+# Реплики-заполнители голосом персонажа сразу после STT (filler.py)
+FILLER_ENABLED = os.environ.get("FILLER_ENABLED", "1") == "1"
+# Срок клипа в общем состоянии: клипы прежней ревизии голоса не копятся в Redis
+FILLER_CLIP_TTL = float(os.environ.get("FILLER_CLIP_TTL", str(7 * 86400)))
+filler_bank = FillerBank(state, characters.current.filler_phrases(), characters.current.voice_revisions(),
+                         clip_ttl=FILLER_CLIP_TTL)
+
+background_tasks = set()
+
+def spawn(coro):
+    """Фоновая задача со ссылкой на неё, чтобы её не собрал GC"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Кеш ответов на частые вопросы: порог похожести триграмм и время жизни записи
+RESPONSE_CACHE_THRESHOLD = 0.82
+RESPONSE_CACHE_TTL = 6 * 3600
+response_cache = ResponseCache(threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL, shared=state,
+                               revision=lambda character: characters.get(character).revision)
+
+# Вопросы, ответы на которые заранее готовятся (текст + озвучка) при старте сервера
+FREQUENT_QUESTIONS = [
+    "Как тебя зовут?",
+    "Где купить билеты?",
+    "Что тут есть?",
+]
+PREFETCH_FREQUENT_ANSWERS = True
+
+# ==================== ПРОГРЕВ ПО AR-МЕТКЕ ====================
+# Клиент шлёт /api/warmup, как только камера нашла скульптуру: пока посетитель тянется к записи,
+# сервер открывает соединения, выбирает голос, готовит ответ на приветствие и контекст сессии
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+WARMUP_GREETING = os.environ.get("WARMUP_GREETING", "Привет!")
+# Одновременных прогревов в воркере; лишние сигналы отбрасываются, а не ждут
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY", "2"))
+# Персонаж (соединения, голос, приветствие) и пара устройство+персонаж прогреваются не чаще, сек
+WARMUP_INTERVAL = float(os.environ.get("WARMUP_INTERVAL", "30"))
+# Выше этой загрузки этапа (см. StageLimiter.load) синтез приветствия и выбор голоса пропускаются
+WARMUP_MAX_LOAD = float(os.environ.get("WARMUP_MAX_LOAD", "0.5"))
+warmup_stats = {"requested": 0, "started": 0, "deduplicated": 0, "busy": 0, "failed": 0, "running": 0}
+_warmed_characters = {}  # персонаж -> time.monotonic() последнего прогрева
+_preconnected = {}  # https://host -> time.monotonic()
+
+async def add_to_history(device_id: str, character: str, role: str, text: str):
     """Добавить сообщение в историю конкретного персонажа"""
-    if device_id not in sessions:
-        sessions[device_id] = {}
-    
-    if character not in sessions[device_id]:
-        sessions[device_id][character] = []
-    
-    sessions[device_id][character].append({"role": role, "text": text})
-    
-    if len(sessions[device_id][character]) > 10:
-        sessions[device_id][character].pop(0)
+    await state.append_history(device_id, character, {"role": role, "text": text}, HISTORY_MAX_MESSAGES)
 
-def get_history(device_id: str, character: str) -> list:
-    """Получить историю конкретного персонажа"""
-    if device_id not in sessions or character not in sessions[device_id]:
-        return []
-    return sessions[device_id][character]
+async def get_history(device_id: str, character: str) -> list:
+    """Получить историю конкретного персонажа (копия)"""
+    return await state.get_history(device_id, character)
 
 # ==================== HELPER FUNCTIONS ====================
 
-def run_cmd(cmd):
-    """Run shell command, raise on error, return stdout"""
-    print("RUN:", " ".join(cmd))
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def run_cmd(cmd, input=None):
+    """Run shell command, raise on error, return stdout (input — bytes-like для stdin)"""
+    log.debug("RUN: %s", " ".join(cmd))
+    with span(f"cmd:{os.path.basename(cmd[0])}"):
+        proc = subprocess.run(cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if proc.returncode != 0:
-        print("ERROR:", proc.stderr.decode('utf-8', errors='ignore'))
+        log.error("Команда завершилась с ошибкой: %s", proc.stderr.decode('utf-8', errors='ignore'),
+                  extra={"cmd": cmd[0]})
         raise RuntimeError("Command failed")
     return proc.stdout
 
 def webm_to_ogg(input_path: str, out_ogg: str, sample_rate=48000):
     """Конвертируем webm -> OGG Opus для Yandex STT через ffmpeg."""
-    print("Converting", input_path, "->", out_ogg)
+    log.debug("Converting %s -> %s", input_path, out_ogg)
     cmd = [
         "ffmpeg", "-y", "-i", input_path,
         "-acodec", "libopus",
@@ -120,7 +302,23 @@ def webm_to_ogg(input_path: str, out_ogg: str, sample_rate=48000):
         out_ogg
     ]
     run_cmd(cmd)
-    print("Converted to", out_ogg)
+
+def rvc_select_voice(instance, model_name: str, protect: float = 0.33, timeout: float = 30):
+    """Выбор голоса (infer_set) на инстансе RvcWebUI; вызывать под rvc_pool.hold()"""
+    log.info("Выбираем голос: %s.pth на %s", model_name, instance.url, extra={"verbose": True})
+    response = requests.post(f"{instance.url}/run/infer_set", json={
+        "data": [
+            f"{model_name}.pth",
+            protect,
+            protect
+        ]
+    }, timeout=min(30, timeout))
+
+    if response.status_code != 200 or response.json().get('data') is None:
+        rvc_pool.mark_loaded(instance, None)
+        raise RuntimeError(f"Не удалось выбрать голос {model_name}")
+
+    rvc_pool.mark_loaded(instance, model_name)
 
 def rvc_convert_infer(
     input_audio: str,
@@ -133,59 +331,55 @@ def rvc_convert_infer(
     filter_radius: int = 3,
     resample_sr: int = 0,
     rms_mix_rate: float = 0.25,
-    protect: float = 0.33
+    protect: float = 0.33,
+    timeout: float = 120,
+    f0_file: str = None
 ):
-    """RVC конвертация через RvcWebUI localhost API."""
+    """
+    RVC конвертация через пул инстансов RvcWebUI (см. RVC_URLS).
+    f0_file — готовая кривая основного тона (pitch.write_f0_file), заменяет кривую f0_method.
+    """
+    model_name = model_path
+    instance = rvc_pool.acquire(model_name)
+    staged_input = input_audio
+    staged_f0 = f0_file
     try:
-        model_name = model_path
-        
-        # 1. Очистка кеша RVC
-        # print("Очищаем кеш RVC...")
-        # response = requests.post("http://localhost:7897/run/infer_clean", json={
-        #     "data": []
-        # }, timeout=30)
-        
-        # if response.status_code != 200 or response.json().get('data') is None:
-        #     print("Предупреждение: не удалось очистить кеш RVC")
-        # else:
-        #     print("Кеш успешно очищен")
-        
-        # 2. Выбор голоса (модели)
-
-        print(f"Выбираем голос: {model_name}.pth")
-        response = requests.post("http://localhost:7897/run/infer_set", json={
-            "data": [
-                f"{model_name}.pth",
-                protect,
-                protect
-            ]
-        }, timeout=30)
-        
-        if response.status_code != 200 or response.json().get('data') is None:
-            raise RuntimeError(f"Не удалось выбрать голос {model_name}")
-        
-        print("Голос успешно выбран")
-        
-        print(f"Запускаем переозвучку через RvcWebUI...")
-        
-        index_file_path = f"logs/{model_name}.index" if index_path else ""
-        
-        response = requests.post("http://localhost:7897/run/infer_convert", json={
-            "data": [
-                f0_up_key,
-                input_audio,
-                0,
-                None,
-                f0_method,
-                "",
-                index_file_path,
-                index_rate,
-                filter_radius,
-                resample_sr,
-                rms_mix_rate,
-                protect,
-            ]
-        }, timeout=120)
+        staged_input = rvc_pool.stage_input(input_audio)
+        if f0_file:
+            staged_f0 = rvc_pool.stage_input(f0_file)
+
+        # Выбор голоса и переозвучка должны идти подряд на одном инстансе, без вмешательства других процессов
+        with rvc_pool.hold(instance, timeout):
+            # 1. Очистка кеша RVC
+            # print("Очищаем кеш RVC...")
+            # response = requests.post(f"{instance.url}/run/infer_clean", json={
+            #     "data": []
+            # }, timeout=30)
+            
+            # 2. Выбор голоса (модели), если на инстансе выбран другой
+            if rvc_pool.needs_select(instance, model_name):
+                rvc_select_voice(instance, model_name, protect, timeout)
+            
+            log.debug("Запускаем переозвучку через RvcWebUI (%s)", instance.url)
+            
+            index_file_path = rvcwebui_index_path(model_name) if index_path else ""
+            
+            response = requests.post(f"{instance.url}/run/infer_convert", json={
+                "data": [
+                    f0_up_key,
+                    staged_input,
+                    0,
+                    {"name": staged_f0, "data": None, "is_file": True} if staged_f0 else None,
+                    f0_method,
+                    "",
+                    index_file_path,
+                    index_rate,
+                    filter_radius,
+                    resample_sr,
+                    rms_mix_rate,
+                    protect,
+                ]
+            }, timeout=timeout)
         
         if response.status_code != 200 or response.json().get('data') is None:
             raise RuntimeError("Не удалось выполнить переозвучку")
@@ -193,95 +387,654 @@ def rvc_convert_infer(
         result_data = response.json()["data"]
         revoiced_path = result_data[1]["name"]
         
-        print(f"Переозвучка завершена: {revoiced_path}")
+        log.debug("Переозвучка завершена: %s", revoiced_path)
         
-        shutil.copy(revoiced_path, output_audio)
+        rvc_pool.fetch_result(instance, revoiced_path, output_audio, timeout)
         
         return output_audio
         
     except Exception as e:
-        print(f"Error in RVC conversion: {e}")
+        log.warning("Error in RVC conversion on %s: %s", instance.url, e, extra={"rvc_instance": instance.url})
         raise
+    finally:
+        rvc_pool.release(instance)
+        rvc_pool.cleanup_input(staged_input, input_audio)
+        if f0_file:
+            rvc_pool.cleanup_input(staged_f0, f0_file)
 
-def send_to_nano_banana(image_base64: str, prompt: str) -> str:
+def send_to_nano_banana(image_base64: bytes, prompt: str, timeout: float = 60) -> bytes:
     """
     Отправляет изображение в Nano Banana через OpenRouter для редактирования.
-    Возвращает base64 отредактированного изображения.
+    Возвращает байты отредактированного изображения.
+    Тело запроса собирается без сериализации base64, ответ разбирается потоково.
     """
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    url = OPENROUTER_URL
     
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
     }
     
-    payload = {
-        "model": "google/gemini-2.5-flash-image",  # Платная модель
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{image_base64}"
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }
-        ]
-    }
+    body = build_image_edit_request(
+        "google/gemini-2.5-flash-image",  # Платная модель
+        prompt, image_base64
+    )
     
-    print(f"🤖 Отправка в Nano Banana с промптом: {prompt[:100]}...")
+    log.debug("Отправка в Nano Banana с промптом: %s", prompt)
     
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        
-        if response.status_code != 200:
-            print(f"❌ Ошибка API: {response.status_code}")
-            print(f"Ответ: {response.text}")
-            raise HTTPException(status_code=response.status_code, detail=f"OpenRouter API error: {response.text}")
-        
-        result = response.json()
-        
-        # Извлекаем base64 изображения из ответа
-        # Формат: choices[0].message.images[0].image_url.url
-        if "choices" in result and result["choices"]:
-            message = result["choices"][0]["message"]
-            
-            # Проверяем наличие images в ответе
-            if "images" in message and message["images"]:
-                image_url = message["images"][0]["image_url"]["url"]
-                
-                # Формат: data:image/png;base64,<данные>
-                if "base64," in image_url:
-                    base64_data = image_url.split("base64,")[1]
-                    print("✅ Изображение успешно получено от Nano Banana")
-                    return base64_data
-                else:
-                    print("❌ Неверный формат image_url")
-                    raise HTTPException(status_code=500, detail="Invalid image URL format")
-            else:
-                print("❌ В ответе нет images")
-                print(f"Структура ответа: {message.keys()}")
-                raise HTTPException(status_code=500, detail="No images in API response")
-        else:
-            print("❌ Неверный формат ответа API")
-            raise HTTPException(status_code=500, detail="Invalid API response format")
+        with requests.post(url, headers=headers, data=body, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                log.error("Ошибка API OpenRouter: %s %s", response.status_code, response.text[:500])
+                raise HTTPException(status_code=response.status_code, detail=f"OpenRouter API error: {response.text}")
             
+            # Формат: choices[0].message.images[0].image_url.url = data:image/png;base64,<данные>
+            image_bytes = extract_image_from_stream(response.iter_content(chunk_size=256 * 1024))
+        
+        log.info("Изображение получено от Nano Banana", extra={"bytes": len(image_bytes)})
+        return image_bytes
+    
+    except ImageExtractionError as e:
+        log.error("Nano Banana: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
     except requests.exceptions.Timeout:
-        print("❌ Таймаут при обращении к API")
+        log.error("Таймаут при обращении к OpenRouter")
         raise HTTPException(status_code=504, detail="API timeout")
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Ошибка: {e}")
+        log.exception("Ошибка запроса к OpenRouter")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def call_llm(client, messages: list, temperature: float = 0.6, max_tokens: int = 200) -> dict:
+    """Запрос к YandexGPT; возвращает result из ответа"""
+    async with admission.stage("llm"):
+        chat_response = await upstream.call("yandex_llm", lambda: client.post(
+            YANDEX_LLM_URL,
+            headers={"Authorization": f"Api-Key {API_KEY}", "Content-Type": "application/json"},
+            json={
+                "modelUri": f"gpt://{FOLDER_ID}/yandexgpt-lite/latest",
+                "completionOptions": {"stream": False, "temperature": temperature, "maxTokens": str(max_tokens)},
+                "messages": messages
+            },
+            timeout=upstream.timeout_for("yandex_llm")
+        ))
+
+    if chat_response.status_code != 200:
+        raise HTTPException(status_code=chat_response.status_code, detail=chat_response.text)
+
+    return loads(chat_response.content)["result"]
+
+async def request_llm_reply(client, character: str, history: list, user_text: str, summary: str = "") -> str:
+    """Ответ персонажа через YandexGPT с учётом сводки и свежей истории в пределах бюджета"""
+    system_prompt = characters.get(character).system_prompt
+    messages = conversation.build_messages(character, system_prompt, summary, history, user_text)
+
+    with StageTimer("llm", messages=len(messages)):
+        result = await call_llm(client, messages)
+
+    input_tokens = int(result.get("usage", {}).get("inputTextTokens", 0))
+    conversation.observe_usage(messages, input_tokens)
+
+    return result["alternatives"][0]["message"]["text"]
+
+async def summarize_history(character: str, previous_summary: str, messages: list) -> str:
+    """Короткая сводка свёрнутых реплик для контекста следующих ходов"""
+    name = characters.get(character).name
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        result = await call_llm(client, [
+            {"role": "system", "text": (
+                f"Сожми разговор пользователя с персонажем {name} в 2-3 предложения: о чём говорили, "
+                "что пользователь рассказал о себе, о чём договорились. Только факты, без оценок."
+            )},
+            {"role": "user", "text": format_for_summary(previous_summary, messages, name)},
+        ], temperature=0.2, max_tokens=150)
+    return result["alternatives"][0]["message"]["text"]
+
+async def compact_history(device_id: str, character: str):
+    """Фоновая свёртка старых реплик после ответа (не на критическом пути)"""
+    history = await get_history(device_id, character)
+    system_prompt = characters.get(character).system_prompt
+    await conversation.compact(
+        device_id, character, system_prompt, history,
+        lambda previous, fold: summarize_history(character, previous, fold)
+    )
+
+async def prepare_f0(character: str, model_config: dict, tts_wav: str, temp_dir: str):
+    """
+    Метод f0 для RvcWebUI и, для локальных методов, файл с кривой.
+    Под нагрузкой на RVC метод понижается до более быстрого (pitch.F0_LADDER).
+    """
+    preferred = model_config.get("f0_method", "pm")
+    load = admission.stages["rvc"].load
+    method = choose_f0_method(preferred, load) if ADAPTIVE_F0 else preferred
+    if method != preferred:
+        log.info("RVC загружен (%.2f), f0 для %s: %s -> %s", load, character, preferred, method,
+                 extra={"rvc_load": round(load, 2)})
+
+    if method not in LOCAL_METHODS:
+        return method, None
+    try:
+        with StageTimer("f0", method=method):
+            f0_file = await asyncio.to_thread(prepare_f0_file, method, tts_wav, temp_dir)
+        # RvcWebUI всё равно считает свою кривую — берём самую дешёвую, она будет заменена
+        return "pm", f0_file
+    except Exception as e:
+        log.warning("Не удалось извлечь f0 методом %s (%s), используем pm", method, e)
+        return "pm", None
+
+async def convert_voice_onnx(character: str, model_config: dict, tts_ogg: str, temp_dir: str):
+    """
+    Переозвучка через ONNX Runtime (rvc_onnx.py), без RvcWebUI: в процессе (путь к WAV)
+    или в процессах rvc_workers (PcmLease с результатом в общей памяти — освобождает вызывающий).
+    """
+    preferred = model_config.get("f0_method", "yin")
+    f0_method = choose_f0_method(preferred, admission.stages["rvc"].load) if ADAPTIVE_F0 else preferred
+    if rvc_workers.enabled:
+        # Без tts16.wav и rvc_out.wav: ffmpeg отдаёт f32le в stdout, дальше звук живёт в общей памяти
+        pcm = run_cmd(["ffmpeg", "-y", "-i", tts_ogg, "-f", "f32le", "-ar", "16000", "-ac", "1", "pipe:1"])
+        with pcm_arena.acquire(len(pcm) // pcm_shm.SAMPLE_BYTES, owner=f"tts:{character}") as source:
+            source.write(pcm, 16000)
+            del pcm
+            return await rvc_workers.convert(
+                source, model_config["model"], has_index=model_config.get("has_index", False),
+                f0_method=f0_method, index_rate=0.85,
+            )
+    # Кодировщику содержания нужен 16 кГц — ресемплинг силами ffmpeg, а не линейной интерполяцией
+    tts_wav16 = os.path.join(temp_dir, "tts16.wav")
+    run_cmd(["ffmpeg", "-y", "-i", tts_ogg, "-ar", "16000", "-ac", "1", tts_wav16])
+    return await asyncio.to_thread(
+        onnx_convert,
+        input_audio=tts_wav16,
+        output_audio=os.path.join(temp_dir, "rvc_out.wav"),
+        model_name=model_config["model"],
+        has_index=model_config.get("has_index", False),
+        f0_method=f0_method,
+        index_rate=0.85,
+    )
+
+async def synthesize_voice(client, character: str, reply_text: str, temp_dir: str) -> str:
+    """TTS -> RVC -> MP3 в голосе персонажа, результат в base64"""
+    # 5. Text-to-Speech
+    stage_start = time.time()
+
+    # Настройки берутся один раз: перезагрузка реестра посреди реплики не смешает голоса
+    profile = characters.get(character)
+    selected_voice = profile.tts_voice
+    async with admission.stage("tts"):
+        tts_response = await upstream.call("yandex_tts", lambda: client.post(
+            YANDEX_TTS_URL,
+            headers={"Authorization": f"Api-Key {API_KEY}"},
+            data={
+                "text": reply_text, "lang": "ru-RU", "voice": selected_voice,
+                "folderId": FOLDER_ID, "format": "oggopus", "sampleRateHertz": "48000"
+            },
+            timeout=upstream.timeout_for("yandex_tts")
+        ))
+
+    record_stage("tts", time.time() - stage_start, voice=selected_voice)
+
+    if tts_response.status_code != 200:
+        raise HTTPException(status_code=tts_response.status_code, detail=tts_response.text)
+
+    tts_ogg = os.path.join(temp_dir, "tts.ogg")
+    with open(tts_ogg, "wb") as f:
+        f.write(tts_response.content)
+
+    # 7. Конвертируем OGG в WAV для RVC
+    stage_start = time.time()
+
+    tts_wav = os.path.join(temp_dir, "tts.wav")
+    run_cmd(["ffmpeg", "-y", "-i", tts_ogg, "-ar", "40000", "-ac", "1", tts_wav])
+
+    # 8. Применяем RVC с динамической моделью
+    final_audio = tts_wav
+    model_config = profile.rvc
+
+    if model_config and model_config.get("backend") == "onnx":
+        try:
+            async with admission.stage("rvc"):
+                final_audio = await convert_voice_onnx(character, model_config, tts_ogg, temp_dir)
+        except Exception as e:
+            final_audio = tts_wav
+            log.warning("ONNX RVC failed for %s, using TTS output: %s", character, e)
+    elif model_config and not upstream.is_available("rvc"):
+        # Быстрая деградация: RVC сейчас сбоит — сразу отдаём голос TTS, не дожидаясь таймаута
+        log.warning("RVC недоступен (предохранитель разомкнут), для %s используем TTS", character)
+    elif model_config:
+        rvc_out = os.path.join(temp_dir, "rvc_out.wav")
+        try:
+            model_name = model_config["model"]
+            index_name = model_name if model_config.get("has_index", False) else None
+            rvc_timeout = upstream.timeout_for("rvc")
+            f0_method, f0_file = await prepare_f0(character, model_config, tts_wav, temp_dir)
+
+            # Если очередь RVC переполнена, AdmissionRejected тоже уводит в голос TTS
+            async with admission.stage("rvc"):
+                final_audio = await upstream.call("rvc", lambda: asyncio.to_thread(
+                    rvc_convert_infer,
+                    input_audio=tts_wav, 
+                    output_audio=rvc_out,
+                    model_path=model_name,
+                    index_path=index_name,  # None для volc
+                    f0_up_key=0, 
+                    f0_method=f0_method, 
+                    index_rate=0.85,
+                    timeout=rvc_timeout,
+                    f0_file=f0_file
+                ))
+        except Exception as e:
+            final_audio = tts_wav
+            log.warning("RVC failed for %s, using TTS output: %s", character, e)
+    else:
+        log.warning("RVC model for '%s' not found. Using original TTS.", character)
+
+    record_stage("rvc", time.time() - stage_start, backend=(model_config or {}).get("backend", "tts"))
+
+    # 9. Конвертируем финальный результат в OGG
+    final_mp3 = os.path.join(temp_dir, "final.mp3")
+    if isinstance(final_audio, pcm_shm.PcmLease):
+        # Результат воркера — прямо из общей памяти в stdin ffmpeg
+        with final_audio:
+            run_cmd(["ffmpeg", "-y", "-f", "f32le", "-ar", str(final_audio.sample_rate), "-ac", "1", "-i", "pipe:0",
+                     "-acodec", "libmp3lame", "-b:a", "128k", final_mp3], input=final_audio.buffer())
+    else:
+        run_cmd(["ffmpeg", "-y", "-i", final_audio, "-acodec", "libmp3lame", "-b:a", "128k", final_mp3])
+
+    # 10. Читаем и кодируем в base64
+    with open(final_mp3, "rb") as f:
+        audio_b64 = base64.b64encode(f.read()).decode('utf-8')
+    return audio_b64
+
+async def generate_reply_events(client, character: str, device_id: str, user_text: str, temp_dir: str, total_start_time: float):
+    """LLM -> TTS -> RVC по уже распознанному тексту. Общая часть HTTP- и WebSocket-чата."""
+    # Ключ кеша считается по истории до текущей реплики
+    history = await get_history(device_id, character)
+    summary = await conversation.get_summary(device_id, character)
+
+    # Частые вопросы отвечаются из кеша — без LLM, а если есть готовая озвучка, то и без TTS/RVC
+    with span("cache"):
+        cached = await response_cache.fetch(character, user_text, history)
+
+    # Пока готовится ответ, телефон не молчит: сразу отдаём короткий заполнитель
+    filler = None
+    if FILLER_ENABLED and not (cached is not None and cached.audio_b64):
+        filler = await filler_bank.pick(character, device_id)
+        if filler is not None:
+            filler_sent_at = time.time()
+            yield FillerEvent(filler.text, filler.audio_b64, round(filler.duration, 2))
+
+    if cached is not None:
+        log.info("Ответ из кеша (%d попаданий)", cached.hits, extra={"cache": "hit"})
+        reply_text = cached.reply_text
+    else:
+        reply_text = await request_llm_reply(client, character, history, user_text, summary)
+
+    await add_to_history(device_id, character, "user", user_text)
+    await add_to_history(device_id, character, "assistant", reply_text)
+    if conversation.needs_compaction(character, characters.get(character).system_prompt, summary,
+                                     history + [{"role": "user", "text": user_text},
+                                                {"role": "assistant", "text": reply_text}]):
+        spawn(compact_history(device_id, character))
+
+    log.debug("Generated reply: %s", reply_text)
+
+    if cached is not None and cached.audio_b64:
+        audio_b64 = cached.audio_b64
+    else:
+        audio_b64 = await synthesize_voice(client, character, reply_text, temp_dir)
+        await response_cache.publish(character, user_text, history, reply_text, audio_b64)
+
+    if filler is not None:
+        wait = time.time() - filler_sent_at
+        masked = filler_bank.record_wait(filler, wait)
+        log.info("Заполнитель закрыл %.1f из %.1f сек ожидания", masked, wait,
+                 extra={"filler_masked": round(masked, 3), "verbose": True})
+
+    # Итоговая строка по запросу пишется всегда, с таймингами всех этапов
+    total_time = time.time() - total_start_time
+    log.info("Ответ готов за %.2f сек", total_time,
+             extra={"total": round(total_time, 3), "timings": stage_timings()})
+
+    # ОТПРАВЛЯЕМ ВТОРОЙ CHUNK: финальный ответ с аудио
+    yield FinalEvent(reply_text, audio_b64)
+
+
+async def prefetch_frequent_answers(only: set = None):
+    """Заранее получаем и озвучиваем ответы на частые вопросы для каждого персонажа (или только для only)"""
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        for character in list(characters.current):
+            if only is not None and character not in only:
+                continue
+            for question in FREQUENT_QUESTIONS:
+                if await response_cache.fetch(character, question, []) is not None:
+                    continue
+                try:
+                    await prefetch_answer(client, character, question)
+                except Exception as e:
+                    log.warning("Не удалось предзагрузить ответ %s на '%s': %s", character, question, e)
+
+async def prefetch_answer(client, character: str, question: str):
+    """Ответ на первый вопрос разговора (пустая история) — текст и озвучка — в кеш ответов"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        reply_text = await request_llm_reply(client, character, [], question)
+        audio_b64 = await synthesize_voice(client, character, reply_text, temp_dir)
+        await response_cache.publish(character, question, [], reply_text, audio_b64, curated=True)
+        log.info("Предзагружен ответ %s: %s", character, question)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+async def build_filler_bank(only: set = None, lock: str = "filler_build"):
+    """Синтез заполнителей голосовым конвейером: один воркер синтезирует, остальные подгружают"""
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        async def synthesize(character: str, text: str) -> str:
+            temp_dir = tempfile.mkdtemp()
+            try:
+                return await synthesize_voice(client, character, text, temp_dir)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        await filler_bank.build(synthesize, owner=await state.try_lock(lock, 600), only=only)
+
+# ---------- прогрев по AR-метке ----------
+
+async def preconnect_upstreams():
+    """Соединения с Yandex открываются заранее и остаются в пуле http_client"""
+    now = time.monotonic()
+    for url in (YANDEX_STT_URL, YANDEX_LLM_URL, YANDEX_TTS_URL):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        # Соединение живёт keepalive_expiry; чаще половины срока обновлять незачем
+        if now - _preconnected.get(origin, -1e9) < 30:
+            continue
+        _preconnected[origin] = now
+        try:
+            # Ответ (обычно 404/405) не важен: после него соединение остаётся открытым
+            await http_client.head(origin + "/", timeout=3.0)
+        except httpx.HTTPError as e:
+            log.info("Не удалось заранее соединиться с %s: %s", origin, e)
+
+def rvc_activate_idle(model_name: str) -> bool:
+    """Выбрать голос на свободном инстансе RvcWebUI, если его ещё нигде нет"""
+    instance = rvc_pool.acquire_idle(model_name)
+    if instance is None:
+        return False
+    try:
+        with rvc_pool.hold(instance, upstream.timeout_for("rvc")):
+            if rvc_pool.needs_select(instance, model_name):
+                rvc_select_voice(instance, model_name, timeout=upstream.timeout_for("rvc"))
+        return True
+    finally:
+        rvc_pool.release(instance)
+
+async def activate_voice(character: str):
+    """Загрузить или выбрать модель RVC персонажа до первой реплики"""
+    rvc = characters.get(character).rvc
+    if not rvc:
+        return
+    if rvc["backend"] == "onnx":
+        if rvc_workers.enabled:
+            await rvc_workers.warm_up(rvc["model"])
+        else:
+            await asyncio.to_thread(rvc_onnx.get_converter, rvc["model"])
+    elif upstream.is_available("rvc") and admission.stages["rvc"].load < WARMUP_MAX_LOAD:
+        await asyncio.to_thread(rvc_activate_idle, rvc["model"])
+
+async def prerender_greeting(character: str) -> bool:
+    """
+    Ответ на приветствие — в кеш ответов (общий для воркеров). True — синтез прошёл сейчас,
+    а значит, голос персонажа уже выбран по обычному пути.
+    """
+    if await response_cache.fetch(character, WARMUP_GREETING, []) is not None:
+        return False
+    if max(admission.stages[name].load for name in ("llm", "tts", "rvc")) >= WARMUP_MAX_LOAD:
+        return False
+    if not await state.try_lock(f"greeting:{character}:{characters.get(character).revision}", 120):
+        return False
+    await prefetch_answer(http_client, character, WARMUP_GREETING)
+    return True
+
+async def run_warmup(character: str, device_id: str):
+    # Этапы конвейера сначала обслуживают настоящие реплики
+    current_priority.set(PRIORITY_BACKGROUND)
+    started = time.monotonic()
+
+    async def warm_character():
+        await preconnect_upstreams()
+        if not await prerender_greeting(character):
+            await activate_voice(character)
+
+    try:
+        steps = []
+        if device_id:
+            # Чтение истории открывает соединение с общим хранилищем; разросшаяся история
+            # сворачивается сейчас, а не после первого ответа
+            steps.append(compact_history(device_id, character))
+        if started - _warmed_characters.get(character, -1e9) >= WARMUP_INTERVAL:
+            _warmed_characters[character] = started
+            steps.append(warm_character())
+        for result in await asyncio.gather(*steps, return_exceptions=True):
+            if isinstance(result, Exception):
+                warmup_stats["failed"] += 1
+                log.info("Прогрев %s не завершён: %s", character, result)
+        log.info("Прогрев %s за %.2f сек", character, time.monotonic() - started, extra={"verbose": True})
+    finally:
+        warmup_stats["running"] -= 1
+
+async def schedule_warmup(character: str, device_id: str) -> bool:
+    """Запуск прогрева без ожидания; повторные и лишние сигналы отбрасываются"""
+    warmup_stats["requested"] += 1
+    if device_id and not await state.try_lock(f"warmup:{device_id}:{character}", WARMUP_INTERVAL):
+        warmup_stats["deduplicated"] += 1
+        return False
+    if warmup_stats["running"] >= WARMUP_CONCURRENCY:
+        warmup_stats["busy"] += 1
+        return False
+    warmup_stats["running"] += 1
+    warmup_stats["started"] += 1
+    spawn(run_warmup(character, device_id))
+    return True
+
+async def apply_character_changes(old, new, changed: set):
+    """
+    Новые настройки персонажей из characters.json: сбрасываются и прогреваются только изменившиеся.
+    Остальные персонажи сохраняют кеш ответов, заполнители и загруженные модели.
+    """
+    conversation.budgets = new.context_budgets()
+    for character in changed:
+        response_cache.drop_stale(character)
+    filler_bank.update(new.filler_phrases(), new.voice_revisions(), changed)
+    alive = {character for character in changed if character in new}
+    if not alive:
+        return
+
+    voice_changed = {c for c in alive if c not in old or old.get(c).voice_revision != new.get(c).voice_revision}
+    for character in voice_changed:
+        rvc = new.get(character).rvc
+        # В процессе сервера модель ONNX грузится заранее; воркеры пула загрузят её при первом вызове
+        if rvc and rvc["backend"] == "onnx" and not rvc_workers.enabled:
+            spawn(asyncio.to_thread(rvc_onnx.get_converter, rvc["model"]))
+    if FILLER_ENABLED:
+        for character in voice_changed:
+            # Замок с отпечатком голоса: синтезирует один воркер, и только один раз на версию
+            spawn(build_filler_bank({character}, f"filler_build:{character}:{new.get(character).voice_revision}"))
+    if PREFETCH_FREQUENT_ANSWERS:
+        fresh = {c for c in alive if await state.try_lock(f"prefetch:{c}:{new.get(c).revision}", 600)}
+        if fresh:
+            spawn(prefetch_frequent_answers(fresh))
+    photo = [c for c in new.photo_characters() if c in alive]
+    if photo:
+        spawn(asyncio.to_thread(warm_up_photo_preview, photo, False))
+
+@app.on_event("startup")
+async def start_prefetch():
+    # Сегменты общей памяти, оставшиеся от убитых процессов сервера
+    pcm_shm.sweep_stale()
+    # Модель сегментации для локального превью фото грузится заранее, в фоне
+    spawn(asyncio.to_thread(warm_up_photo_preview, characters.current.photo_characters()))
+    spawn(characters.watch(apply_character_changes))
+    spawn(get_ar_manifest())
+    spawn(get_dialogue_sprites())
+    if FILLER_ENABLED:
+        spawn(build_filler_bank())
+    # При нескольких воркерах предзагрузку делает один, остальные берут ответы из общего кеша
+    if PREFETCH_FREQUENT_ANSWERS and await state.try_lock("prefetch", 600):
+        spawn(prefetch_frequent_answers())
+
+@app.on_event("shutdown")
+async def stop_voice_workers():
+    await http_client.aclose()
+    await asyncio.to_thread(rvc_workers.close)
+    pcm_arena.close()
+
 # ==================== ENDPOINTS ====================
 
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+def admit_or_429(endpoint: str, key: str, stages=()) -> int:
+    """Допуск запроса или HTTP 429 с Retry-After"""
+    try:
+        return admission.admit(endpoint, key, stages)
+    except AdmissionRejected as e:
+        log.warning("%s отклонён для %s: %s", endpoint, key, e.reason)
+        raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+@app.get("/api/metrics")
+async def metrics():
+    """Счётчики контроля допуска и состояние внешних сервисов"""
+    return {
+        "worker_pid": os.getpid(),
+        "admission": admission.snapshot(),
+        "upstream": upstream.snapshot(),
+        "rvc_pool": rvc_pool.snapshot(),
+        "conversation": conversation.snapshot(),
+        "filler": filler_bank.snapshot(),
+        "logging": logs.snapshot(),
+        "pcm": pcm_arena.snapshot(),
+        "characters": characters.snapshot(),
+        "warmup": warmup_stats,
+        "rvc_workers": rvc_workers.snapshot(),
+    }
+
+@app.post("/api/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, interval: float = profiling.PROFILE_SAMPLE_INTERVAL):
+    """
+    Сэмплирующий профиль живого процесса (воркера, принявшего запрос) за seconds секунд.
+    Результат — .speedscope.json в PROFILE_DIR и топ функций по self time.
+    """
+    if not profiling.authorized(request.headers):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    result = await asyncio.to_thread(profiling.sample_process, seconds, max(interval, 0.001))
+    return {"worker_pid": os.getpid(), **result}
+
+@app.get("/api/upstream-status")
+async def upstream_status():
+    """Состояние предохранителей и задержки внешних сервисов"""
+    return upstream.snapshot()
+
+_ar_manifest = None
+
+async def get_ar_manifest():
+    """Манифест наборов AR-маркеров; при изменении targets_all.mind пересобирается"""
+    global _ar_manifest
+    if _ar_manifest is None:
+        _ar_manifest = await asyncio.to_thread(ar_targets.load_manifest)
+    return _ar_manifest
+
+@app.get("/api/ar-targets")
+async def ar_targets_endpoint(lux: float = None, brightness: float = None):
+    """
+    Какой набор маркеров грузить телефону: день/ночь по высоте солнца над парком
+    или по подсказке освещённости, в сумерках — полный. targets — индекс маркера -> персонаж.
+    """
+    manifest = await get_ar_manifest()
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="AR targets not found")
+    choice = ar_targets.choose_variant(manifest, lux=lux, brightness=brightness)
+    body = {
+        "variant": choice["variant"],
+        "reason": choice["reason"],
+        "url": f"/ar/targets/{choice['file']}",
+        "bytes": choice["bytes"],
+        "targets": choice["targets"],
+        "valid_for": choice["valid_for"],
+    }
+    # Выбор кешируется телефоном, пока не сменится время суток (но не дольше 10 минут)
+    return JSONResponse(body, headers={"Cache-Control": f"private, max-age={min(choice['valid_for'], 600)}"})
+
+@app.get("/ar/targets/{name}")
+async def ar_targets_file(request: Request, name: str):
+    """Файлы наборов с хешем содержимого в имени — кешируются навсегда; .gz, если клиент принимает"""
+    manifest = await get_ar_manifest()
+    if manifest is None or name not in {v["file"] for v in manifest["variants"].values()}:
+        raise HTTPException(status_code=404, detail="AR targets not found")
+    path, headers = precompressed_file(os.path.join(ar_targets.AR_TARGETS_DIR, name),
+                                       request.headers.get("accept-encoding", ""))
+    headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return FileResponse(path, media_type="application/octet-stream", headers=headers)
+
+_dialogue_sprites = None
+_sprite_bytes = {}
+
+async def get_dialogue_sprites():
+    """Манифест спрайтов реплик; пересобирается, как только меняются файлы в assets/dialogues"""
+    global _dialogue_sprites
+    signature = audio_sprites.source_signature()
+    if _dialogue_sprites is None or _dialogue_sprites["source"] != signature:
+        _dialogue_sprites = await asyncio.to_thread(audio_sprites.load_manifest)
+    return _dialogue_sprites
+
+@app.get("/api/dialogue-sprites")
+async def dialogue_sprites_endpoint(request: Request):
+    """
+    Спрайт реплик на персонажа: url и для каждой реплики offset/length в байтах (Blob.slice
+    даёт самостоятельный MP3) и start/duration в секундах внутри спрайта.
+    """
+    manifest = await get_dialogue_sprites()
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Dialogue sprites not found")
+    headers = {"Cache-Control": "no-cache", "ETag": f'"{manifest["source"]}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    body = {
+        character: {"url": f"/dialogues/{sprite['file']}", "bytes": sprite["bytes"], "clips": sprite["clips"]}
+        for character, sprite in manifest["sprites"].items()
+    }
+    return JSONResponse(body, headers=headers)
+
+@app.get("/dialogues/{name}")
+async def dialogue_sprite_file(request: Request, name: str):
+    """Спрайт с хешем содержимого в имени: кешируется навсегда, поддерживает Range"""
+    manifest = await get_dialogue_sprites()
+    if manifest is None or name not in {s["file"] for s in manifest["sprites"].values()}:
+        raise HTTPException(status_code=404, detail="Dialogue sprite not found")
+    data = _sprite_bytes.get(name)
+    if data is None:
+        path = os.path.join(audio_sprites.DIALOGUE_SPRITES_DIR, name)
+        data = await asyncio.to_thread(Path(path).read_bytes)
+        # Имена с хешем не устаревают: держим только актуальные спрайты
+        live = {s["file"] for s in manifest["sprites"].values()}
+        for stale in [key for key in _sprite_bytes if key not in live]:
+            del _sprite_bytes[stale]
+        _sprite_bytes[name] = data
+
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{name.split(".")[1]}"',
+        "Accept-Ranges": "bytes",
+    }
+    try:
+        byte_range = audio_sprites.byte_range(request.headers.get("range"), len(data))
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+    if byte_range is None or request.headers.get("if-range", headers["ETag"]) != headers["ETag"]:
+        return Response(data, media_type="audio/mpeg", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(data[start:end + 1], status_code=206, media_type="audio/mpeg", headers=headers)
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     if not os.path.exists(INDEX_PATH):
@@ -289,189 +1042,92 @@ async def root():
     with open(INDEX_PATH, "r", encoding="utf-8") as f:
         return HTMLResponse(content=f.read())
 
+@app.post("/api/warmup")
+async def warmup_endpoint(request: Request, character: str = Form(...), device_id: str = Form("")):
+    """Камера нашла скульптуру character: прогрев в фоне, ответ сразу"""
+    if not WARMUP_ENABLED or character not in characters.current:
+        return {"scheduled": False}
+    try:
+        admission.admit("warmup", device_id or client_ip(request))
+    except AdmissionRejected:
+        return {"scheduled": False}
+    return {"scheduled": await schedule_warmup(character, device_id)}
+
 @app.post("/api/chat-stream")
 async def chat_stream_endpoint(
+    request: Request,
     audio: UploadFile = File(...),
     character: str = Form(...),
     device_id: str = Form(...)
 ):
     """Полный цикл: STT -> Chat -> TTS -> RVC для конкретного персонажа"""
     
+    # Отсекаем лишние запросы до того, как тратить ресурсы на аудио
+    priority = admit_or_429("chat", device_id or client_ip(request), ("stt", "llm"))
+    
     # Читаем аудио заранее, до генератора
     audio_data = await audio.read()
     
     async def generate_response():
+        current_priority.set(priority)
+        begin_request(request.headers.get("x-request-id"), endpoint="chat-stream",
+                      character=character, device_id=device_id)
         # Начало общего отсчёта времени
         total_start_time = time.time()
         
         temp_dir = tempfile.mkdtemp()
         
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                # 1. Сохраняем загруженный аудиофайл
-                audio_path = os.path.join(temp_dir, "input.webm")
-                with open(audio_path, "wb") as f:
-                    f.write(audio_data)
-                
-                # Получаем системный промпт для выбранного персонажа
-                system_prompt = SYSTEM_PROMPTS.get(character, SYSTEM_PROMPTS["cheb"])
-                
-                # 2. Конвертируем webm -> ogg для STT
-                print("\n[ЭТАП 1/5] Конвертация WebM -> OGG для STT")
-                stage_start = time.time()
-                
-                audio_ogg = os.path.join(temp_dir, "input.ogg")
+            # 1. Сохраняем загруженный аудиофайл
+            audio_path = os.path.join(temp_dir, "input.webm")
+            with open(audio_path, "wb") as f:
+                f.write(audio_data)
+            
+            # 2. Конвертируем webm -> ogg для STT
+            audio_ogg = os.path.join(temp_dir, "input.ogg")
+            with StageTimer("transcode"):
                 webm_to_ogg(audio_path, audio_ogg)
-                
-                stage_time = time.time() - stage_start
-                print(f"⏱️  Конвертация WebM->OGG: {stage_time:.2f} сек")
-                
-                # 3. Speech-to-Text
-                print("\n[ЭТАП 2/5] Распознавание речи (STT)")
-                stage_start = time.time()
-                
-                with open(audio_ogg, "rb") as f:
-                    stt_response = await client.post(
-                        f"https://stt.api.cloud.yandex.net/speech/v1/stt:recognize?lang=ru-RU&folderId={FOLDER_ID}&format=oggopus",
-                        headers={"Authorization": f"Api-Key {API_KEY}"},
-                        content=f.read()
-                    )
-                
-                stage_time = time.time() - stage_start
-                print(f"⏱️  STT (распознавание речи): {stage_time:.2f} сек")
-                
-                if stt_response.status_code != 200:
-                    raise HTTPException(status_code=stt_response.status_code, detail=stt_response.text)
-                
-                user_text = stt_response.json().get("result", "")
-                if not user_text:
-                    raise HTTPException(status_code=400, detail="Не удалось распознать речь")
-                
-                print(f"Recognized text: {user_text}")
-                
-                # ОТПРАВЛЯЕМ ПЕРВЫЙ CHUNK: user_text сразу после STT
-                yield json.dumps({"type": "stt", "user_text": user_text}) + "\n"
-                
-                # 4. Генерируем ответ через YandexGPT с динамическим промптом
-                # 4. Отправка в LLM через OpenRouter
-                print("\n[ЭТАП 3/5] Генерация ответа (LLM)")
-                stage_start = time.time()
-
-                system_prompt = SYSTEM_PROMPTS.get(character, "Ты — дружелюбный помощник.")
-                
-                messages = [{"role": "system", "text": system_prompt}]
-
-                # Добавляем историю переписки
-                history = get_history(device_id, character)
-                messages.extend(history)
-
-                # Добавляем новое сообщение пользователя
-                messages.append({"role": "user", "text": user_text})
-
-                # 4. Генерируем ответ через YandexGPT с динамическим промптом
-                chat_response = await client.post(
-                    "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-                    headers={"Authorization": f"Api-Key {API_KEY}", "Content-Type": "application/json"},
-                    json={
-                        "modelUri": f"gpt://{FOLDER_ID}/yandexgpt-lite/latest",
-                        "completionOptions": {"stream": False, "temperature": 0.6, "maxTokens": "200"},
-
-                        "messages": messages  
-                    }
-                )
-
-                stage_time = time.time() - stage_start
-                print(f"⏱️  LLM (генерация ответа): {stage_time:.2f} сек")
-                
-                if chat_response.status_code != 200:
-                    raise HTTPException(status_code=chat_response.status_code, detail=chat_response.text)
-                
-                reply_text = chat_response.json()["result"]["alternatives"][0]["message"]["text"]
-
-                add_to_history(device_id, character, "user", user_text)
-                add_to_history(device_id, character, "assistant", reply_text)
-
-                print(f"Generated reply: {reply_text}")
-                
-                # 5. Text-to-Speech
-                print("\n[ЭТАП 4/5] Синтез речи (TTS)")
-                stage_start = time.time()
-                
-                selected_voice = TTS_VOICES.get(character, "alena")
-                tts_response = await client.post(
-                    "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize",
+            
+            # 3. Speech-to-Text
+            stage_start = time.time()
+            
+            with open(audio_ogg, "rb") as f:
+                audio_ogg_data = f.read()
+            async with admission.stage("stt"):
+                stt_response = await upstream.call("yandex_stt", lambda: http_client.post(
+                    f"{YANDEX_STT_URL}?lang=ru-RU&folderId={FOLDER_ID}&format=oggopus",
                     headers={"Authorization": f"Api-Key {API_KEY}"},
-                    data={
-                        "text": reply_text, "lang": "ru-RU", "voice": selected_voice,
-                        "folderId": FOLDER_ID, "format": "oggopus", "sampleRateHertz": "48000"
-                    }
-                )
-
-                stage_time = time.time() - stage_start
-                print(f"⏱️  TTS (синтез речи): {stage_time:.2f} сек")
-
-                if tts_response.status_code != 200:
-                    raise HTTPException(status_code=tts_response.status_code, detail=tts_response.text)
-                
-                tts_ogg = os.path.join(temp_dir, "tts.ogg")
-                with open(tts_ogg, "wb") as f:
-                    f.write(tts_response.content)
-                
-                # 7. Конвертируем OGG в WAV для RVC
-                print("\n[ЭТАП 5/5] Клонирование голоса (RVC)")
-                stage_start = time.time()
-                
-                tts_wav = os.path.join(temp_dir, "tts.wav")
-                run_cmd(["ffmpeg", "-y", "-i", tts_ogg, "-ar", "40000", "-ac", "1", tts_wav])
-                
-                # 8. Применяем RVC с динамической моделью
-                final_audio = tts_wav
-                model_config = RVC_MODELS.get(character)
-
-                if model_config:
-                    rvc_out = os.path.join(temp_dir, "rvc_out.wav")
-                    try:
-                        model_name = model_config["model"]
-                        index_name = model_name if model_config.get("has_index", False) else None
-                        
-                        final_audio = rvc_convert_infer(
-                            input_audio=tts_wav, 
-                            output_audio=rvc_out,
-                            model_path=model_name,
-                            index_path=index_name,  # None для volc
-                            f0_up_key=0, 
-                            f0_method="pm", 
-                            index_rate=0.85
-                        )
-                    except Exception as e:
-                        print(f"RVC failed for {character}, using TTS output: {e}")
-                else:
-                    print(f"RVC model for '{character}' not found. Using original TTS.")
-
-                stage_time = time.time() - stage_start
-                print(f"⏱️  RVC (клонирование голоса): {stage_time:.2f} сек")
-
-                # 9. Конвертируем финальный результат в OGG
-                final_mp3 = os.path.join(temp_dir, "final.mp3")
-                run_cmd(["ffmpeg", "-y", "-i", final_audio, "-acodec", "libmp3lame", "-b:a", "128k", final_mp3])
-                
-                # 10. Читаем и кодируем в base64
-                with open(final_mp3, "rb") as f:
-                    audio_b64 = base64.b64encode(f.read()).decode('utf-8')
-                
-                # Подсчёт общего времени
-                total_time = time.time() - total_start_time
-                print(f"\n{'='*60}")
-                print(f"🎯 ОБЩЕЕ ВРЕМЯ ОБРАБОТКИ: {total_time:.2f} сек")
-                print(f"{'='*60}\n")
-                
-                # ОТПРАВЛЯЕМ ВТОРОЙ CHUNK: финальный ответ с аудио
-                yield json.dumps({"type": "final", "reply_text": reply_text, "audio_base64": audio_b64}) + "\n"
-    
+                    content=audio_ogg_data,
+                    timeout=upstream.timeout_for("yandex_stt")
+                ))
+            
+            record_stage("stt", time.time() - stage_start)
+            
+            if stt_response.status_code != 200:
+                raise HTTPException(status_code=stt_response.status_code, detail=stt_response.text)
+            
+            user_text = loads(stt_response.content).get("result", "")
+            if not user_text:
+                raise HTTPException(status_code=400, detail="Не удалось распознать речь")
+            
+            log.debug("Recognized text: %s", user_text)
+            
+            # Речь распознана: устройство действительно проходит квест
+            admission.touch(device_id or client_ip(request))
+
+            # ОТПРАВЛЯЕМ ПЕРВЫЙ CHUNK: user_text сразу после STT
+            yield ndjson_line(SttEvent(user_text))
+            
+            async for event in generate_reply_events(http_client, character, device_id, user_text, temp_dir, total_start_time):
+                yield ndjson_line(event)
+
+        except AdmissionRejected as e:
+            log.warning("Запрос отклонён: %s", e.reason)
+            yield ndjson_line(ErrorEvent(e.reason, e.retry_after))
+        
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
+            log.exception("Ошибка обработки чата")
+            yield ndjson_line(ErrorEvent(str(e)))
         
         finally:
             if os.path.exists(temp_dir):
@@ -479,18 +1135,189 @@ async def chat_stream_endpoint(
     
     return StreamingResponse(generate_response(), media_type="application/x-ndjson")
 
-@app.post("/remove")
-async def remove_background(
-    photo: UploadFile = File(...),
-    ar_overlay: UploadFile = File(...),
-    active_target: str = Form(None)
-):
+@app.websocket("/api/chat-ws")
+async def chat_ws_endpoint(websocket: WebSocket):
     """
-    НОВАЯ ЛОГИКА:
-    1. Накладываем AR-слой поверх обычного фото (если есть AR-контент)
-    2. Отправляем композитное изображение в Nano Banana
-    3. Получаем отредактированное изображение
+    Потоковый вариант /api/chat-stream.
+    Протокол: JSON {"character", "device_id"} -> бинарные webm-кадры по мере записи -> JSON {"type": "end"}.
+    Сервер шлёт stt_partial по ходу речи, затем stt и final/error в формате NDJSON-чата.
     """
+    await websocket.accept()
+    temp_dir = tempfile.mkdtemp()
+    transcoder = FfmpegTranscoder()
+    reader_task = None
+
+    try:
+        init = await websocket.receive_json()
+        character = init.get("character", "cheb")
+        device_id = init.get("device_id", "")
+        begin_request(websocket.headers.get("x-request-id") or init.get("request_id"), endpoint="chat-ws", character=character, device_id=device_id)
+        admission.admit("chat", device_id or websocket.client.host, ("stt", "llm"))
+        total_start_time = time.time()
+
+        transcoder.start()
+        recognizer = create_recognizer(STT_STREAMING_BACKEND, API_KEY, FOLDER_ID)
+
+        async def read_client_audio():
+            """Пересылаем кадры из браузера в ffmpeg, пока клиент не пришлёт end"""
+            try:
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        break
+                    if message.get("bytes"):
+                        await transcoder.feed(message["bytes"])
+                    elif message.get("text") and loads(message["text"]).get("type") == "end":
+                        break
+            finally:
+                await transcoder.close_input()
+
+        reader_task = asyncio.create_task(read_client_audio())
+
+        stage_start = time.time()
+        user_text = ""
+        async with aclosing(recognizer.recognize(transcoder.pcm_chunks())) as events:
+            async for kind, text in events:
+                if kind == "partial":
+                    await websocket.send_text(event_text(SttPartialEvent(text)))
+                else:
+                    user_text = text
+                    break
+
+        record_stage("stt", time.time() - stage_start, streaming=True)
+
+        if not user_text:
+            raise HTTPException(status_code=400, detail="Не удалось распознать речь")
+
+        log.debug("Recognized text: %s", user_text)
+        admission.touch(device_id or websocket.client.host)
+        await websocket.send_text(event_text(SttEvent(user_text)))
+
+        # Финальный текст получен — LLM стартует сразу, не дожидаясь конца загрузки аудио
+        async for event in generate_reply_events(http_client, character, device_id, user_text, temp_dir, total_start_time):
+            await websocket.send_text(event_text(event))
+
+    except WebSocketDisconnect:
+        log.info("WebSocket клиент отключился")
+    except AdmissionRejected as e:
+        log.warning("Запрос отклонён: %s", e.reason)
+        await websocket.send_text(event_text(ErrorEvent(e.reason, e.retry_after)))
+    except Exception as e:
+        log.exception("Ошибка обработки чата")
+        try:
+            await websocket.send_text(event_text(ErrorEvent(str(e))))
+        except Exception:
+            pass
+    finally:
+        if reader_task is not None:
+            reader_task.cancel()
+        transcoder.kill()
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+def pick_photo_character(active_target: str) -> str:
+    photo_characters = characters.current.photo_characters()
+    return active_target if active_target and active_target in photo_characters else random.choice(photo_characters)
+
+def build_composite(photo_data: bytes, ar_data: bytes):
+    """Фото + AR-слой поверх. Возвращает (фото, AR-слой или None, композит)"""
+    with span("image:composite"):
+        return _build_composite(photo_data, ar_data)
+
+def _build_composite(photo_data: bytes, ar_data: bytes):
+    # 1. Открываем обычное фото
+    photo_image = Image.open(io.BytesIO(photo_data)).convert("RGBA")
+    
+    # 2. Открываем AR-слой
+    ar_image = Image.open(io.BytesIO(ar_data)).convert("RGBA")
+    # Есть ли непрозрачные пиксели: bbox альфа-канала считается в C, без обхода пикселей в Python
+    has_ar_content = ar_image.getchannel("A").getbbox() is not None
+    
+    # 3. Накладываем AR-слой поверх фото
+    composite = photo_image.copy()
+    
+    if has_ar_content:
+        log.debug("AR-контент обнаружен, накладываем поверх фото")
+        # Масштабируем AR оверлей если нужно
+        if ar_image.size != photo_image.size:
+            ar_image = ar_image.resize(photo_image.size, Image.Resampling.LANCZOS)
+        composite.paste(ar_image, (0, 0), ar_image)
+    else:
+        log.debug("AR-контент отсутствует, используем только фото")
+        ar_image = None
+    
+    return photo_image, ar_image, composite
+
+def encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def local_preview(photo_image: Image.Image, ar_image, character: str, fmt: str, with_thumbnail: bool):
+    """Локальная замена фона на bg_<персонаж>.png (CPU), без обращения к ИИ"""
+    with StageTimer("local_preview", character=character):
+        preview = compose_preview(photo_image, ar_image, character)
+        output = render_image(preview, fmt, with_thumbnail)
+    return output
+
+async def photo_response(request: Request, output, extra_headers: dict = None) -> Response:
+    """Ответ с картинкой: Content-Length/ETag, 304 по If-None-Match, ссылка на миниатюру"""
+    headers = output.headers()
+    headers.update(extra_headers or {})
+    if output.thumbnail is not None:
+        thumb_id = output.etag.strip('"')
+        await state.set(f"thumb:{thumb_id}", {
+            "media_type": output.thumbnail_media_type,
+            "data": base64.b64encode(output.thumbnail).decode("ascii"),
+        }, PHOTO_JOB_TTL)
+        headers["X-Thumbnail-URL"] = f"/remove/thumb/{thumb_id}"
+    headers["Access-Control-Expose-Headers"] = ", ".join(
+        name for name in ("ETag", "X-Photo-Job", "X-Thumbnail-URL", "X-Degraded") if name in headers
+    )
+    if request.headers.get("if-none-match") == output.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=output.body, media_type=output.media_type, headers=headers)
+
+async def stylize_photo(composite_png: bytes, character: str) -> bytes:
+    """
+    Стилизация через Nano Banana с учётом предохранителя, очереди и дневного бюджета.
+    Возвращает байты результата; при недоступности бросает исключение.
+    """
+    budget_key = f"nano_budget:{time.strftime('%Y%m%d')}"
+    # Заранее — только проверка: очередь и предохранитель не должны тратить бюджет
+    if (await state.get(budget_key) or 0) >= NANO_BANANA_DAILY_BUDGET:
+        raise BudgetExceeded("дневной бюджет Nano Banana исчерпан")
+    
+    composite_base64 = base64.b64encode(composite_png)
+    prompt = characters.get(character).image_edit_prompt
+    nano_timeout = upstream.timeout_for("nano_banana")
+    async with admission.stage("image"):
+        # Списываем в момент отправки; списание атомарно, поэтому бюджет не превысят и параллельные воркеры
+        if await state.incr(budget_key, ttl=2 * 86400) > NANO_BANANA_DAILY_BUDGET:
+            await state.decr(budget_key)
+            raise BudgetExceeded("дневной бюджет Nano Banana исчерпан")
+        try:
+            with StageTimer("nano_banana"):
+                return await upstream.call("nano_banana", lambda: asyncio.to_thread(
+                    send_to_nano_banana, composite_base64, prompt, nano_timeout
+                ))
+        except CircuitOpenError:
+            # Предохранитель не пустил вызов — он не ушёл, списание возвращаем
+            await state.decr(budget_key)
+            raise
+
+def degraded_reason(e: Exception) -> str:
+    if isinstance(e, CircuitOpenError):
+        return "предохранитель разомкнут"
+    if isinstance(e, AdmissionRejected):
+        return "очередь переполнена"
+    return str(e)
+
+async def read_photo_upload(photo: UploadFile, ar_overlay: UploadFile, active_target: str):
     # Проверка типов файлов
     if photo.content_type.split('/')[0] != "image":
         raise HTTPException(status_code=400, detail="Photo file is not an image")
@@ -503,78 +1330,164 @@ async def remove_background(
     os.makedirs("debug", exist_ok=True)
     with open("debug/input_photo.png", "wb") as f: f.write(photo_data)
     with open("debug/input_ar.png", "wb") as f: f.write(ar_data)
-    print(f"✓ Входящие изображения сохранены, активный маркер: {active_target}")
+    log.debug("Входящие изображения сохранены, активный маркер: %s", active_target)
+    return photo_data, ar_data
+
+@app.post("/remove")
+async def remove_background(
+    request: Request,
+    photo: UploadFile = File(...),
+    ar_overlay: UploadFile = File(...),
+    active_target: str = Form(None),
+    device_id: str = Form(None),
+    output_format: str = Form(None),
+    thumbnail: bool = Form(False)
+):
+    """
+    НОВАЯ ЛОГИКА:
+    1. Накладываем AR-слой поверх обычного фото (если есть AR-контент)
+    2. Отправляем композитное изображение в Nano Banana
+    3. Получаем отредактированное изображение
+    Если Nano Banana недоступен — локальная замена фона (photo_preview).
+    """
+    admit_or_429("remove", device_id or client_ip(request), ("image",))
+    begin_request(request.headers.get("x-request-id"), endpoint="remove", device_id=device_id)
+    photo_data, ar_data = await read_photo_upload(photo, ar_overlay, active_target)
     
     try:
-        # 1. Открываем обычное фото
-        photo_image = Image.open(io.BytesIO(photo_data)).convert("RGBA")
-        
-        # 2. Открываем AR-слой
-        ar_image = Image.open(io.BytesIO(ar_data)).convert("RGBA")
-        # Проверяем, есть ли непрозрачные пиксели (альфа-канал > 0)
-        has_ar_content = False
-        # Проверяем, есть ли непрозрачные пиксели в AR-слое
-        for pixel in ar_image.getdata():
-            if pixel[3] > 0:  # Если альфа-канал > 0, то пиксель не прозрачный
-                has_ar_content = True
-                break
-        
-        # 3. Накладываем AR-слой поверх фото
-        composite = photo_image.copy()
-        
-        if has_ar_content:
-            print("✓ AR-контент обнаружен, накладываем поверх фото")
-            # Масштабируем AR оверлей если нужно
-            if ar_image.size != photo_image.size:
-                ar_image = ar_image.resize(photo_image.size, Image.Resampling.LANCZOS)
-            composite.paste(ar_image, (0, 0), ar_image)
-        else:
-            print("⚠ AR-контент отсутствует, используем только фото")
+        photo_image, ar_image, composite = build_composite(photo_data, ar_data)
         
         # Сохраняем композит для отладки
-        composite.save("debug/composite_before_ai.png", format="PNG")
-        print("✓ Композитное изображение сохранено для отладки")
-        
-        # 4. Конвертируем композитное изображение в base64
-        buffer = io.BytesIO()
-        composite.save(buffer, format="PNG")
-        composite_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        
-        # 5. Выбираем промпт в зависимости от персонажа
-        bg_options = ['cheb', 'volc', 'gena', 'shap']
-        selected_character = active_target if active_target and active_target in bg_options else random.choice(bg_options)
-        prompt = IMAGE_EDIT_PROMPTS.get(selected_character, IMAGE_EDIT_PROMPTS["cheb"])
-        
-        print(f"✓ Выбран персонаж: {selected_character}")
-        print(f"✓ Промпт: {prompt}")
+        composite_png = encode_png(composite)
+        with open("debug/composite_before_ai.png", "wb") as f:
+            f.write(composite_png)
+        # 5. Выбираем персонажа
+        selected_character = pick_photo_character(active_target)
+        bind(character=selected_character)
         
         # 6. Отправляем в Nano Banana
-        print("🚀 Отправка в Nano Banana...")
-        result_base64 = send_to_nano_banana(composite_base64, prompt)
+        try:
+            result_bytes = await stylize_photo(composite_png, selected_character)
+        except Exception as e:
+            # Деградация: локальная замена фона вместо ошибки
+            log.warning("Nano Banana недоступен (%s), возвращаем локальный вариант", degraded_reason(e))
+            fmt = choose_format(request.headers.get("accept", ""), output_format, None)
+            output = await asyncio.to_thread(local_preview, photo_image, ar_image, selected_character, fmt, thumbnail)
+            return await photo_response(request, output, {"X-Degraded": "local-preview"})
         
-        # 7. Декодируем результат
-        result_bytes = base64.b64decode(result_base64)
-        result_image = Image.open(io.BytesIO(result_bytes))
+        # 7. Готовим ответ: байты Nano Banana идут как есть, если формат подходит клиенту
+        with span("image:render"):
+            output = await asyncio.to_thread(
+                render_photo, result_bytes, request.headers.get("accept", ""), output_format, thumbnail
+            )
         
-        # Сохраняем результат под уникальным именем с текущим временем
+        # Сохраняем исходные байты результата без перекодирования
         timestamp = time.strftime("%Y%m%d_%H%M%S")
-        output_path = f"debug/output_result_{timestamp}.png"
-        result_image.save(output_path, format="PNG")
-        print(f"✓ Результат сохранен: {output_path}")
+        output_path = f"debug/output_result_{timestamp}.{output.media_type.split('/')[1]}"
+        with open(output_path, "wb") as f:
+            f.write(result_bytes if output.passthrough else output.body)
+        log.info("Результат сохранен: %s", output_path,
+                 extra={"passthrough": output.passthrough, "media_type": output.media_type})
         
         # 8. Возвращаем результат
-        out_io = io.BytesIO()
-        result_image.save(out_io, format="PNG")
-        out_io.seek(0)
+        return await photo_response(request, output)
+        
+    except Exception as e:
+        log.exception("Ошибка обработки фото")
+        raise HTTPException(status_code=500, detail=f"Processing failed: {e}")
+
+async def run_photo_upgrade(job_id: str, composite_png: bytes, character: str):
+    """Фоновая стилизация через Nano Banana; результат кладётся в общее состояние"""
+    key = f"photo:{job_id}"
+    try:
+        result_bytes = await stylize_photo(composite_png, character)
+        await state.set(key, {"status": "done", "image_b64": base64.b64encode(result_bytes).decode("ascii")},
+                        PHOTO_JOB_TTL)
+        log.info("ИИ-версия фото %s готова", job_id)
+    except Exception as e:
+        log.warning("ИИ-версия фото %s не получена (%s), остаётся превью", job_id, degraded_reason(e))
+        await state.set(key, {"status": "failed"}, PHOTO_JOB_TTL)
+
+@app.post("/remove/preview")
+async def remove_background_preview(
+    request: Request,
+    photo: UploadFile = File(...),
+    ar_overlay: UploadFile = File(...),
+    active_target: str = Form(None),
+    device_id: str = Form(None),
+    output_format: str = Form(None),
+    thumbnail: bool = Form(False)
+):
+    """
+    Мгновенное превью: люди с фото на фоне bg_<персонаж>.png + AR-слой.
+    Стилизация Nano Banana запускается в фоне; её результат забирается через
+    /remove/result/{job_id} (id в заголовке X-Photo-Job).
+    """
+    admit_or_429("remove", device_id or client_ip(request), ("image",))
+    begin_request(request.headers.get("x-request-id"), endpoint="remove-preview", device_id=device_id)
+    photo_data, ar_data = await read_photo_upload(photo, ar_overlay, active_target)
+    
+    try:
+        photo_image, ar_image, composite = build_composite(photo_data, ar_data)
+        selected_character = pick_photo_character(active_target)
+        bind(character=selected_character)
+        
+        fmt = choose_format(request.headers.get("accept", ""), output_format, None)
+        output = await asyncio.to_thread(local_preview, photo_image, ar_image, selected_character, fmt, thumbnail)
         
-        return StreamingResponse(out_io, media_type="image/png")
+        job_id = uuid.uuid4().hex
+        await state.set(f"photo:{job_id}", {"status": "pending"}, PHOTO_JOB_TTL)
+        composite_png = await asyncio.to_thread(encode_png, composite)
+        spawn(run_photo_upgrade(job_id, composite_png, selected_character))
         
+        return await photo_response(request, output, {"X-Photo-Job": job_id})
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка обработки фото")
         raise HTTPException(status_code=500, detail=f"Processing failed: {e}")
 
-if __name__ == "__main__":
+@app.get("/remove/thumb/{thumb_id}")
+async def remove_background_thumbnail(thumb_id: str):
+    """Лёгкая миниатюра фото для чата"""
+    thumb = await state.get(f"thumb:{thumb_id}")
+    if thumb is None:
+        raise HTTPException(status_code=404, detail="Thumbnail expired")
+    return Response(content=base64.b64decode(thumb["data"]), media_type=thumb["media_type"],
+                    headers={"Cache-Control": "private, max-age=3600"})
+
+@app.get("/remove/result/{job_id}")
+async def remove_background_result(request: Request, job_id: str, wait: float = 25,
+                                   format: str = None, thumbnail: bool = False):
+    """
+    Long-poll ИИ-версии фото: 200 — готово, 202 — ещё в работе (повторить),
+    204 — стилизации не будет, остаётся превью.
+    """
+    deadline = time.time() + min(wait, 55)
+    while True:
+        job = await state.get(f"photo:{job_id}")
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown photo job")
+        if job["status"] == "done":
+            output = await asyncio.to_thread(
+                render_photo, base64.b64decode(job["image_b64"]), request.headers.get("accept", ""), format, thumbnail
+            )
+            return await photo_response(request, output)
+        if job["status"] == "failed":
+            return Response(status_code=204)
+        if time.time() >= deadline:
+            return Response(status_code=202)
+        await asyncio.sleep(0.5)
+
+if __name__ == "__main__" and RUN_MODE == "production":
+    # Несколько процессов без reload; состояние — в SHARED_STATE_URL, RVC — в RVC_URLS
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "443")),
+        workers=WORKERS,
+        ssl_keyfile=os.environ.get("SSL_KEYFILE", r"C:\Certbot\live\vrkodex.ru\privkey.pem") or None,
+        ssl_certfile=os.environ.get("SSL_CERTFILE", r"C:\Certbot\live\vrkodex.ru\fullchain.pem") or None
+    )
+elif __name__ == "__main__":
     uvicorn.run(
         "server:app", 
         host="0.0.0.0", 
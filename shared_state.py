@@ -0,0 +1,133 @@
+"""
+Общее состояние для запуска в несколько воркеров/машин: история диалогов и кеши.
+
+По умолчанию — память процесса (как раньше, для одного воркера).
+С SHARED_STATE_URL=redis://... история и кеш ответов живут в Redis, и любой воркер
+может обслужить любой запрос устройства без «липких» сессий.
+"""
+
+import json
+import time
+
+
+class MemoryState:
+    """Состояние в памяти процесса — только для одного воркера"""
+
+    def __init__(self, session_ttl: float = 6 * 3600):
+        self.session_ttl = session_ttl
+        self._history = {}
+        self._kv = {}
+
+    async def get_history(self, device_id: str, character: str) -> list:
+        return list(self._history.get(device_id, {}).get(character, []))
+
+    async def append_history(self, device_id: str, character: str, message: dict, max_len: int):
+        history = self._history.setdefault(device_id, {}).setdefault(character, [])
+        history.append(message)
+        if len(history) > max_len:
+            del history[:-max_len]
+
+    async def drop_history_head(self, device_id: str, character: str, count: int):
+        """Убрать count самых старых сообщений (они свёрнуты в сводку)"""
+        history = self._history.get(device_id, {}).get(character)
+        if history:
+            del history[:count]
+
+    async def get(self, key: str):
+        item = self._kv.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at and expires_at < time.time():
+            del self._kv[key]
+            return None
+        return value
+
+    async def set(self, key: str, value, ttl: float = 0):
+        self._kv[key] = (value, time.time() + ttl if ttl else 0)
+
+    async def incr(self, key: str, ttl: float = 0) -> int:
+        value = (await self.get(key) or 0) + 1
+        item = self._kv.get(key)
+        expires_at = item[1] if item else 0
+        self._kv[key] = (value, expires_at or (time.time() + ttl if ttl else 0))
+        return value
+
+    async def decr(self, key: str) -> int:
+        item = self._kv.get(key)
+        if item is None:
+            return 0
+        value = item[0] - 1
+        self._kv[key] = (value, item[1])
+        return value
+
+    async def try_lock(self, name: str, ttl: float) -> bool:
+        if await self.get(f"lock:{name}") is not None:
+            return False
+        await self.set(f"lock:{name}", 1, ttl)
+        return True
+
+
+class RedisState:
+    """Состояние в Redis: общее для всех воркеров и машин"""
+
+    def __init__(self, url: str, session_ttl: float = 6 * 3600, prefix: str = "cheb:"):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.session_ttl = int(session_ttl)
+        self.prefix = prefix
+
+    def _hist_key(self, device_id: str, character: str) -> str:
+        return f"{self.prefix}hist:{device_id}:{character}"
+
+    async def get_history(self, device_id: str, character: str) -> list:
+        items = await self.redis.lrange(self._hist_key(device_id, character), 0, -1)
+        return [json.loads(item) for item in items]
+
+    async def append_history(self, device_id: str, character: str, message: dict, max_len: int):
+        key = self._hist_key(device_id, character)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(message, ensure_ascii=False))
+            pipe.ltrim(key, -max_len, -1)
+            pipe.expire(key, self.session_ttl)
+            await pipe.execute()
+
+    async def drop_history_head(self, device_id: str, character: str, count: int):
+        # Новые сообщения добавляются в хвост, поэтому срез головы не теряет их при гонке
+        await self.redis.ltrim(self._hist_key(device_id, character), count, -1)
+
+    async def get(self, key: str):
+        raw = await self.redis.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key: str, value, ttl: float = 0):
+        await self.redis.set(self.prefix + key, json.dumps(value, ensure_ascii=False),
+                             ex=int(ttl) if ttl else None)
+
+    async def incr(self, key: str, ttl: float = 0) -> int:
+        value = await self.redis.incr(self.prefix + key)
+        if value == 1 and ttl:
+            await self.redis.expire(self.prefix + key, int(ttl))
+        return value
+
+    async def decr(self, key: str) -> int:
+        return await self.redis.decr(self.prefix + key)
+
+    async def try_lock(self, name: str, ttl: float) -> bool:
+        return bool(await self.redis.set(f"{self.prefix}lock:{name}", 1, nx=True, ex=int(ttl)))
+
+
+def create_state(url: str = "", session_ttl: float = 6 * 3600, workers: int = 1):
+    """
+    Redis по url или память процесса. Память процесса при нескольких воркерах — ошибка конфигурации:
+    история делится между воркерами, замки и дневной бюджет Nano Banana действуют в каждом отдельно,
+    а результат фото-задачи виден только принявшему её воркеру.
+    """
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisState(url, session_ttl)
+    if url:
+        raise ValueError(f"SHARED_STATE_URL: ожидается redis:// или rediss://, а не {url!r}")
+    if workers > 1:
+        raise RuntimeError(f"{workers} воркеров без общего состояния: задайте SHARED_STATE_URL=redis://...")
+    return MemoryState(session_ttl)
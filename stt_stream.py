@@ -0,0 +1,189 @@
+"""
+Потоковое распознавание речи: webm-кадры из браузера -> PCM через ffmpeg -> streaming STT.
+
+Используется WebSocket-эндпоинтом /api/chat-ws в server.py. Распознаватель выдаёт
+события ("partial", текст) по мере речи и ("final", текст) в конце фразы.
+"""
+
+import asyncio
+import subprocess
+
+# Параметры PCM, которые получает распознаватель
+PCM_SAMPLE_RATE = 16000
+PCM_CHUNK_BYTES = 3200  # 100 мс моно s16le при 16 кГц
+
+YANDEX_STT_GRPC_HOST = "stt.api.cloud.yandex.net:443"
+
+
+class FfmpegTranscoder:
+    """Перекодирует поток webm/opus в сырой PCM s16le на лету через ffmpeg (stdin -> stdout)."""
+
+    def __init__(self, sample_rate: int = PCM_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.proc = None
+
+    def start(self):
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-f", "s16le", "-acodec", "pcm_s16le",
+            "-ar", str(self.sample_rate), "-ac", "1",
+            "pipe:1",
+        ]
+        # Popen + потоки вместо asyncio-субпроцессов: работает с любым event loop (в т.ч. на Windows)
+        self.proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+
+    async def feed(self, data: bytes):
+        """Передать очередной кусок webm в ffmpeg"""
+        if self.proc is None or self.proc.stdin.closed:
+            return
+        try:
+            await asyncio.to_thread(self._write, data)
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _write(self, data: bytes):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    async def close_input(self):
+        """Сообщить ffmpeg, что аудио закончилось"""
+        if self.proc is not None and not self.proc.stdin.closed:
+            try:
+                await asyncio.to_thread(self.proc.stdin.close)
+            except OSError:
+                pass
+
+    async def pcm_chunks(self):
+        """Асинхронный итератор PCM-фрагментов, пока ffmpeg не закроет stdout"""
+        while True:
+            chunk = await asyncio.to_thread(self.proc.stdout.read1, PCM_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+    def kill(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        if self.proc is not None:
+            self.proc.wait()
+
+
+class MockStreamingRecognizer:
+    """
+    Локальный распознаватель для тестов: «распознаёт» заданную фразу.
+    Слова открываются пропорционально полученному аудио, финал — в конце потока.
+    """
+
+    def __init__(self, text: str = "привет как тебя зовут", bytes_per_word: int = PCM_CHUNK_BYTES * 3):
+        self.text = text
+        self.bytes_per_word = bytes_per_word
+
+    async def recognize(self, pcm_chunks):
+        words = self.text.split()
+        received = 0
+        shown = 0
+        async for chunk in pcm_chunks:
+            received += len(chunk)
+            count = min(len(words), received // self.bytes_per_word)
+            if count > shown:
+                shown = count
+                yield "partial", " ".join(words[:shown])
+        yield "final", self.text
+
+
+class YandexStreamingRecognizer:
+    """Потоковый распознаватель SpeechKit v3 (gRPC RecognizeStreaming)."""
+
+    def __init__(self, api_key: str, folder_id: str, sample_rate: int = PCM_SAMPLE_RATE):
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self.sample_rate = sample_rate
+
+    def _session_options(self, stt_pb2):
+        return stt_pb2.StreamingOptions(
+            recognition_model=stt_pb2.RecognitionModelOptions(
+                audio_format=stt_pb2.AudioFormatOptions(
+                    raw_audio=stt_pb2.RawAudio(
+                        audio_encoding=stt_pb2.RawAudio.LINEAR16_PCM,
+                        sample_rate_hertz=self.sample_rate,
+                        audio_channel_count=1,
+                    )
+                ),
+                text_normalization=stt_pb2.TextNormalizationOptions(
+                    text_normalization=stt_pb2.TextNormalizationOptions.TEXT_NORMALIZATION_ENABLED,
+                    profanity_filter=True,
+                    literature_text=False,
+                ),
+                language_restriction=stt_pb2.LanguageRestrictionOptions(
+                    restriction_type=stt_pb2.LanguageRestrictionOptions.WHITELIST,
+                    language_code=["ru-RU"],
+                ),
+                audio_processing_type=stt_pb2.RecognitionModelOptions.REAL_TIME,
+            )
+        )
+
+    async def recognize(self, pcm_chunks):
+        # gRPC-стабы ставятся отдельно: pip install grpcio yandexcloud
+        import grpc
+        from yandex.cloud.ai.stt.v3 import stt_pb2, stt_service_pb2_grpc
+
+        async def requests_iter():
+            yield stt_pb2.StreamingRequest(session_options=self._session_options(stt_pb2))
+            async for chunk in pcm_chunks:
+                yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=chunk))
+
+        channel = grpc.aio.secure_channel(YANDEX_STT_GRPC_HOST, grpc.ssl_channel_credentials())
+        call = None
+        try:
+            stub = stt_service_pb2_grpc.RecognizerStub(channel)
+            call = stub.RecognizeStreaming(
+                requests_iter(),
+                metadata=(
+                    ("authorization", f"Api-Key {self.api_key}"),
+                    ("x-folder-id", self.folder_id),
+                ),
+            )
+            async for kind, text in utterance_events(call):
+                yield kind, text
+        finally:
+            # Потребитель может бросить генератор после финала — вызов и канал закрываем явно
+            if call is not None:
+                call.cancel()
+            await channel.close()
+
+
+async def utterance_events(responses):
+    """
+    События одной реплики из ответов RecognizeStreaming.
+    Финалы приходят по сегментам (пауза внутри фразы даёт отдельный final), final_refinement
+    уточняет сегмент нормализованным текстом; фраза закончена по eou_update или концу потока.
+    """
+    segments = {}
+    async for response in responses:
+        event = response.WhichOneof("Event")
+        index = response.audio_cursors.final_index
+        if event == "partial" and response.partial.alternatives:
+            done = [segments[i] for i in sorted(segments) if i < index]
+            yield "partial", " ".join(done + [response.partial.alternatives[0].text])
+        elif event == "final" and response.final.alternatives:
+            if response.final.alternatives[0].text:
+                segments[index] = response.final.alternatives[0].text
+        elif event == "final_refinement" and response.final_refinement.normalized_text.alternatives:
+            text = response.final_refinement.normalized_text.alternatives[0].text
+            if text:
+                segments[index] = text
+        elif event == "eou_update" and segments:
+            break
+    yield "final", " ".join(segments[i] for i in sorted(segments))
+
+
+def create_recognizer(backend: str, api_key: str = "", folder_id: str = ""):
+    """Фабрика распознавателя: "yandex" для продакшена, "mock" для локальных тестов"""
+    if backend == "mock":
+        return MockStreamingRecognizer()
+    if backend == "yandex":
+        return YandexStreamingRecognizer(api_key, folder_id)
+    raise ValueError(f"Неизвестный STT backend: {backend}")
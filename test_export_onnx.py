@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Паритет ONNX-моделей RVC с torch через export_onnx.parity(): python test_export_onnx.py (или pytest).
+Нужны torch, fairseq, onnxruntime, экспортированные модели и реплика TTS; без них тест пропускается.
+
+    PARITY_MODELS=cheb,gena PARITY_WAV=samples/alena.wav pytest test_export_onnx.py
+"""
+
+import os
+
+import pytest
+
+PARITY_MODELS = [m for m in os.environ.get("PARITY_MODELS", "cheb").split(",") if m]
+PARITY_WAV = os.environ.get("PARITY_WAV", "samples/alena.wav")
+
+
+@pytest.mark.parametrize("model", PARITY_MODELS)
+def test_onnx_parity(model):
+    pytest.importorskip("torch")
+    pytest.importorskip("fairseq")
+    pytest.importorskip("onnxruntime")
+    import export_onnx
+    import rvc_onnx
+
+    if not os.path.exists(PARITY_WAV):
+        pytest.skip(f"нет реплики {PARITY_WAV} (PARITY_WAV)")
+    for precision in ("fp32", "int8"):
+        if not os.path.exists(os.path.join(rvc_onnx.RVC_ONNX_DIR, f"{model}.{precision}.onnx")):
+            pytest.skip(f"{model} не экспортирована: python export_onnx.py export {model}")
+
+    # Те же аргументы и пороги, что у python export_onnx.py parity
+    args = export_onnx.build_parser().parse_args(["parity", model, "--wav", PARITY_WAV])
+    assert export_onnx.parity(model, args), (
+        f"{model}: LSD выше порога (fp32 {args.max_lsd_fp32} дБ, int8 {args.max_lsd_int8} дБ)"
+    )
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-v"]))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Проверки предохранителя resilience.py: python test_resilience.py (или pytest)
+"""
+
+import asyncio
+
+from resilience import CircuitOpenError, Resilience, UpstreamError
+
+
+def test_cancelled_probe_does_not_jam_breaker():
+    async def scenario():
+        upstream = Resilience()
+        policy = upstream.register("llm", min_timeout=1, max_timeout=1, default_latency=0.1, max_retries=0)
+        policy.breaker.reset_timeout = 0.0
+
+        async def failing():
+            raise UpstreamError("HTTP 503")
+
+        for _ in range(policy.breaker.consecutive_limit):
+            try:
+                await upstream.call("llm", failing)
+            except UpstreamError:
+                pass
+        assert policy.breaker.state == "open"
+
+        # Пробный вызов half-open отменяется, как при отключении клиента посреди стрима
+        probe = asyncio.ensure_future(upstream.call("llm", lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        assert policy.breaker.state == "half_open"
+        probe.cancel()
+        try:
+            await probe
+        except asyncio.CancelledError:
+            pass
+
+        async def ok():
+            return "ok"
+
+        assert await upstream.call("llm", ok) == "ok"
+        assert policy.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_open_breaker_rejects():
+    async def scenario():
+        upstream = Resilience()
+        policy = upstream.register("tts", min_timeout=1, max_timeout=1, default_latency=0.1, max_retries=0)
+        policy.breaker._trip()
+        try:
+            await upstream.call("tts", lambda: asyncio.sleep(0))
+        except CircuitOpenError:
+            return
+        raise AssertionError("разомкнутый предохранитель пропустил вызов")
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_cancelled_probe_does_not_jam_breaker()
+    test_open_breaker_rejects()
+    print("OK")
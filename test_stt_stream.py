@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Проверки потокового распознавания stt_stream.py: python test_stt_stream.py (или pytest)
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from stt_stream import PCM_CHUNK_BYTES, MockStreamingRecognizer, utterance_events
+
+
+def response(event: str, final_index: int, text: str = ""):
+    """Ответ RecognizeStreaming в том виде, в каком его читает utterance_events"""
+    alternatives = [SimpleNamespace(text=text)]
+    return SimpleNamespace(
+        WhichOneof=lambda _: event,
+        audio_cursors=SimpleNamespace(final_index=final_index),
+        partial=SimpleNamespace(alternatives=alternatives),
+        final=SimpleNamespace(alternatives=alternatives),
+        final_refinement=SimpleNamespace(normalized_text=SimpleNamespace(alternatives=alternatives)),
+    )
+
+
+async def stream(items):
+    for item in items:
+        yield item
+
+
+async def collect(events) -> list:
+    return [event async for event in events]
+
+
+def test_mock_recognizer_partials_then_final():
+    async def scenario():
+        recognizer = MockStreamingRecognizer("раз два три", bytes_per_word=PCM_CHUNK_BYTES)
+        chunks = stream([b"\0" * PCM_CHUNK_BYTES] * 4)
+        return await collect(recognizer.recognize(chunks))
+
+    assert asyncio.run(scenario()) == [
+        ("partial", "раз"), ("partial", "раз два"), ("partial", "раз два три"), ("final", "раз два три"),
+    ]
+
+
+def test_final_waits_for_end_of_utterance():
+    consumed = []
+
+    async def responses():
+        for item in [
+            response("partial", 0, "привет"),
+            response("final", 0, "привет"),
+            response("partial", 1, "как"),
+            response("final", 1, "как тебя зовут"),
+            response("final_refinement", 1, "Как тебя зовут?"),
+            response("eou_update", 2),
+            response("partial", 2, "лишнее"),
+        ]:
+            consumed.append(item)
+            yield item
+
+    events = asyncio.run(collect(utterance_events(responses())))
+    assert events == [
+        ("partial", "привет"), ("partial", "привет как"), ("final", "привет Как тебя зовут?"),
+    ]
+    # Ответы после конца фразы не читаются
+    assert len(consumed) == 6
+
+
+def test_final_at_end_of_stream():
+    events = asyncio.run(collect(utterance_events(stream([
+        response("eou_update", 0),
+        response("final", 0, "один"),
+        response("final", 1, "два"),
+    ]))))
+    # eou до первого финала фразу не заканчивает
+    assert events == [("final", "один два")]
+    assert asyncio.run(collect(utterance_events(stream([])))) == [("final", "")]
+
+
+if __name__ == "__main__":
+    test_mock_recognizer_partials_then_final()
+    test_final_waits_for_end_of_utterance()
+    test_final_at_end_of_stream()
+    print("OK")
@@ -4,44 +4,45 @@ import shutil
 import subprocess
 import base64
 import requests
+from pitch import LOCAL_METHODS, prepare_f0_file
+from characters import CharacterRegistry
+from logs import setup_logging, get_logger, begin_request, StageTimer, stage_timings
 from flask import Flask, render_template_string, request, jsonify
 
 app = Flask(__name__)
 
+setup_logging()
+log = get_logger("voice_generator")
+
 # Yandex API credentials
 API_KEY = ""
 FOLDER_ID = ""
 
-# Настройки голосов для TTS
-TTS_VOICES = {
-    "cheb": "alena",      # Чебурашка
-    "gena": "ermil",      # Крокодил Гена
-    "shap": "jane",       # Шапокляк
-    "volc": "filipp"      # Волк
-}
-
-# Настройки моделей для RVC
-RVC_MODELS = {
-    "cheb": {"model": "cheb", "has_index": True},
-    "gena": {"model": "gena", "has_index": True},
-    "shap": {"model": "shap", "has_index": True},
-    "volc": {"model": "volc", "has_index": False}
-}
+# Голоса TTS и модели RVC — в characters.json, общем с server.py; файл перечитывается на каждой генерации.
+# Генерация офлайн, поэтому здесь берётся rvc.offline_f0_method — качественнее, чем f0_method в чате
+characters = CharacterRegistry()
 
 def run_cmd(cmd):
     """Запуск команды"""
-    print("RUN:", " ".join(cmd))
+    log.debug("RUN: %s", " ".join(cmd))
     proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if proc.returncode != 0:
-        print("ERROR:", proc.stderr.decode('utf-8', errors='ignore'))
+        log.error("Команда завершилась с ошибкой: %s", proc.stderr.decode('utf-8', errors='ignore'),
+                  extra={"cmd": cmd[0]})
         raise RuntimeError("Command failed")
     return proc.stdout
 
-def rvc_convert(input_audio, output_audio, model_name, has_index):
+def rvc_convert(input_audio, output_audio, model_name, has_index, f0_method="pm"):
     """RVC конвертация через RvcWebUI localhost API"""
     try:
+        # Локальные методы: кривая f0 считается здесь и передаётся файлом, RvcWebUI считает дешёвый pm
+        f0_file = None
+        if f0_method in LOCAL_METHODS:
+            f0_file = prepare_f0_file(f0_method, input_audio, os.path.dirname(output_audio))
+            f0_method = "pm"
+        
         # Выбор голоса
-        print(f"Выбираем голос: {model_name}.pth")
+        log.info("Выбираем голос: %s.pth", model_name, extra={"verbose": True})
         response = requests.post("http://localhost:7897/run/infer_set", json={
             "data": [f"{model_name}.pth", 0.33, 0.33]
         }, timeout=30)
@@ -57,8 +58,8 @@ def rvc_convert(input_audio, output_audio, model_name, has_index):
                 0,              # pitch
                 input_audio,    # input path
                 0,
-                None,
-                "pm",          # f0_method
+                {"name": f0_file, "data": None, "is_file": True} if f0_file else None,  # f0 file
+                f0_method,     # f0_method
                 "",
                 index_path,    # index path
                 0.85,          # index_rate
@@ -81,7 +82,7 @@ def rvc_convert(input_audio, output_audio, model_name, has_index):
         return output_audio
         
     except Exception as e:
-        print(f"RVC conversion failed: {e}")
+        log.warning("RVC conversion failed: %s", e)
         if os.path.exists(input_audio) and input_audio != output_audio:
             shutil.copy(input_audio, output_audio)
         return output_audio
@@ -89,6 +90,7 @@ def rvc_convert(input_audio, output_audio, model_name, has_index):
 @app.route('/')
 def index():
     """Главная страница с интерфейсом"""
+    characters.refresh()
     return render_template_string('''
 <!DOCTYPE html>
 <html>
@@ -194,10 +196,9 @@ def index():
         <div class="form-group">
             <label for="character">Выберите персонажа:</label>
             <select id="character">
-                <option value="cheb">Чебурашка</option>
-                <option value="gena">Крокодил Гена</option>
-                <option value="shap">Шапокляк</option>
-                <option value="volc">Волк</option>
+                {% for character in characters %}
+                <option value="{{ character.id }}">{{ character.name }}</option>
+                {% endfor %}
             </select>
         </div>
         
@@ -286,7 +287,7 @@ def index():
     </script>
 </body>
 </html>
-    ''')
+    ''', characters=list(characters.current.characters.values()))
 
 @app.route('/generate', methods=['POST'])
 def generate():
@@ -299,35 +300,35 @@ def generate():
         if not character or not text:
             return jsonify({"detail": "Не указан персонаж или текст"}), 400
         
-        if character not in TTS_VOICES:
+        characters.refresh()
+        if character not in characters.current:
             return jsonify({"detail": "Неизвестный персонаж"}), 400
         
         # Создаём временную директорию
         temp_dir = tempfile.mkdtemp()
         
         try:
-            print(f"\n{'='*60}")
-            print(f"Генерация аудио для персонажа: {character}")
-            print(f"Текст: {text}")
-            print(f"{'='*60}\n")
+            begin_request(request.headers.get("X-Request-ID"), endpoint="generate", character=character)
+            log.debug("Текст: %s", text)
             
             # 1. Text-to-Speech через Яндекс
-            print("[1/3] Синтез речи через Яндекс TTS...")
-            selected_voice = TTS_VOICES[character]
+            profile = characters.get(character)
+            selected_voice = profile.tts_voice
             
-            tts_response = requests.post(
-                "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize",
-                headers={"Authorization": f"Api-Key {API_KEY}"},
-                data={
-                    "text": text,
-                    "lang": "ru-RU",
-                    "voice": selected_voice,
-                    "folderId": FOLDER_ID,
-                    "format": "oggopus",
-                    "sampleRateHertz": "48000"
-                },
-                timeout=30
-            )
+            with StageTimer("tts", voice=selected_voice):
+                tts_response = requests.post(
+                    "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize",
+                    headers={"Authorization": f"Api-Key {API_KEY}"},
+                    data={
+                        "text": text,
+                        "lang": "ru-RU",
+                        "voice": selected_voice,
+                        "folderId": FOLDER_ID,
+                        "format": "oggopus",
+                        "sampleRateHertz": "48000"
+                    },
+                    timeout=30
+                )
             
             if tts_response.status_code != 200:
                 return jsonify({"detail": f"TTS error: {tts_response.text}"}), 500
@@ -337,31 +338,28 @@ def generate():
             with open(tts_ogg, "wb") as f:
                 f.write(tts_response.content)
             
-            print("✓ TTS завершён")
-            
             # 2. Конвертируем OGG в WAV для RVC
-            print("[2/3] Конвертация в WAV...")
             tts_wav = os.path.join(temp_dir, "tts.wav")
-            run_cmd(["ffmpeg", "-y", "-i", tts_ogg, "-ar", "40000", "-ac", "1", tts_wav])
-            print("✓ Конвертация завершена")
+            with StageTimer("transcode"):
+                run_cmd(["ffmpeg", "-y", "-i", tts_ogg, "-ar", "40000", "-ac", "1", tts_wav])
             
             # 3. Применяем RVC
-            print("[3/3] Клонирование голоса через RVC...")
             final_audio = tts_wav
-            model_config = RVC_MODELS.get(character)
+            model_config = profile.rvc
             
             if model_config:
                 rvc_out = os.path.join(temp_dir, "rvc_out.wav")
                 try:
-                    final_audio = rvc_convert(
-                        tts_wav,
-                        rvc_out,
-                        model_config["model"],
-                        model_config.get("has_index", False)
-                    )
-                    print("✓ RVC завершён")
+                    with StageTimer("rvc", f0_method=model_config["offline_f0_method"]):
+                        final_audio = rvc_convert(
+                            tts_wav,
+                            rvc_out,
+                            model_config["model"],
+                            model_config["has_index"],
+                            model_config["offline_f0_method"]
+                        )
                 except Exception as e:
-                    print(f"RVC failed, используем оригинальный TTS: {e}")
+                    log.warning("RVC failed, используем оригинальный TTS: %s", e)
             
             # 4. Конвертируем в MP3
             final_mp3 = os.path.join(temp_dir, "final.mp3")
@@ -371,9 +369,7 @@ def generate():
             with open(final_mp3, "rb") as f:
                 audio_b64 = base64.b64encode(f.read()).decode('utf-8')
             
-            print(f"\n{'='*60}")
-            print("🎯 ГОТОВО!")
-            print(f"{'='*60}\n")
+            log.info("Аудио готово", extra={"timings": stage_timings()})
             
             return jsonify({"audio_base64": audio_b64})
             
@@ -383,8 +379,7 @@ def generate():
                 shutil.rmtree(temp_dir)
     
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log.exception("Ошибка генерации аудио")
         return jsonify({"detail": str(e)}), 500
 
 if __name__ == "__main__":